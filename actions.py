@@ -116,7 +116,7 @@ class ActionRule:
 		if what == "reject":
 			return True
 		elif what == "ipmax":
-			return conntrack.ipcount(hi.getip()) >= val
+			return conntrack.ipcount(hi.getipn()) >= val
 		else:
 			return conntrack.classcount(cls.name) >= val
 	def doesfailall(self, hi):
@@ -10,6 +10,12 @@ import util
 class BadInput(Exception):
 	pass
 
+# Directives that take a TIMESPEC argument.
+timespecs = ('dropipafter', 'expireevery', 'forwhnrefresh',
+	     'answersonttl', 'answersonnegttl', 'identdnegttl',
+	     'iptimessave', 'dnsttl', 'dnsnegttl', 'reorderevery',
+	     'rulecachettl')
+
 # Unlike rule and action files, our overall configuration file is completely
 # interdependant. As a result, we hang all our parsing off a class so we can
 # do lookups easily.
@@ -25,7 +31,7 @@ class NannyConfig:
 		ks = self.cf.keys()
 		ks.sort()
 		for k in ks:
-			if k in ('dropipafter', 'expireevery'):
+			if k in timespecs:
 				a.append("%s %ss" % (k, self.cf[k]))
 			elif k != 'listen':
 				a.append("%s %s" % (k, self.cf[k]))
@@ -35,6 +41,8 @@ class NannyConfig:
 		return "\n".join(a) + "\n"
 	def __getitem__(self, name):
 		return self.cf[name]
+	def get(self, name, default = None):
+		return self.cf.get(name, default)
 	def has_key(self, name):
 		return self.cf.has_key(name)
 	def __contains__(self, name):
@@ -52,16 +60,17 @@ class NannyConfig:
 		if n[0] != "listen" and self.cf.has_key(n[0]):
 			raise BadInput, "can only give one %s directive" % \
 			      (n[0],)
-		# These three do no contents-checking: they just store it.
-		if n[0] in ('rulefile', 'actionfile', 'user', 'aftermaxthreads'):
+		# These do no contents-checking: they just store it.
+		if n[0] in ('rulefile', 'actionfile', 'user', 'aftermaxthreads',
+			    'iptimesfile', 'hostmap', 'cachefile'):
 			self.cf[n[0]] = n[1]
-		# I really need a better name for this.
-		elif n[0] == 'dropipafter':
-			self.cf[n[0]] = util.getsecs_or_raise(n[1], BadInput)
-		elif n[0] == 'expireevery':
+		# I really need a better name for dropipafter.
+		elif n[0] in timespecs:
 			self.cf[n[0]] = util.getsecs_or_raise(n[1], BadInput)
-		elif n[0] == 'maxthreads':
+		elif n[0] in ('maxthreads', 'lookupbudget', 'maxiptimes'):
 			self.cf[n[0]] = util.int_or_raise(n[1], BadInput)
+			if self.cf[n[0]] < 0:
+				raise BadInput, "%s cannot be negative" % (n[0],)
 		elif n[0] == 'listen':
 			# Listen stores host/port pairs in a list, since
 			# we can legally accept multiple listen directives.
@@ -77,9 +86,10 @@ class NannyConfig:
 			if n[1] not in ('drop', 'use-old'):
 				raise BadInput, "unknown option for onfileerror"
 			self.cf[n[0]] = n[1]
-		elif n[0] == "substitutions":
+		elif n[0] in ("substitutions", "prefetch", "lognames",
+			      "cheapfirst"):
 			if n[1] not in ("off", "on"):
-				raise BadInput, "substitutions must be off or on"
+				raise BadInput, "%s must be off or on" % (n[0],)
 			self.cf[n[0]] = n[1]
 		else:
 			raise BadInput, "unknown config file directive "+n[0]
@@ -2,7 +2,10 @@
 # Track active connections.
 # Active connections are started with PID / IP / Classes, and are ended
 # with PID. We can query for how many connections currently exist for a
-# given IP address or class.
+# given IP address or class. IP addresses are normally in numeric form
+# (as from HostInfo.getipn()), but we don't care.
+
+import netblock
 
 class DuplicatePid(Exception):
 	pass
@@ -15,8 +18,11 @@ class ConnInfo:
 		self.ip = ip
 		self.classes = classes
 	def __str__(self):
+		ip = self.ip
+		if isinstance(ip, (int, long)):
+			ip = netblock.ipstr(ip)
 		return "<CI: PID %d, IP %s, classes: %s>" % \
-		       (self.pid, self.ip, " ".join(self.classes))
+		       (self.pid, ip, " ".join(self.classes))
 
 pidmap = {}
 clsmap = {}
@@ -34,6 +34,8 @@ def genHNStat(mo):
 def genIPM(mo):
 	return "mergeList(%s)" % (", ".join(["%s('%s', '%s')" % (mName(mo), mo.cname, x) for x in mo.name]))
 def genHNM(mo):
+	if mo.names:
+		return "mergeList(%s)" % (", ".join(["%s('%s', '%s')" % (mName(mo), mo.cname, x) for x in mo.names]))
 	if mo.hoste:
 		return mStr(mo, mo.cname, mo.hoste)
 	else:
@@ -41,6 +43,8 @@ def genHNM(mo):
 def genCMatch(mo):
 	return mStr(mo, 'class:', mo.cls)
 def genRE(mo):
+	if mo.pats:
+		return "mergeList(%s)" % (", ".join([mStr(mo, mo.cname, x) for x in mo.pats]))
 	return mStr(mo, mo.cname, mo.rexp.pattern)
 def genFor(mo):
 	return mStr(mo, 'forwhn:', mo.forwhn)
@@ -49,6 +53,8 @@ def genDNSBL(mo):
 		return mStr(mo, "dnsbl:", '%s/%s' % (mo.dnsbl[1:], mo.ipval))
 	else:
 		return mStr(mo, "dnsbl:", mo.dnsbl[1:])
+def genAns(mo):
+	return "mergeList(%s)" % (", ".join(["%s(intern('answerson:'), '%s')" % (mName(mo), x) for x in mo.ports]))
 def genTime(mo):
 	return mStr(mo, mo.name, "%ss" % mo.secsold)
 
@@ -68,10 +74,11 @@ nodeDict = {
 	matchers.REMatch: genRE, matchers.ClaimedREMatch: genRE,
 	matchers.ForwhnMatch: genFor,
 	matchers.DNSBlMatch: genDNSBL,
-	matchers.AnswersOnMatch: lambda x: "%s(intern('answerson:'), '%s')" % (mName(x), x.port),
+	matchers.AnswersOnMatch: genAns,
 	matchers.WaitedMatch: genTime, matchers.StallMatch: genTime,
 	matchers.LastSeenMatch: genTime, matchers.NotSeenForMatch: genTime,
 	matchers.FirstTimeMatch: lambda x: "%s(intern('firsttime'), None)" % mName(x),
+	matchers.DNSDegradedMatch: lambda x: "%s(intern('dnsdegraded'), None)" % mName(x),
 	}
 def genMatchRule(mre):
 	if mre.__class__ not in nodeDict:
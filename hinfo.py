@@ -6,7 +6,9 @@
 # The major product of this module is a 'hinfo object' (class HostInfo),
 # which aggregates cached information and supplies lookup services.
 
-import socket, time, select, errno
+import socket, time, select, errno, os, array, struct, mmap, itertools
+import marshal
+import thread, threading, Queue
 import idclient
 import util
 import netblock
@@ -14,6 +16,9 @@ import netblock
 # Half a second is an experimental value.
 IDENTDTIMEOUT = 0.5
 CONNTIMEOUT = 0.5
+# How often, in seconds, the forward lookups of forwhn: names are
+# redone by default.
+FORWREFRESH = 300
 
 # Determine the name of an ip address as paranoidly as possible.
 # There are four possible result states:
@@ -24,22 +29,292 @@ CONNTIMEOUT = 0.5
 #	       name do not include the IP address.
 # good -> the name/ip information exists and is consistent.
 def getipname(ip):
+	return _ipname(ip)[0]
+# The real work. We also return whether the answer is definite, as
+# opposed to something we got because the DNS was in trouble; only
+# definite answers are cached.
+def _ipname(ip):
 	try:
 		revname = socket.gethostbyaddr(ip)[0]
-	except socket.error:
-		return ('unknown', None)
+	except socket.error, e:
+		breaker.note(e, 'hostname', ip)
+		return (('unknown', None), not dnstrouble(e))
+	breaker.note(None)
 	# We have to do this explicitly, because gethostbyname_ex() will
 	# work on IP addresses.
 	if util.isipaddr(revname):
-		return ('noforward', revname)
+		return (('noforward', revname), True)
 	try:
 		ips = socket.gethostbyname_ex(revname)[2]
-	except socket.error:
-		return ('noforward', revname)
+	except socket.error, e:
+		breaker.note(e, 'hostname', revname)
+		return (('noforward', revname), not dnstrouble(e))
 	for i in ips:
 		if i == ip:
-			return ('good', revname)
-	return ('addrmismatch', revname)
+			return (('good', revname), True)
+	return (('addrmismatch', revname), True)
+
+# Look up the IP addresses of a hostname, returning an empty list if
+# there are none.
+def gethostips(host):
+	return _hostips(host)[0]
+def _hostips(host):
+	try:
+		ips = socket.gethostbyname_ex(host)[2]
+	except socket.error, e:
+		breaker.note(e, 'dnsbl', host)
+		return ([], not dnstrouble(e))
+	breaker.note(None)
+	return (ips, True)
+
+# The same, but putting definite answers in the shared DNS caches
+# (see namecache and dnscache, below).
+def cachedipname(ip):
+	r, definite = _ipname(ip)
+	if definite:
+		namecache.put(ip, r, r[0] != 'unknown')
+	return r
+def cachedhostips(host):
+	r, definite = _hostips(host)
+	if definite:
+		dnscache.put(host, r)
+	return r
+
+# Did a DNS lookup fail because the DNS is in trouble, as opposed to
+# giving us a definite 'no such thing'? (socket.herror's errno is an
+# h_errno value; 2 and 3 are TRY_AGAIN and NO_RECOVERY.)
+def dnstrouble(e):
+	if isinstance(e, socket.timeout):
+		return True
+	if isinstance(e, socket.gaierror):
+		return e.args[0] in (socket.EAI_AGAIN, socket.EAI_FAIL)
+	if isinstance(e, socket.herror):
+		return e.args[0] in (2, 3)
+	return False
+
+# If the DNS is in trouble, every lookup waits a long time and then
+# fails, and soon all of our threads are stuck in lookups. So we keep
+# track of how DNS lookups have gone over the last BREAKWINDOW seconds
+# and if too many of them have failed (or run out of lookup budget),
+# the breaker trips. While it is tripped, hostname and DNSBl lookups
+# immediately give 'unknown' or no-answer results, and a background
+# thread retries the last lookup that failed every BREAKPROBE seconds;
+# once that gets an answer, the breaker resets.
+BREAKWINDOW = 30
+BREAKMIN = 20
+BREAKRATIO = 0.5
+BREAKPROBE = 5
+class Breaker:
+	def __init__(self):
+		self.lock = thread.allocate_lock()
+		self.trips = 0
+		self.skips = 0
+		self.reset()
+	def reset(self):
+		# slots is second -> [good, bad] counts.
+		self.slots = {}
+		self.tripped = 0
+		self.probe = None
+	# Record how a lookup went. err is None if it worked; otherwise
+	# it is the socket error, or True for running out of budget,
+	# and kind and arg say what the lookup was for.
+	def note(self, err, kind = None, arg = None):
+		if err is not None and err is not True and not dnstrouble(err):
+			err = None
+		now = int(time.time())
+		self.lock.acquire()
+		try:
+			if now not in self.slots:
+				for k in self.slots.keys():
+					if k <= now - BREAKWINDOW:
+						del self.slots[k]
+				self.slots[now] = [0, 0]
+			if err is None:
+				self.slots[now][0] += 1
+				return
+			self.slots[now][1] += 1
+			self.probe = (kind, arg)
+			if self.tripped:
+				return
+			good = sum([x[0] for x in self.slots.values()])
+			bad = sum([x[1] for x in self.slots.values()])
+			if good + bad < BREAKMIN or bad < (good + bad) * BREAKRATIO:
+				return
+			self.tripped = now
+			self.trips += 1
+		finally:
+			self.lock.release()
+		thread.start_new_thread(self._prober, ())
+	def skip(self):
+		self.skips += 1
+	# Our probes go straight to the resolver, so that they are not
+	# themselves counted. Hostname verification does both reverse and
+	# forward lookups, so what we retry depends on the argument.
+	def _prober(self):
+		while 1:
+			time.sleep(BREAKPROBE)
+			kind, arg = self.probe
+			try:
+				if util.isipaddr(arg):
+					socket.gethostbyaddr(arg)
+				else:
+					socket.gethostbyname_ex(arg)
+			except socket.error, e:
+				if dnstrouble(e):
+					continue
+			self.lock.acquire()
+			self.reset()
+			self.lock.release()
+			return
+breaker = Breaker()
+def dnsdegraded():
+	return bool(breaker.tripped)
+def breakerstats():
+	return (breaker.tripped, breaker.trips, breaker.skips)
+
+# A lookup running in the background, so that several of them can be
+# outstanding at once. .get() waits for and returns the answer; if the
+# lookup function blows up, the answer is the default. If .get() is
+# given a timeout and the lookup doesn't finish in time, the answer is
+# also the default (and .finished() is false).
+#
+# Lookups are run by a fixed pool of LOOKUPTHREADS threads, so that a
+# slow DNS cannot make us start threads without limit; lookups that
+# time out keep their thread until they finish. At most LOOKUPMAX
+# lookups can be waiting for or running in the pool at once. Past
+# that, a new lookup is refused: it is never finished and its answer
+# is the default right away.
+LOOKUPTHREADS = 16
+LOOKUPMAX = 256
+class LookupPool:
+	def __init__(self):
+		self.lock = thread.allocate_lock()
+		self.q = Queue.Queue()
+		self.threads = 0
+		self.pending = 0
+		self.refused = 0
+	def submit(self, l, func, args):
+		self.lock.acquire()
+		try:
+			if self.pending >= LOOKUPMAX:
+				self.refused += 1
+				return False
+			self.pending += 1
+			while self.threads < LOOKUPTHREADS:
+				thread.start_new_thread(self._worker, ())
+				self.threads += 1
+		finally:
+			self.lock.release()
+		self.q.put((l, func, args))
+		return True
+	def _worker(self):
+		while 1:
+			l, func, args = self.q.get()
+			try:
+				l._run(func, args)
+			except:
+				pass
+			self.lock.acquire()
+			self.pending -= 1
+			self.lock.release()
+lookuppool = LookupPool()
+def lookupstats():
+	return (lookuppool.pending, lookuppool.refused)
+
+class Lookup:
+	def __init__(self, default, func, *args):
+		self.default = default
+		self.result = default
+		self.done = threading.Event()
+		self.refused = not lookuppool.submit(self, func, args)
+		if self.refused:
+			self.done.set()
+	def _run(self, func, args):
+		try:
+			self.result = func(*args)
+		finally:
+			self.done.set()
+	def finished(self):
+		return self.done.isSet() and not self.refused
+	def get(self, timeout = None):
+		self.done.wait(timeout)
+		if not self.finished():
+			return self.default
+		return self.result
+
+# When one place opens a burst of connections at once, their rules all
+# want the same lookups at the same time. Rather than do each lookup
+# over and over, the first caller of singleflight() for a given function
+# and arguments does the work while any others that arrive while it is
+# in progress wait for it and share its answer. Answers are not kept
+# once the lookup is done; that is what caches are for. If the first
+# caller blows up, the others do the lookup themselves.
+class Flight:
+	def __init__(self):
+		self.result = None
+		self.ok = False
+		self.timeout = None
+		self.done = threading.Event()
+inflight = {}
+inflightlock = thread.allocate_lock()
+flightwaits = 0
+def singleflight(func, *args):
+	global flightwaits
+	key = (func,) + args
+	inflightlock.acquire()
+	f = inflight.get(key)
+	if f is None:
+		f = inflight[key] = Flight()
+		inflightlock.release()
+		try:
+			f.result = func(*args)
+			f.ok = True
+		finally:
+			inflightlock.acquire()
+			del inflight[key]
+			inflightlock.release()
+			f.done.set()
+		return f.result
+	flightwaits += 1
+	inflightlock.release()
+	f.done.wait()
+	if not f.ok:
+		return func(*args)
+	return f.result
+# timedflight() is singleflight() for functions that take a timeout as
+# their last argument. The timeout is not part of what is shared, so
+# callers with different timeouts share one flight, but each caller
+# waits for it no longer than its own timeout. We return None if we
+# gave up waiting, and otherwise the result and the timeout that the
+# flight actually had.
+def timedflight(timeout, func, *args):
+	global flightwaits
+	key = (func,) + args
+	inflightlock.acquire()
+	f = inflight.get(key)
+	if f is None:
+		f = inflight[key] = Flight()
+		f.timeout = timeout
+		inflightlock.release()
+		try:
+			f.result = func(*(args + (timeout,)))
+			f.ok = True
+		finally:
+			inflightlock.acquire()
+			del inflight[key]
+			inflightlock.release()
+			f.done.set()
+		return f.result, timeout
+	flightwaits += 1
+	inflightlock.release()
+	f.done.wait(timeout)
+	if not f.done.isSet():
+		return None
+	if not f.ok:
+		return func(*(args + (timeout,))), timeout
+	return f.result, f.timeout
+def flightstats():
+	return flightwaits
 
 #
 # This is necessary because select.select() can bail with EINTR if we
@@ -62,171 +337,825 @@ def timeoutsel(r, w, e, timeout):
 			timeout = max(et - time.time(), 0)
 	return ([], [], [])
 
-# Can we connect to port on host?
+# Can we connect to ports on host?
 # The Berkeley sockets API complicates our attempts to do this with a
 # timeout, so we don't hang for too long if the remote host is down or
 # discarding packets to that port. We could try to use SIGALRM, but that
 # probably interacts badly with threads.
-def canconnectto(host, port, timeout = CONNTIMEOUT):
-	try:
-		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		s.setblocking(0)
-		# connect() on a nonblocking socket immediately returns
-		# an error indication. I suppose this makes a certain
-		# amount of sense, as does Python propagating it back.
-		# I still wish it didn't do that.
+# All of the ports are probed at once, so asking about several ports
+# costs no more time than asking about one. We return a dictionary of
+# port to True or False.
+def canconnectmany(host, ports, timeout = CONNTIMEOUT):
+	res = {}
+	socks = {}
+	for port in ports:
+		res[port] = False
 		try:
-			s.connect((host, port))
-		except socket.error, e:
-			# Look for immediate failures, check.
-			if e[0] not in (errno.EAGAIN, errno.EINPROGRESS):
-				return False
+			s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			s.setblocking(0)
+			# connect() on a nonblocking socket immediately
+			# returns an error indication. I suppose this makes
+			# a certain amount of sense, as does Python
+			# propagating it back. I still wish it didn't do
+			# that.
+			try:
+				s.connect((host, port))
+			except socket.error, e:
+				# Look for immediate failures, check.
+				if e[0] not in (errno.EAGAIN, errno.EINPROGRESS):
+					continue
+			socks[s] = port
+		except socket.error:
 			pass
-		# The socket will become ready for IO when the connection
-		# completes. We must select for write, because only that
-		# produces an accurate indication; selecting for read would
-		# block until the remote end sends us something, which might
-		# be long after the connection was made.
+	# The sockets will become ready for IO when their connections
+	# complete. We must select for write, because only that produces
+	# an accurate indication; selecting for read would block until
+	# the remote end sends us something, which might be long after
+	# the connection was made. Anything not ready to write by the
+	# time our timeout runs out is a failure.
+	et = time.time() + timeout
+	while socks:
 		try:
-			rt = timeoutsel([], [s], [], timeout)
+			rt = timeoutsel([], socks.keys(), [], max(et - time.time(), 0))
 		except select.error:
 			# Any uncaught errors are assumed to be a 'nope'.
-			return False
-		# If there is nothing ready to write, our timeout has been
-		# exceeded and we declare this a failure.
+			break
 		if not rt[1]:
-			return False
+			break
 		# Now we get any pending error. If there was one, something
 		# went wrong with the connection, so our status is whether
 		# or not getsockopt() finds an error.
-		return s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
-	except socket.error:
-		pass
-	return False
-		
+		for s in rt[1]:
+			port = socks.pop(s)
+			try:
+				res[port] = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+			except socket.error:
+				pass
+	return res
+def canconnectto(host, port, timeout = CONNTIMEOUT):
+	return canconnectmany(host, (port,), timeout)[port]
+
+# A shared cache of answers that expire after a while. Positive and
+# negative answers can have different lifetimes; a lifetime of zero
+# means that such answers aren't cached at all. Entries are
+# (value, expiry-time, positive) tuples, replaced as a unit for thread safety
+# in the same way as IPTimeCache (below). Like IPTimeCache, .expire()
+# relies on only ever being called from the main thread.
+class TTLCache:
+	def __init__(self, ttl = 0, negttl = 0):
+		self.clear()
+		self.setttls(ttl, negttl)
+	def clear(self):
+		self.ents = {}
+	def setttls(self, ttl, negttl):
+		self.ttl = ttl
+		self.negttl = negttl
+	# Raises KeyError if we have no current answer.
+	def get(self, key):
+		return self.getent(key)[0]
+	# The same, but giving the answer and when it expires.
+	def getent(self, key):
+		ent = self.ents[key]
+		if ent[1] < time.time():
+			raise KeyError, key
+		return ent[:2]
+	# Whether an answer is positive or negative is normally its
+	# truth value, but the caller can say otherwise.
+	def put(self, key, val, good = None):
+		if good is None:
+			good = val
+		if good:
+			ttl = self.ttl
+		else:
+			ttl = self.negttl
+		if ttl > 0:
+			self.ents[key] = (val, time.time() + ttl, bool(good))
+	def expire(self):
+		now = time.time()
+		for k, ent in self.ents.items():
+			if ent[1] < now:
+				try:
+					del self.ents[k]
+				except KeyError:
+					pass
+	def __len__(self):
+		return len(self.ents)
+	# Snapshots are lists of (key, value, expiry-time, positive)
+	# tuples for the entries that are still current. When we restore
+	# one, entries that have expired since are dropped, and no entry
+	# is allowed to live longer than our current lifetime for its
+	# sort of answer would let it.
+	def snapshot(self):
+		now = time.time()
+		return [(k,) + ent for k, ent in self.ents.items()
+			if ent[1] >= now]
+	def restore(self, ents):
+		now = time.time()
+		n = 0
+		for k, val, et, good in ents:
+			if good:
+				lim = now + self.ttl
+			else:
+				lim = now + self.negttl
+			if now <= et and now < lim:
+				self.ents[k] = (val, min(et, lim), good)
+				n += 1
+		return n
+
+# Scanners and the like can hit us over and over again, and probing
+# them with answerson: every time is expensive, so the results are
+# shared across connections, keyed by (ip, port).
+ANSWERSONTTL = 300
+ANSWERSONNEGTTL = 60
+anscache = TTLCache(ANSWERSONTTL, ANSWERSONNEGTTL)
+
+def setanswersonttls(ttl, negttl):
+	anscache.setttls(ttl, negttl)
+
+# Most clients today don't run identd and many filter the port, so
+# querying them costs us the full identd timeout every time. Hosts
+# whose identd could not be reached are remembered for a while and
+# their later connections skip the query entirely. We count how often
+# this saves us a query (hits) and how often we had to query (misses).
+IDENTDNEGTTL = 600
+idnegcache = TTLCache(0, IDENTDNEGTTL)
+identhits = 0
+identmisses = 0
+
+def setidentdnegttl(secs):
+	idnegcache.setttls(0, secs)
+def identstats():
+	return (identhits, identmisses)
+
+def identskip(rip):
+	global identhits
+	try:
+		idnegcache.get(rip)
+	except KeyError:
+		return False
+	identhits += 1
+	return True
+def getident(rip, rport, lip, lport, timeout = IDENTDTIMEOUT):
+	global identmisses
+	if identskip(rip):
+		return None
+	identmisses += 1
+	try:
+		return idclient.queryident(rip, rport, lip, lport, timeout)
+	except idclient.NoIdentd:
+		# A query cut short by a lookup budget proves nothing
+		# about the host.
+		if timeout >= IDENTDTIMEOUT:
+			idnegcache.put(rip, False)
+		return None
+
+# If the identd engine is running, identd queries can be started early
+# (as soon as we know that the rules may want the answer) and run in
+# the background while we do other things, such as hostname lookups.
+# Errors in the engine are reported to identlog, if it is set.
+identengine = None
+identlog = None
+def setidentlog(func):
+	global identlog
+	identlog = func
+def startidentengine():
+	global identengine
+	identengine = idclient.IdentEngine(identlog)
+	identengine.start()
+def startident(rip, rport, lip, lport, timeout = IDENTDTIMEOUT):
+	global identmisses
+	identmisses += 1
+	return identengine.submit(rip, rport, lip, lport, timeout)
+def finishident(rip, q):
+	try:
+		return q.wait()
+	except idclient.NoIdentd:
+		idnegcache.put(rip, False)
+		return None
+
+# Answers to hostname lookups and DNS lookups (DNSBl queries and the
+# like) can also be shared between connections. The standard resolver
+# interface doesn't give us record TTLs, so we use fixed lifetimes; by
+# default these are zero, so that we always ask the DNS (and leave
+# caching to the local resolver). A hostname with status 'unknown' and
+# a name with no IP addresses are negative answers. Answers that we
+# got because the DNS was in trouble are never cached.
+namecache = TTLCache()
+dnscache = TTLCache()
+def setdnsttls(ttl, negttl):
+	namecache.setttls(ttl, negttl)
+	dnscache.setttls(ttl, negttl)
+
+# When we are prefetching, HostInfo.prefetch() starts every lookup that
+# the rules could want at once, instead of leaving them to be done one
+# at a time as the rules ask for them. Prefetching identd information
+# needs the identd engine, so we start it here.
+prefetching = 0
+def setprefetch(val):
+	global prefetching
+	prefetching = val
+	if val and identengine is None:
+		startidentengine()
+
+# Each connection can have a total budget of time (in seconds) that all
+# of the lookups made while evaluating rules for it can take; once it
+# is used up, lookups give 'unknown' or no-answer results instead of
+# waiting. None means no limit. We count how many lookups of each sort
+# ran out of time.
+lookupbudget = None
+lookuptimeouts = {}
+def setlookupbudget(secs):
+	global lookupbudget
+	lookupbudget = secs
+def timedout(kind):
+	lookuptimeouts[kind] = lookuptimeouts.get(kind, 0) + 1
+def timeoutstats():
+	l = lookuptimeouts.items()
+	l.sort()
+	return l
+
+# If we have a host map (see hostmap), connections from IP addresses
+# in it get their hostname and hostname status from it and never look
+# them up in the DNS.
+hmap = None
+def sethostmap(hm):
+	global hmap
+	hmap = hm
+
+# All of our shared lookup caches (but not the IP times information,
+# which is not a cache as such), by name.
+caches = (('answerson', anscache), ('identd negative', idnegcache),
+	  ('hostname', namecache), ('dns', dnscache))
+def flushcaches():
+	for name, c in caches:
+		c.clear()
+def expirecaches():
+	for name, c in caches:
+		c.expire()
+def cachesizes():
+	return [(name, len(c)) for name, c in caches]
+
+# The shared lookup caches can be saved and loaded, so that a restart
+# doesn't start with them all empty and give the DNS a burst of
+# queries. A snapshot is a marshalled dictionary of cache name to
+# that cache's snapshot, plus a version number. Entries carry their
+# absolute expiry times, so the ones that have expired while we were
+# down are dropped when the snapshot is loaded.
+CACHEVERSION = 2
+# Both of these return how many entries were saved or loaded.
+def savecaches(fname):
+	snap = {}
+	n = 0
+	for name, c in caches:
+		snap[name] = c.snapshot()
+		n += len(snap[name])
+	util.atomicwrite(fname, [marshal.dumps({'version': CACHEVERSION,
+						'caches': snap})])
+	return n
+# We raise ValueError if the file is not a good snapshot.
+def loadcaches(fname):
+	fp = open(fname, "rb")
+	try:
+		data = fp.read()
+	finally:
+		fp.close()
+	try:
+		snap = marshal.loads(data)
+		if snap['version'] != CACHEVERSION:
+			raise ValueError, "unknown snapshot version"
+		n = 0
+		for name, c in caches:
+			n += c.restore(snap['caches'].get(name, ()))
+	except (EOFError, TypeError, KeyError, AttributeError):
+		raise ValueError, "not a usable cache snapshot"
+	return n
 
 # Keep track of the first and last times we have seen a connection from
-# a given IP address. We try fairly hard to do the efficient thing.
+# a given IP address. We try fairly hard to do the efficient thing,
+# because during a scan we may be tracking millions of IP addresses.
 # For thread safety, we keep all information for an IP address together
 # and update it as a unit; this avoids exceptions if it is expired
 # halfway through a check. We don't lock, so checks are allowed to stomp
 # over each other and get slightly inconsistent data (eg, two people
 # thinking that a connection is new; two people updating the last connected
 # time).
+#
+# To save memory, the information for an IP address is packed into a
+# single integer, first time << 32 | last time, instead of a tuple.
+#
+# Expiry works from a time-ordered queue instead of scanning everything:
+# the IP addresses last seen in each minute are appended to that
+# minute's bucket (an array of 32-bit ints) when they are first seen
+# in it. .expire() works through the buckets oldest first, dropping the
+# entries whose last time is too old and skipping the ones that were
+# seen again later (they are in a later bucket too). It can be told to
+# stop after looking at so many entries and pick up where it left off
+# next time, so that a big expiry doesn't stall the main loop. Entries
+# can live up to a bucket's worth of time past their expiry.
+#
+# There can also be a cap on the number of entries. When we are over it,
+# .expire() sheds the least recently seen entries (to within a bucket)
+# until we are not.
+IPTBUCKET = 60
 class IPTimeCache:
 	def __init__(self):
 		self.clear()
 		self.setexpire(None)
+		self.setmax(None)
 	def clear(self):
 		self.tinf = {}
+		self.queue = {}
+		self.pos = 0
 	def setexpire(self, val):
 		self.explen = val
+	def setmax(self, val):
+		self.maxents = val
+	def full(self):
+		return self.maxents and len(self.tinf) > self.maxents
+	def _enqueue(self, ipk, now):
+		b = now // IPTBUCKET
+		try:
+			q = self.queue[b]
+		except KeyError:
+			q = self.queue.setdefault(b, array.array('i'))
+		q.append(ipk)
 	# expire relies on the fact that it is never performed in multiple
-	# threads. We also explicitly pull .keys() so that the list is
-	# stable in the face of other threads adding entries.
-	def expire(self):
-		if not self.explen:
-			return None
-		exptime = time.time() - self.explen
-		for k in self.tinf.keys():
-			if self.tinf[k][1] < exptime:
-				del self.tinf[k]
+	# threads. Other threads only ever append to the current bucket,
+	# which we never touch. Returns true if there is more to do.
+	def expire(self, limit = None):
+		now = int(time.time())
+		if self.explen:
+			exptime = now - self.explen
+		else:
+			exptime = None
+		cur = now // IPTBUCKET
+		while self.queue:
+			b = min(self.queue)
+			over = self.full()
+			if b >= cur or not (over or \
+			   (exptime is not None and (b+1)*IPTBUCKET <= exptime)):
+				return False
+			q = self.queue[b]
+			while self.pos < len(q):
+				if limit is not None:
+					if limit <= 0:
+						return True
+					limit -= 1
+				ipk = q[self.pos]
+				self.pos += 1
+				try:
+					lt = self.tinf[ipk] & 0xffffffff
+				except KeyError:
+					continue
+				if lt // IPTBUCKET == b or \
+				   (exptime is not None and lt < exptime):
+					try:
+						del self.tinf[ipk]
+					except KeyError:
+						pass
+				if over and not self.full():
+					break
+			if self.pos >= len(q):
+				del self.queue[b]
+				self.pos = 0
+		return False
 	def firstlast(self, ipk, now):
 		# First connection?
 		# A try/except pair is the only thread safe way of doing
 		# this, as we may be checking for an entry while .expire()
 		# is removing it underneath us.
 		try:
-			ft, lt = self.tinf[ipk]
+			v = self.tinf[ipk]
 		except KeyError:
 			# Initialize to now.
-			self.tinf[ipk] = (now, now)
+			self.tinf[ipk] = (now << 32) | now
+			self._enqueue(ipk, now)
 			return (0, None)
+		ft = v >> 32
+		lt = v & 0xffffffff
 		# We replace the information instead of editing it in place
 		# for thread safety; a .expire could have deleted it between
 		# our retrieval and our update.
-		self.tinf[ipk] = (ft, now)
+		self.tinf[ipk] = (ft << 32) | now
+		if lt // IPTBUCKET != now // IPTBUCKET:
+			self._enqueue(ipk, now)
 		return (now - ft, now - lt)
 	def __len__(self):
 		return len(self.tinf)
 
+	# Snapshots of the IP times let them survive restarts. A snapshot
+	# is a header, the IP keys as an array of 32-bit ints, their
+	# packed times as an array of native longs, and then each queue
+	# bucket as its number and length followed by its array. Everything
+	# is in native byte order; a snapshot made on a different sort of
+	# machine (or with a different bucket size) is refused.
+	# Snapshots can be made from any thread; copying the dictionary
+	# and each bucket's array is atomic.
+	def snapshot(self):
+		d = self.tinf.copy()
+		keys = array.array('i', d.keys())
+		vals = array.array('l', d.values())
+		chunks = [struct.pack(IPTHDR, IPTMAGIC, IPTMARK, vals.itemsize,
+				      IPTBUCKET, len(keys), len(self.queue)),
+			  keys.tostring(), vals.tostring()]
+		for b, q in self.queue.items():
+			q = q.tostring()
+			chunks.append(struct.pack(IPTBHDR, b, len(q) // 4))
+			chunks.append(q)
+		return chunks
+	# buf is anything that can be sliced to get strings, such as an
+	# mmap object. We raise ValueError if it is not a good snapshot.
+	def restore(self, buf):
+		hl = struct.calcsize(IPTHDR)
+		try:
+			mg, mk, vs, bs, n, nb = struct.unpack(IPTHDR, buf[:hl])
+		except struct.error:
+			raise ValueError, "truncated header"
+		if mg != IPTMAGIC or mk != IPTMARK or bs != IPTBUCKET or \
+		   vs != array.array('l').itemsize:
+			raise ValueError, "not a usable IP times snapshot"
+		keys = array.array('i')
+		vals = array.array('l')
+		pos = hl + n * 4
+		keys.fromstring(buf[hl:pos])
+		vals.fromstring(buf[pos:pos + n * vs])
+		if len(keys) != n or len(vals) != n:
+			raise ValueError, "truncated IP times"
+		pos = pos + n * vs
+		bhl = struct.calcsize(IPTBHDR)
+		queue = {}
+		for i in xrange(nb):
+			try:
+				b, qn = struct.unpack(IPTBHDR, buf[pos:pos+bhl])
+			except struct.error:
+				raise ValueError, "truncated queue"
+			q = array.array('i')
+			q.fromstring(buf[pos+bhl:pos+bhl+qn*4])
+			if len(q) != qn:
+				raise ValueError, "truncated queue"
+			queue[b] = q
+			pos = pos + bhl + qn * 4
+		self.tinf = dict(itertools.izip(keys, vals))
+		self.queue = queue
+		self.pos = 0
+		return n
+IPTMAGIC = "PNIT"
+IPTMARK = 0x01020304
+IPTHDR = "=4sIIIII"
+IPTBHDR = "=iI"
+
 iptcache = IPTimeCache()
 
 def cleariptimes():
 	iptcache.clear()
 def setiptimesdur(secs):
 	iptcache.setexpire(secs)
-def expireiptimes():
-	iptcache.expire()
+def setiptimesmax(n):
+	iptcache.setmax(n)
+def iptimesfull():
+	return iptcache.full()
+def expireiptimes(limit = None):
+	return iptcache.expire(limit)
 def iptimessize():
 	return len(iptcache)
+# Both of these return how many entries were saved or loaded.
+def saveiptimes(fname):
+	chunks = iptcache.snapshot()
+	util.atomicwrite(fname, chunks)
+	return struct.unpack(IPTHDR, chunks[0])[4]
+def loadiptimes(fname):
+	fp = open(fname, "rb")
+	try:
+		if os.fstat(fp.fileno()).st_size == 0:
+			raise ValueError, "empty file"
+		m = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			return iptcache.restore(m)
+		finally:
+			m.close()
+	finally:
+		fp.close()
+
+# The hostnames in forwhn: rules are fixed, so looking them up again
+# for every connection is pure waste. Instead they are resolved when
+# the rules file is loaded and the answers are kept in a shared cache,
+# which a background thread refreshes every so often. Connections then
+# only do a set membership test.
+#
+# Names are registered with the cache as the rules are parsed, and
+# the cache ages along with the matchers' memoizations: .age() makes
+# the names registered in the generation just loaded the live set and
+# drops everything else, while .discard() throws away a generation that
+# failed to load. Entries are (frozenset-of-IPs, lookup-time) tuples
+# and are always replaced as a unit, so readers in other threads never
+# see a half-updated entry.
+#
+# The standard resolver interface doesn't give us record TTLs, so we
+# refresh on a fixed schedule instead.
+def _forwlookup(host):
+	return frozenset(socket.gethostbyname_ex(host)[2])
+class ForwardCache:
+	def __init__(self):
+		self.live = {}
+		self.discard()
+		self.setrefresh(FORWREFRESH)
+	def discard(self):
+		self.pending = {}
+	def age(self):
+		self.live = self.pending
+		self.pending = {}
+	def setrefresh(self, secs):
+		self.refresh = secs
+	def _resolve(self, host):
+		try:
+			ips = _forwlookup(host)
+		except socket.error:
+			ips = frozenset()
+		return (ips, time.time())
+	def register(self, host):
+		if host in self.pending:
+			return
+		if host in self.live:
+			self.pending[host] = self.live[host]
+		else:
+			self.pending[host] = self._resolve(host)
+	def lookup(self, host):
+		try:
+			return self.live[host][0]
+		except KeyError:
+			pass
+		try:
+			return self.pending[host][0]
+		except KeyError:
+			return None
+	# This is called from the refresh thread. We pull .items() for
+	# stability against the main thread aging the cache underneath
+	# us. A lookup failure keeps the old answer, on the grounds that
+	# a transient resolver problem shouldn't make forwhn: rules stop
+	# matching.
+	def refreshall(self):
+		lv = self.live
+		now = time.time()
+		for host, ent in lv.items():
+			if now - ent[1] < self.refresh:
+				continue
+			try:
+				lv[host] = (_forwlookup(host), time.time())
+			except socket.error:
+				lv[host] = (ent[0], time.time())
+	def __len__(self):
+		return len(self.live)
+
+forwcache = ForwardCache()
+
+def setforwrefresh(secs):
+	forwcache.setrefresh(secs)
+def forwcachesize():
+	return len(forwcache)
+# Start the background thread that keeps the forwhn: cache fresh.
+# It wakes up at the refresh interval and redoes everything that has
+# gotten stale since the last time.
+def _forwrefresher():
+	while 1:
+		time.sleep(max(forwcache.refresh, 1))
+		forwcache.refreshall()
+def startforwrefresh():
+	thread.start_new_thread(_forwrefresher, ())
+
+# Connections carry their IP addresses as (unsigned 32-bit) integers
+# as well as strings; the strings are for logging and the like, and
+# everything that matches or keys on IP addresses uses the integers.
+# We convert with inet_aton() instead of picking the string apart
+# ourselves, since we know we have a proper IP address.
+def iptoint(ip):
+	return struct.unpack("!I", socket.inet_aton(ip))[0]
 
-# This returns a 32-bit int version of a string IP address.
-# We cannot use netblock.strtoip() directly, because it returns longs.
-def ipto32int(ip):
-	r = netblock.strtoip(ip)
-	if r < 0x80000000L:
-		return int(r)
-	else:
-		return int(r-0x100000000L)
 # To reduce storage space, we store the IP address and the time as Python
-# integers, instead of their natural string and float natures. We have to
-# go to some effort (see above) to get the IP address as a true int, not
-# a long.
-def getiptimes(ip):
+# integers, instead of their natural string and float natures. IP times
+# are keyed by the IP address as a signed 32-bit integer, so that the
+# keys fit in an array('i') (see IPTimeCache).
+def getiptimes(ipn):
 	# Integer time will only overflow to long in 2038. Long is
 	# acceptable to us.
 	now = int(time.time())
-	ikey = ipto32int(ip)
-	return iptcache.firstlast(ikey, now)
+	if ipn >= 0x80000000:
+		ipn -= 0x100000000
+	return iptcache.firstlast(ipn, now)
+
+# Each connection gets a unique connection ID, so that log messages
+# about it made at different times can be matched up.
+connids = itertools.count(1)
 
-class HostInfo:
+# There is one HostInfo per connection, so it is kept compact.
+class HostInfo(object):
+	__slots__ = "_rip", "_rport", "_ripn", "_revip", "_lip", "_lport", \
+		    "_lipn", "_hnstate", "_rhn", "_rhnl", "_chn", "_chnl", \
+		    "classes", "_id", "_idinit", "_idq", "_tinit", \
+		    "_ftime", "_ltime", "_anscache", "_lupcache", "_pend", \
+		    "_deadline", "_info", "_connid", "_memo", "_transient", \
+		    "_expired", "_until"
 	def __init__(self, loc, rem):
 		self._rip, self._rport = rem
-		self._ripn = None; self._revip = None
+		self._ripn = iptoint(self._rip); self._revip = None
 		self._lip, self._lport = loc
-		self._lipn = None
+		self._lipn = iptoint(self._lip)
 		self._hnstate = None
 		self._rhn = None; self._rhnl = None
 		self._chn = None; self._chnl = None
 		self.classes = []
 		self._id = None
 		self._idinit = None
+		self._idq = None
 		self._tinit = None
 		self._ftime = None
 		self._ltime = None
 		self._anscache = {}; self._lupcache = {}
-	def _fillhn(self):
-		if self._hnstate != None:
-			return
-		self._hnstate, self._chn = getipname(self._rip)
+		# Lookups started by prefetch() that nothing has used yet.
+		self._pend = {}
+		self._deadline = None
+		self._info = None
+		self._connid = connids.next()
+		self._memo = {}
+		self._transient = False
+		self._expired = set()
+		self._until = None
+
+	# Matchers remember results for this connection here, so that
+	# a check that several rules make is only done once.
+	def memoized(self, key, func, *args):
+		try:
+			return self._memo[key]
+		except KeyError:
+			r = self._memo[key] = func(*args)
+			return r
+
+	# Lookups are limited by our budget, if we have one; see
+	# setlookupbudget().
+	def setbudget(self, secs):
+		if secs is None:
+			self._deadline = None
+		else:
+			self._deadline = time.time() + secs
+	# How much of our budget is left, or None if we have none.
+	def _left(self):
+		if self._deadline is None:
+			return None
+		return max(self._deadline - time.time(), 0)
+	# Whether any answer we got from a lookup may not hold for the
+	# next connection from the same IP address, because the lookup
+	# gave up early or because the answer is not in the shared
+	# caches.
+	def transient(self):
+		return self._transient
+	# If not, when the first of the shared cache entries that our
+	# answers came from expires (or None if they came from none).
+	def validuntil(self):
+		return self._until
+	# Each lookup that runs out of budget is only counted once, however
+	# many times it is asked for afterward. Returns true the first time.
+	def _timedout(self, kind, key = None):
+		self._transient = True
+		if key is None:
+			key = kind
+		if key in self._expired:
+			return False
+		self._expired.add(key)
+		timedout(kind)
+		return True
+	def _fromcache(self, cache, key):
+		val, et = cache.getent(key)
+		if self._until is None or et < self._until:
+			self._until = et
+		return val
+	def _checkcached(self, cache, key):
+		try:
+			self._fromcache(cache, key)
+		except KeyError:
+			self._transient = True
+
+	# Get the answer to a kind of DNS lookup, using the prefetched
+	# lookup for key if there is one or the answer in cache if it has
+	# one, within our budget. If our budget runs out or the DNS
+	# breaker is tripped, the answer is default. Returns the answer
+	# and whether it is a real one; a default from running out of
+	# budget only holds for rules evaluation, so the caller must not
+	# keep it, and a lookup still running is kept for whoever asks
+	# next.
+	def _budgeted(self, kind, key, default, cache, func, *args):
+		l = self._pend.pop(key, None)
+		if l is not None and l.refused:
+			l = None
+		left = self._left()
+		if l is None:
+			try:
+				return (self._fromcache(cache, args[0]), True)
+			except KeyError:
+				pass
+			if breaker.tripped:
+				breaker.skip()
+				self._transient = True
+				return (default, True)
+			if left is None:
+				r = singleflight(func, *args)
+				self._checkcached(cache, args[0])
+				return (r, True)
+			if left == 0:
+				self._timedout(kind, key)
+				return (default, False)
+			l = Lookup(default, singleflight, func, *args)
+		r = l.get(left)
+		if not l.finished():
+			if not l.refused:
+				self._pend[key] = l
+			if self._timedout(kind, key):
+				breaker.note(True, kind, args[0])
+			return (default, False)
+		self._checkcached(cache, args[0])
+		return (r, True)
+
+	# Fill in our hostname information from the host map, if it
+	# knows about us. Returns true if it did.
+	def _maphn(self):
+		if hmap is None:
+			return False
+		r = hmap.lookup(self._ripn)
+		if r is None:
+			return False
+		self._sethn(r)
+		return True
+	def _sethn(self, r):
+		self._hnstate, self._chn = r
+		self._info = None
 		if self._chn:
 			self._chnl = self._chn.lower()
 		if self._hnstate == 'good':
 			self._rhn = self._chn
 			self._rhnl = self._chnl
+	# Returns false if we ran out of budget, in which case we are
+	# 'unknown' for now but will look again if asked without a budget.
+	def _fillhn(self):
+		if self._hnstate != None or self._maphn():
+			return True
+		r, ok = self._budgeted('hostname', 'hostname',
+				       ('unknown', None), namecache,
+				       cachedipname, self._rip)
+		if ok:
+			self._sethn(r)
+		return ok
+	# Similarly, running out of budget leaves us with no identd
+	# answer for now, and a query still in progress is kept.
 	def _fillid(self):
 		if self._idinit:
 			return
+		left = self._left()
+		if self._idq:
+			q = self._idq
+			if left is not None and not q.ready(left):
+				self._timedout('identd')
+				return
+			self._idq = None
+			self._id = finishident(self._rip, q)
+		elif left is None or left >= IDENTDTIMEOUT:
+			self._id = getident(self._rip, self._rport,
+					    self._lip, self._lport)
+		elif left == 0:
+			self._timedout('identd')
+			return
+		else:
+			r = getident(self._rip, self._rport,
+				     self._lip, self._lport, left)
+			# No answer only means we ran out of time if we
+			# actually did.
+			if r is None and self._left() == 0:
+				self._timedout('identd')
+				return
+			self._id = r
 		self._idinit = 1
-		self._id = idclient.ident(self._rip, self._rport,
-					  self._lip, self._lport,
-					  IDENTDTIMEOUT)
+		self._info = None
+	# Start our identd query in the background, if we can.
+	def startident(self):
+		if self._idinit or self._idq or identengine is None:
+			return
+		if identskip(self._rip):
+			self._idinit = 1
+			return
+		self._idq = startident(self._rip, self._rport,
+				       self._lip, self._lport)
 	def _filltime(self):
 		if self._tinit:
 			return
 		self._tinit = 1
-		self._ftime, self._ltime = getiptimes(self._rip)
+		self._ftime, self._ltime = getiptimes(self._ripn)
+		self._info = None
 	def settimes(self, f, l):
 		self._ftime = f
 		self._ltime = l
 		self._tinit = 1
+		self._info = None
 
 	def getip(self):
 		return self._rip
 	def getipn(self):
-		if self._ripn is None:
-			self._ripn = netblock.strtoip(self._rip)
 		return self._ripn
 	# .split() is remarkably expensive, so it's worth caching the IP
 	# address as reversed for DNS blocklist checking. And hey, we have
@@ -240,28 +1169,34 @@ class HostInfo:
 	def getlip(self):
 		return self._lip
 	def getlipn(self):
-		if self._lipn is None:
-			self._lipn = netblock.strtoip(self._lip)
 		return self._lipn
 	def getport(self):
 		return str(self._rport)
 	def getlport(self):
 		return str(self._lport)
+	def getlportn(self):
+		return self._lport
+
+	def getconnid(self):
+		return self._connid
+	# Do we know our hostname information yet?
+	def hnknown(self):
+		return self._hnstate is not None
 
 	def gethostname(self):
-		if not self._hnstate: self._fillhn()
+		if not self._hnstate and not self._fillhn(): return None
 		return self._rhn
 	def getclaimedhn(self):
-		if not self._hnstate: self._fillhn()
+		if not self._hnstate and not self._fillhn(): return None
 		return self._chn
 	def gethnstate(self):
-		if not self._hnstate: self._fillhn()
+		if not self._hnstate and not self._fillhn(): return 'unknown'
 		return self._hnstate
 	def gethostname_l(self):
-		if not self._hnstate: self._fillhn()
+		if not self._hnstate and not self._fillhn(): return None
 		return self._rhnl
 	def getclaimedhn_l(self):
-		if not self._hnstate: self._fillhn()
+		if not self._hnstate and not self._fillhn(): return None
 		return self._chnl
 
 	# Class membership is annotated on the host info object because
@@ -279,6 +1214,9 @@ class HostInfo:
 		self._fillid()
 		return self._id
 
+	def dnsdegraded(self):
+		return dnsdegraded()
+
 	def getfirsttime(self):
 		self._filltime()
 		return self._ftime
@@ -287,22 +1225,144 @@ class HostInfo:
 		return self._ltime
 
 	# We do this here on the grounds that all connection stuff should
-	# go through us.
-	def answerson(self, port):
+	# go through us. We look in our own cache, then in the shared
+	# cache, and only then probe; several ports are probed at once.
+	def _ansknown(self, port):
 		if port not in self._anscache:
-			self._anscache[port] = canconnectto(self._rip, port)
+			try:
+				self._anscache[port] = self._fromcache(anscache, (self._rip, port))
+			except KeyError:
+				return None
 		return self._anscache[port]
+	# If share is false, only positive answers go in the shared cache.
+	def _setans(self, res, share = True):
+		for port, r in res.items():
+			self._anscache[port] = r
+			if r or share:
+				anscache.put((self._rip, port), r)
+			self._checkcached(anscache, (self._rip, port))
+	def _needans(self, ports):
+		need = []
+		for port in ports:
+			r = self._ansknown(port)
+			if r:
+				return None
+			elif r is None:
+				need.append(port)
+		return tuple(need)
+	def answerson(self, port):
+		return self.answersonany((port,))
+	# Probes cut short by our budget only tell us about ports that
+	# answered, so the other ports are no-answer for this connection
+	# alone. Probes are shared with other connections from the same
+	# place (see timedflight()), including ones with less time than
+	# us; if such a probe found nothing, we must probe again for our
+	# full time.
+	def _probe(self, need, timeout):
+		r = timedflight(timeout, canconnectmany, self._rip, need)
+		if r and r[1] < timeout and True not in r[0].values():
+			left = self._left()
+			if left is None or left > timeout:
+				left = timeout
+			if left > 0:
+				r = (canconnectmany(self._rip, need, left), left)
+		return self._takeans(r)
+	def _takeans(self, r):
+		if r is None:
+			return {}
+		res, timeout = r
+		self._setans(res, timeout >= CONNTIMEOUT)
+		return res
+	def answersonany(self, ports):
+		need = self._needans(ports)
+		left = self._left()
+		# A prefetched probe may already be answering our question.
+		if need and 'answerson' in self._pend:
+			l = self._pend.pop('answerson')
+			r = l.get(left)
+			if not l.finished():
+				if not l.refused:
+					self._pend['answerson'] = l
+				self._timedout('answerson')
+			self._takeans(r)
+			need = self._needans(ports)
+			left = self._left()
+		if need is None:
+			return True
+		if not need:
+			return False
+		if left is None or left >= CONNTIMEOUT:
+			res = self._probe(need, CONNTIMEOUT)
+		elif left == 0:
+			self._timedout('answerson')
+			return False
+		else:
+			res = self._probe(need, left)
+		if True in res.values():
+			return True
+		if left is not None and left < CONNTIMEOUT:
+			self._timedout('answerson')
+		return False
 	# Ditto IP address lookups.
 	# This is more dodgy, but a HostInfo struct is our per-connection
 	# data object.
 	def gethostips(self, host):
-		if host not in self._lupcache:
-			try:
-				ips = socket.gethostbyname_ex(host)[2]
-			except socket.error:
-				ips = []
-			self._lupcache[host] = ips
-		return self._lupcache[host]
+		try:
+			return self._lupcache[host]
+		except KeyError:
+			pass
+		r, ok = self._budgeted('dnsbl', host, [], dnscache,
+				       cachedhostips, host)
+		if ok:
+			self._lupcache[host] = r
+		return r
+
+	# Start all of the lookups in plan (a list of facets in the order
+	# to start them; see matchers and rules) running at once, if we
+	# are prefetching. The lookup functions pick up the answers when
+	# they are actually wanted.
+	# IP times are not 'looked up'; they are bookkeeping that is
+	# only done for connections that are checked against them, so we
+	# leave them alone.
+	def prefetch(self, plan):
+		if not prefetching:
+			return
+		ports = []
+		for kind, arg in plan:
+			if kind == 'identd':
+				self.startident()
+			elif kind in ('hostname', 'dnsbl') and breaker.tripped:
+				pass
+			elif kind == 'hostname':
+				if self._hnstate is None and \
+				   'hostname' not in self._pend and \
+				   not self._maphn():
+					try:
+						self._sethn(self._fromcache(namecache, self._rip))
+					except KeyError:
+						self._pend['hostname'] = Lookup(('unknown', None), singleflight, cachedipname, self._rip)
+			elif kind == 'dnsbl':
+				host = self.getrevip() + arg
+				if host not in self._lupcache and \
+				   host not in self._pend:
+					try:
+						self._lupcache[host] = self._fromcache(dnscache, host)
+					except KeyError:
+						self._pend[host] = Lookup([], singleflight, cachedhostips, host)
+			elif kind == 'answerson':
+				ports.append(arg)
+		if ports and 'answerson' not in self._pend:
+			need = self._needans(ports)
+			if need:
+				self._pend['answerson'] = Lookup(None, timedflight, CONNTIMEOUT, canconnectmany, self._rip, need)
+	# The IP addresses of a forwhn: hostname, as a set. These normally
+	# come from the shared cache; we only look them up ourselves if
+	# the name was somehow never registered.
+	def getforwips(self, host):
+		r = forwcache.lookup(host)
+		if r is None:
+			r = frozenset(self.gethostips(host))
+		return r
 
 	# Information formatting.
 	def pretty(self, iponly = 0):
@@ -314,30 +1374,85 @@ class HostInfo:
 			return pref + self._rhn
 		else:
 			return pref + self._rip
-	# Return an info dictionary based on what we know.
+	# Return an info mapping based on what we know. This is an
+	# InfoView, which is only built once (until we learn more) and
+	# only works out the values that are actually asked for.
 	def getinfo(self):
-		d = {}
-		d['ip'] = self._rip
-		d['remport'] = self._rport
-		d['localip'] = self._lip
-		d['port'] = self._lport
-		if self._hnstate != None:
-			d['hnstatus'] = self._hnstate
-		if self._chn != None:
-			d['claimedhn'] = self._chn
-		if self._rhn == None:
-			d['hostname'] = self._rip
-		else:
-			d['hostname'] = self._rhn
-		if self._id:
-			d['identd'] = self._id
-		if self._ftime != None:
-			d['seensince'] = self._ftime
-		if self._ltime != None:
-			d['lastseen'] = self._ltime
-		d['connsum'] = self.pretty()
-		d['connipsum'] = self.pretty(1)
-		return d
+		if self._info is None:
+			self._info = InfoView(self)
+		return self._info
+
+# The information in a HostInfo, as a read-only mapping suitable for
+# '%' formatting. Keys whose information we don't know are missing,
+# and raise KeyError. Values are worked out when first asked for.
+def _infohnstatus(hi):
+	if hi._hnstate is None:
+		raise KeyError, 'hnstatus'
+	return hi._hnstate
+def _infoclaimedhn(hi):
+	if hi._chn is None:
+		raise KeyError, 'claimedhn'
+	return hi._chn
+def _infohostname(hi):
+	if hi._rhn is None:
+		return hi._rip
+	return hi._rhn
+def _infoidentd(hi):
+	if not hi._id:
+		raise KeyError, 'identd'
+	return hi._id
+def _infoseensince(hi):
+	if hi._ftime is None:
+		raise KeyError, 'seensince'
+	return hi._ftime
+def _infolastseen(hi):
+	if hi._ltime is None:
+		raise KeyError, 'lastseen'
+	return hi._ltime
+infofuncs = {
+	'connid': lambda hi: hi._connid,
+	'ip': lambda hi: hi._rip,
+	'remport': lambda hi: hi._rport,
+	'localip': lambda hi: hi._lip,
+	'port': lambda hi: hi._lport,
+	'hnstatus': _infohnstatus,
+	'claimedhn': _infoclaimedhn,
+	'hostname': _infohostname,
+	'identd': _infoidentd,
+	'seensince': _infoseensince,
+	'lastseen': _infolastseen,
+	'connsum': lambda hi: hi.pretty(),
+	'connipsum': lambda hi: hi.pretty(1),
+	}
+class InfoView(object):
+	__slots__ = "hi", "d"
+	def __init__(self, hi):
+		self.hi = hi
+		self.d = {}
+	def __getitem__(self, key):
+		try:
+			return self.d[key]
+		except KeyError:
+			pass
+		v = infofuncs[key](self.hi)
+		self.d[key] = v
+		return v
+	def __contains__(self, key):
+		try:
+			self[key]
+		except KeyError:
+			return False
+		return True
+	has_key = __contains__
+	def get(self, key, default = None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+	def keys(self):
+		return [k for k in infofuncs.keys() if k in self]
+	def items(self):
+		return [(k, self[k]) for k in self.keys()]
 
 def frompairs(loc, rem):
 	return HostInfo(loc, rem)
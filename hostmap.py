@@ -0,0 +1,96 @@
+#
+# Our loader of host map files.
+#
+# A host map gives the hostname and hostname status for IP addresses
+# and CIDR netblocks that we already know about, so that connections
+# from them never have to wait on reverse DNS lookups. Host map files
+# are (rfc822-style continued) lines of the form
+#	IP-OR-CIDR	HOSTNAME	[STATUS]
+# STATUS is one of the hostname states that hinfo uses (good,
+# noforward, addrmismatch, unknown) and defaults to 'good'. With
+# 'unknown', the hostname must be given as '-'.
+#
+# When an IP address is in several netblocks, the most specific one
+# (the one with the longest prefix) wins. If the same netblock is given
+# twice, the last entry wins.
+
+import readcf
+import netblock
+import util
+
+class BadInput(Exception):
+	pass
+
+hnstates = ('good', 'noforward', 'addrmismatch', 'unknown')
+
+# Entries are stored in a dictionary per prefix length, keyed by the
+# network number, so that a lookup is one dictionary probe for each
+# prefix length that the map actually uses, longest first.
+class HostMap:
+	def __init__(self):
+		self.nets = {}
+		self.lens = []
+	def addentry(self, ent):
+		(net, plen), res = ent
+		if plen not in self.nets:
+			self.nets[plen] = {}
+			self.lens.append(plen)
+			self.lens.sort()
+			self.lens.reverse()
+		self.nets[plen][net] = res
+	# ipn is an IP address in numeric form. We return the
+	# (hnstatus, hostname) tuple for it, or None.
+	def lookup(self, ipn):
+		for plen in self.lens:
+			try:
+				return self.nets[plen][ipn & masks[plen]]
+			except KeyError:
+				pass
+		return None
+	def __len__(self):
+		return sum([len(x) for x in self.nets.values()])
+masks = [int(netblock.lenmask(x)) for x in range(0, 33)]
+
+def getnet(s):
+	try:
+		if '/' in s:
+			low = netblock.convcidr(s)[0]
+			plen = int(s[s.find('/')+1:])
+		else:
+			if not util.isipaddr(s):
+				raise BadInput, "bad IP address: "+s
+			low = netblock.strtoip(s)
+			plen = 32
+	except netblock.NBError, e:
+		raise BadInput, str(e)
+	return (int(low), plen)
+
+def parseline(line, lineno):
+	__pychecker__ = 'no-argsused'
+	n = line.split()
+	if len(n) not in (2, 3):
+		raise BadInput, "badly formatted line"
+	if len(n) == 3:
+		st = n[2]
+		if st not in hnstates:
+			raise BadInput, "unknown hostname status "+st
+	else:
+		st = 'good'
+	hn = n[1]
+	if (st == 'unknown') != (hn == '-'):
+		raise BadInput, "hostname must be '-' exactly when the status is unknown"
+	if hn == '-':
+		hn = None
+	return (getnet(n[0]), (st, hn))
+
+def fromfile(fp, fname):
+	hm = HostMap()
+	readcf.readcf(fp, fname, parseline, hm.addentry, BadInput)
+	return hm
+
+def parsefile(fname):
+	try:
+		fp = open(fname, "r")
+	except EnvironmentError, e:
+		raise BadInput, "cannot open %s: %s" % (fname, str(e))
+	return fromfile(fp, fname)
@@ -7,7 +7,8 @@
 #
 # Returned (in general): either the identd return or 'None'.
 
-import string, socket, select, errno, time
+import string, socket, select, errno, time, os, fcntl, sys
+import thread, threading
 
 # some constants:
 MAXSIZE = 1024		# no sane identd return will ever be over this size
@@ -17,6 +18,11 @@ IDENTD = 113		# identd/auth/etc TCP port
 # errors that should cause us to just return None.
 class TrapErr(Exception):
 	pass
+# This is thrown by queryident() when we could not talk to the remote
+# identd at all, because the connection was refused or timed out. This
+# is different from an identd that answers without a user ID.
+class NoIdentd(Exception):
+	pass
 
 class SafeSock:
 	"""A wrapper class for sockets that times out operations.
@@ -98,6 +104,14 @@ class SafeSock:
 	# this is not trapped specifically; it cannot time out.
 	def bind(self, addr):
 		return self._s.bind(addr)
+	# After a connect() finishes, this is the error (if any) that it
+	# finished with.
+	def connerror(self):
+		try:
+			return self._s.getsockopt(socket.SOL_SOCKET,
+						  socket.SO_ERROR)
+		except socket.error:
+			raise self._e
 
 
 # The user-serviceable parts. (sort of. Ignore _ident.)
@@ -111,7 +125,13 @@ def _ident(s, rh, rp, lh, lp):
 		# case of multihomed hosts; otherwise the remote identd
 		# will either give us errors or the wrong answer.
 		s.bind((lh, 0))
-		s.connect((rh, IDENTD))
+		# Failure to connect is reported specially.
+		try:
+			s.connect((rh, IDENTD))
+			if s.connerror():
+				raise TrapErr
+		except TrapErr:
+			raise NoIdentd
 		s.send("%d, %d\r\n" % (rp, lp))
 		l = ""
 		while len(l) < MAXSIZE:
@@ -123,32 +143,47 @@ def _ident(s, rh, rp, lh, lp):
 			# we could insist on \r\n, but why?
 			if '\n' in l:
 				break
-		if not '\n' in l:
-			return None
-		# chomp off short in case of a multi-line return.
-		l = l[:string.find(l, '\n')]
-		fields = map(string.strip, string.split(l, ':'))
-		# does this look like a good identd return, with a user ID?
-		if len(fields) != 4:
-			return None
-		if fields[1] != 'USERID':
-			return None
-		return fields[3]
+		return parsereply(l)
 	except TrapErr:
 		return None
+
+# Turn what the remote identd sent us into a user ID, or None.
+def parsereply(l):
+	if not '\n' in l:
+		return None
+	# chomp off short in case of a multi-line return.
+	l = l[:string.find(l, '\n')]
+	fields = map(string.strip, string.split(l, ':'))
+	# does this look like a good identd return, with a user ID?
+	if len(fields) != 4:
+		return None
+	if fields[1] != 'USERID':
+		return None
+	return fields[3]
 	
-def ident(rh, rp, lh, lp, wait=None):
+def queryident(rh, rp, lh, lp, wait=None):
 	"""Perform the identd protocol and return the result.
 
-	Parameters: remote host, remote port, local host, and local port.
-	Optional wait timeout defaults to None."""
+	Like ident(), but raises NoIdentd if the remote identd could not
+	be reached at all."""
 
 	s = SafeSock(socket.socket(socket.AF_INET, socket.SOCK_STREAM), wait,
 		     TrapErr)
 	# use subroutine to centralize cleanup.
-	r = _ident(s, rh, rp, lh, lp)
-	s.close()
-	return r
+	try:
+		return _ident(s, rh, rp, lh, lp)
+	finally:
+		s.close()
+
+def ident(rh, rp, lh, lp, wait=None):
+	"""Perform the identd protocol and return the result.
+
+	Parameters: remote host, remote port, local host, and local port.
+	Optional wait timeout defaults to None."""
+	try:
+		return queryident(rh, rp, lh, lp, wait)
+	except NoIdentd:
+		return None
 
 def sockident(sock, wait=None):
 	"""Given a connected TCP socket, return identd information about it.
@@ -158,3 +193,173 @@ def sockident(sock, wait=None):
 	(rh, rp) = sock.getpeername()
 	(lh, lp) = sock.getsockname()
 	return ident(rh, rp, lh, lp, wait)
+
+
+# The identd engine runs many queries at once from a single thread,
+# with one select() loop over all of their sockets, instead of tying
+# up a thread in SafeSock for each one. Queries are submitted from any
+# thread and run to completion in the background; whoever wants the
+# answer calls .wait() on the query, which gives the user ID (or None)
+# or raises NoIdentd just like queryident().
+#
+# Each query moves through the states below. Its deadline covers the
+# whole exchange, like SafeSock's wait interval.
+CONNECTING, SENDING, READING = range(3)
+WAITSLACK = 1
+class Query:
+	def __init__(self, rh, rp, lh, lp, wait, port = IDENTD):
+		self.addr = (rh, port)
+		self.local = lh
+		self.out = "%d, %d\r\n" % (rp, lp)
+		self.buf = ''
+		self.deadline = time.time() + wait
+		self.sock = None
+		self.state = CONNECTING
+		self.result = None
+		self.noidentd = False
+		self.done = threading.Event()
+	def fileno(self):
+		return self.sock.fileno()
+	# Wait up to timeout seconds for the query to finish, and say
+	# whether it has.
+	def ready(self, timeout):
+		self.done.wait(timeout)
+		return self.done.isSet()
+	# If the engine has fallen behind (or died), we give up on it a
+	# little after our deadline rather than wait forever. That is our
+	# problem, not the identd's, so it isn't a NoIdentd.
+	def wait(self):
+		if not self.ready(max(self.deadline - time.time(), 0) + WAITSLACK):
+			self.finish()
+		if self.noidentd:
+			raise NoIdentd
+		return self.result
+	def finish(self, result = None, noidentd = False):
+		if self.done.isSet():
+			return
+		self.result = result
+		self.noidentd = noidentd
+		try:	self.sock.close()
+		except:	pass
+		self.done.set()
+	# Returns true if the query is still going.
+	def begin(self):
+		try:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.sock.setblocking(0)
+			# See _ident() for why we bind.
+			self.sock.bind((self.local, 0))
+			r = self.sock.connect_ex(self.addr)
+		except socket.error:
+			self.finish(noidentd = True)
+			return False
+		if r not in (0, errno.EAGAIN, errno.EINPROGRESS):
+			self.finish(noidentd = True)
+			return False
+		return True
+	# Do whatever we can now that our socket is ready.
+	def step(self):
+		try:
+			if self.state == CONNECTING:
+				if self.sock.getsockopt(socket.SOL_SOCKET,
+							socket.SO_ERROR):
+					self.finish(noidentd = True)
+					return False
+				self.state = SENDING
+			if self.state == SENDING:
+				n = self.sock.send(self.out)
+				self.out = self.out[n:]
+				if not self.out:
+					self.state = READING
+				return True
+			r = self.sock.recv(MAXSIZE)
+		except socket.error, e:
+			if e[0] in (errno.EAGAIN, errno.EINPROGRESS):
+				return True
+			self.finish(noidentd = (self.state == CONNECTING))
+			return False
+		self.buf += r
+		if not r or '\n' in self.buf or len(self.buf) >= MAXSIZE:
+			self.finish(parsereply(self.buf))
+			return False
+		return True
+	# Our time has run out.
+	def expire(self):
+		self.finish(noidentd = (self.state == CONNECTING))
+
+# If anything unexpected goes wrong in the engine (for instance, select()
+# failing because we have too many sockets), every query it has is
+# given up on with no answer (but not as if the identd could not be
+# reached, since we don't know that), the error is passed to onerror
+# (if we have one), and the engine carries on.
+class IdentEngine:
+	def __init__(self, onerror = None):
+		self.lock = thread.allocate_lock()
+		self.new = []
+		self.onerror = onerror
+		self.errors = 0
+		# Writing a byte to the pipe wakes the engine up to notice
+		# new queries. Our children have no business with it.
+		self.pipe = os.pipe()
+		for fd in self.pipe:
+			fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+	def start(self):
+		thread.start_new_thread(self.run, ())
+	def submit(self, rh, rp, lh, lp, wait, port = IDENTD):
+		q = Query(rh, rp, lh, lp, wait, port)
+		self.lock.acquire()
+		self.new.append(q)
+		self.lock.release()
+		os.write(self.pipe[1], "a")
+		return q
+	def _takenew(self):
+		self.lock.acquire()
+		nl = self.new
+		self.new = []
+		self.lock.release()
+		return nl
+	def run(self):
+		active = []
+		while 1:
+			try:
+				self.step(active)
+			except:
+				self.errors += 1
+				e = sys.exc_info()[1]
+				if self.onerror:
+					try:
+						self.onerror("identd engine error: %s: %s" % (e.__class__.__name__, str(e)))
+					except:
+						pass
+				for q in active + self._takenew():
+					q.finish()
+				del active[:]
+				# Don't spin if the error keeps happening.
+				time.sleep(0.1)
+	def step(self, active):
+		for q in self._takenew():
+			if q.begin():
+				active.append(q)
+		# Queries can be given up on by whoever is waiting for them.
+		now = time.time()
+		for q in [x for x in active if x.deadline <= now or x.done.isSet()]:
+			q.expire()
+			active.remove(q)
+		if active:
+			tmo = max(min([x.deadline for x in active]) - now, 0)
+		else:
+			tmo = None
+		r = [self.pipe[0]] + [x for x in active if x.state == READING]
+		w = [x for x in active if x.state != READING]
+		try:
+			r, w, e = select.select(r, w, [], tmo)
+		except select.error, e:
+			if e[0] != errno.EINTR:
+				raise
+			return
+		if self.pipe[0] in r:
+			os.read(self.pipe[0], 512)
+			r.remove(self.pipe[0])
+		for q in r + w:
+			if not q.step():
+				active.remove(q)
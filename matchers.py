@@ -9,10 +9,19 @@
 # Matchers may take a required argument, in which case their name (as
 # shown in MatchInfo.terminals; see rdparse) has a ':' at the end, or
 # they may take no arguments. The simplest no-argument matcher is 'ALL'.
+#
+# Matchers that need information that hinfo has to look up have a
+# .facets() method, which returns a tuple of (kind, argument) pairs
+# describing what they will ask for: ('hostname', None), ('identd',
+# None), ('iptimes', None), ('dnsbl', ZONE), ('forwhn', NAME), or
+# ('answerson', PORT). The rules code uses this to work out what
+# lookups a ruleset can trigger. Matchers without .facets() only use
+# information that is free.
 
-import re, string
+import re, string, sre_parse, sre_constants
 import netblock
 import util
+import hinfo
 
 # Utility bits
 unitytrans = string.maketrans('', '')
@@ -86,12 +95,16 @@ ipadmemo = IAdMemo()
 # errormemos() is called if there is an error during rules file load.
 # In both cases, they just apply the particular operation to each of
 # our memoization proxies.
+# The shared forwhn: lookup cache in hinfo follows the same generation
+# scheme, so it is aged and discarded here too.
 def agememos():
 	rememo.age()
 	ipadmemo.age()
+	hinfo.forwcache.age()
 def discardmemos():
 	rememo.discard()
 	ipadmemo.discard()
+	hinfo.forwcache.discard()
 
 # ALL: matches everything.
 class AllMatch:
@@ -99,6 +112,11 @@ class AllMatch:
 		__pychecker__ = "no-argsused"
 	def __str__(self):
 		return "ALL"
+	def sharekey(self):
+		return ()
+	def genexpr(self, c):
+		__pychecker__ = "no-argsused"
+		return "1"
 	def eval(self, hi):
 		__pychecker__ = "no-argsused"
 		return 1
@@ -115,6 +133,15 @@ class IdentdMatch:
 			return "identd: "+self.desid
 		else:
 			return "IDENTD"
+	def sharekey(self):
+		return self.desid
+	def facets(self):
+		return (('identd', None),)
+	def genexpr(self, c):
+		if self.desid:
+			return "d.getidentd() == %s" % (c.lit(self.desid),)
+		else:
+			return "d.getidentd()"
 	def eval(self, hi):
 		r = hi.getidentd()
 		if not r:
@@ -132,12 +159,27 @@ class LocalMatch:
 		if r == None:
 			raise BadArg, "bad local: values"
 		self.host, self.port = r
+		# We match on the numeric forms.
+		self.hostn = self.portn = None
+		if self.host:
+			self.hostn = int(netblock.strtoip(self.host))
+		if self.port:
+			self.portn = int(self.port)
 	def __str__(self):
 		return "local: %s@%s" % (self.port, self.host)
+	def sharekey(self):
+		return (self.portn, self.hostn)
+	def genexpr(self, c):
+		l = ["1"]
+		if self.portn is not None:
+			l.append("d.getlportn() == %s" % (c.lit(self.portn),))
+		if self.hostn is not None:
+			l.append("d.getlipn() == %s" % (c.lit(self.hostn),))
+		return " and ".join(l)
 	def eval(self, hi):
-		if self.port and self.port != hi.getlport():
+		if self.portn is not None and self.portn != hi.getlportn():
 			return 0
-		if self.host and self.host != hi.getlip():
+		if self.hostn is not None and self.hostn != hi.getlipn():
 			return 0
 		return 1
 
@@ -161,6 +203,12 @@ class HNStatusMatch:
 		self.name = intern(val)
 	def __str__(self):
 		return "hnstatus: "+self.name
+	def sharekey(self):
+		return self.wstates
+	def facets(self):
+		return (('hostname', None),)
+	def genexpr(self, c):
+		return "d.gethnstate() in %s" % (c.const(self.wstates),)
 	def eval(self, hi):
 		return hi.gethnstate() in self.wstates
 
@@ -190,7 +238,7 @@ def validipaddr(val):
 	return not (val[0] == '.' or
 		    val.translate(unitytrans, ipAddrChars))
 class IPAddrMatch(object):
-	__slots__ = "cidr", "cname", "ip", "name"
+	__slots__ = "cidr", "cname", "ip", "name", "net", "mask"
 	# 'docheck' is a hack and a private interface; it avoids doing
 	# validity checks twice if we're coming through the handledefault()
 	# internal path.
@@ -205,6 +253,11 @@ class IPAddrMatch(object):
 		else:
 			validateipprefix(val)
 			self.ip = val
+			# Prefixes are matched numerically, as a network
+			# and a mask.
+			n = val.count('.')
+			self.net = int(netblock.strtoip(val[:-1], min = 1))
+			self.mask = int(netblock.lenmask(n * 8))
 		self.name = [val]
 		self.cname = intern(name)
 	def __str__(self):
@@ -244,28 +297,40 @@ class IPAddrMatch(object):
 		# work off the self.name list, since we have to maintain
 		# it anyways and it better be parseable.
 		self.ip = None
+		self.name = list(self.name)
 		self.name.extend(other.name)
 		return True
-	# This returns both the string and the numeric form of the IP
-	# address, because we may need both.
-	def _getipS(self, hi):
-		return hi.getip()
 	def _getipN(self, hi):
 		return hi.getipn()
+	# The (low, high) ranges of IP addresses that we match, as
+	# numbers.
+	def ipranges(self):
+		if self.ip:
+			return [(self.net, self.net | (~self.mask & 0xffffffffL))]
+		return [(int(x[0]), int(x[1])) for x in self.cidr.numranges()]
+	def sharekey(self):
+		return tuple(self.ipranges())
+	ipgetter = "getipn"
+	def genexpr(self, c):
+		if self.ip:
+			return "(d.%s() & %s) == %s" % (self.ipgetter,
+							c.lit(self.mask),
+							c.lit(self.net))
+		else:
+			return "d.%s() in %s" % (self.ipgetter,
+						 c.const(self.cidr))
 	def eval(self, hi):
-		# if self.ip is set, it ends with a dot and is safe to
-		# match against the IP address we want to check.
-		# Otherwise, CIDR match.
+		# if self.ip is set, we are a single tcpwrappers style
+		# prefix. Otherwise, CIDR match.
 		if self.ip:
-			return self._getipS(hi).startswith(self.ip)
+			return (self._getipN(hi) & self.mask) == self.net
 		else:
 			return self._getipN(hi) in self.cidr
 # This matches against the local IP address instead of the remote one.
 class LIPAddrMatch(IPAddrMatch):
-	def _getipS(self, hi):
-		return hi.getlip()
 	def _getipN(self, hi):
 		return hi.getlipn()
+	ipgetter = "getlipn"
 
 # Match against tcpwrappers style hostnames, which may be either full
 # hostnames or '.' with a hostname portion. '.foobar' matches either
@@ -277,7 +342,7 @@ def validhostname(hn):
 	return not (hn.translate(unitytrans, hostNameChars) or
 		    hn == '.')
 class HostnameMatch(object):
-	__slots__ = "cname", "host", "hoste"
+	__slots__ = "cname", "host", "hoste", "names", "exact", "suffixes"
 	def __init__(self, name, val):
 		val = val.lower()
 		if not validhostname(val):
@@ -295,19 +360,85 @@ class HostnameMatch(object):
 		else:
 			self.hoste = None
 			self.host = val
+		# See merge().
+		self.names = None
+		self.exact = None
+		self.suffixes = None
+	def _val(self):
+		if self.hoste:
+			return self.hoste
+		return self.host
 	def __str__(self):
 		# Our small optimization above requires us to be clever
 		# here in order to get the original version out, since
 		# that is either hoste or host, depending.
-		if self.hoste:
-			return '%s %s' % (self.cname, self.hoste)
+		# Like IPAddrMatch, if we have merged we produce a fake
+		# orlist.
+		if self.names:
+			return " ".join(["%s %s" % (self.cname, x) for x in self.names])
+		return '%s %s' % (self.cname, self._val())
+	def sharekey(self):
+		return self.names or (self._val(),)
+	# Like IPAddrMatch, several hostname matches in a row merge into
+	# one. Once finalized, a merged match has a set of the names it
+	# matches exactly, and a set of the '.' suffixes it matches; we
+	# check every '.' suffix of the hostname against the latter,
+	# which takes a set lookup per label instead of a check per
+	# name. (A '.foo' name also matches 'foo' exactly.)
+	def merge(self, other):
+		if not (isinstance(other, HostnameMatch) and \
+			other.cname == self.cname):
+			return False
+		# We may have been finalized already, if we came out of
+		# a bracketed orlist.
+		if self.names is None:
+			self.names = [self._val()]
+		elif self.exact is not None:
+			self.names = list(self.names)
+			self.exact = self.suffixes = None
+		if other.names:
+			self.names.extend(other.names)
 		else:
-			return "%s %s" % (self.cname, self.host)
+			self.names.append(other._val())
+		return True
+	def finalize(self):
+		if not self.names:
+			return
+		self.names = tuple(self.names)
+		self.exact = frozenset([x.lstrip('.') for x in self.names])
+		self.suffixes = frozenset([x for x in self.names if x[0] == '.'])
+	def facets(self):
+		return (('hostname', None),)
 	def _gethostname(self, hi):
 		return hi.gethostname_l()
+	hngetter = "gethostname_l"
+	def _matchmany(self, hn):
+		if not hn:
+			return False
+		if hn in self.exact:
+			return True
+		i = hn.find('.')
+		while i >= 0:
+			if hn[i:] in self.suffixes:
+				return True
+			i = hn.find('.', i+1)
+		return False
+	# A missing hostname is None, which is never equal to or the
+	# end of anything.
+	def genexpr(self, c):
+		hn = "d.%s()" % (self.hngetter,)
+		if self.exact is not None:
+			return "%s(%s)" % (c.const(self._matchmany), hn)
+		elif self.hoste:
+			return "(%s or '').endswith(%s) or %s == %s" % \
+			       (hn, c.lit(self.hoste), hn, c.lit(self.host))
+		else:
+			return "%s == %s" % (hn, c.lit(self.host))
 	def eval(self, hi):
 		hn = self._gethostname(hi)
-		if not hn:
+		if self.exact is not None:
+			return self._matchmany(hn)
+		elif not hn:
 			return False
 		elif self.hoste:
 			return hn.endswith(self.hoste) or hn == self.host
@@ -318,6 +449,7 @@ class HostnameMatch(object):
 class ClaimedHNMatch(HostnameMatch):
 	def _gethostname(self, hi):
 		return hi.getclaimedhn_l()
+	hngetter = "getclaimedhn_l"
 
 class ClassMatch:
 	def __init__(self, name, val):
@@ -325,34 +457,190 @@ class ClassMatch:
 		self.cls = val
 	def __str__(self):
 		return "class: "+self.cls
+	def sharekey(self):
+		return self.cls
+	def genexpr(self, c):
+		return "%s in d.getclasses()" % (c.lit(self.cls),)
 	def eval(self, hi):
 		return self.cls in hi.getclasses()
 
 # Regular expressions turn out to be pretty easy.
+# Several re: (or claimedre:) matches in a row merge into one, like
+# hostname: matches. Once finalized, a merged match searches the
+# hostname with one alternation of all of its patterns instead of
+# one search per pattern. Patterns with backreferences or inline
+# flags cannot safely be put in an alternation (the references
+# would be renumbered and the flags would apply to everything), so
+# they are searched for on their own; so are alternations that
+# Python's regexp engine refuses, for example because they would
+# have too many groups.
+MAXGROUPS = 99
+def _subpatterns(av):
+	if isinstance(av, sre_parse.SubPattern):
+		yield av
+	elif isinstance(av, (tuple, list)):
+		for a in av:
+			for sp in _subpatterns(a):
+				yield sp
+def _walkops(ops):
+	for op, av in ops:
+		yield op
+		for sp in _subpatterns(av):
+			for x in _walkops(sp):
+				yield x
+def _parsere(pat):
+	try:
+		return sre_parse.parse(pat, re.IGNORECASE)
+	except (re.error, RuntimeError):
+		return None
+def _alternable(pat):
+	p = _parsere(pat)
+	if p is None or p.pattern.flags != re.IGNORECASE:
+		return False
+	for op in _walkops(p):
+		if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+			return False
+	return True
+# Most patterns cannot match unless the hostname contains some literal
+# text, such as 'dsl' or 'pool'. We find the longest such literal
+# when we compile the pattern and check for it with a plain substring
+# search first, which is much cheaper than a regexp search. Only runs
+# of literal characters at the top level of the pattern (or inside
+# plain groups there) count; anything optional or alternative ends
+# the run. Since matching is case-independent, literals are lower
+# case and are checked against the lower-cased hostname.
+def _literalruns(ops, runs):
+	cur = []
+	for op, av in ops:
+		if op == sre_constants.LITERAL and av < 128:
+			cur.append(chr(av))
+			continue
+		if cur:
+			runs.append("".join(cur))
+			cur = []
+		if op == sre_constants.SUBPATTERN:
+			_literalruns(av[1], runs)
+	if cur:
+		runs.append("".join(cur))
+def _reqliteral(pat):
+	p = _parsere(pat)
+	if p is None:
+		return None
+	runs = []
+	_literalruns(p, runs)
+	if not runs:
+		return None
+	return max(runs, key=len).lower()
+# A search can be skipped unless the hostname contains one of its
+# literals. If any pattern in it has no required literal, there is
+# no such shortcut and we return None.
+def _prefilter(pats):
+	lits = [_reqliteral(x) for x in pats]
+	if None in lits:
+		return None
+	res = []
+	for l in lits:
+		if l not in res:
+			res.append(l)
+	return tuple(res)
+
+# We return a tuple of the compiled searches to make and a matching
+# tuple of their prefilters.
+def _alternate(pats):
+	res = []
+	chunk = []; groups = 0
+	for p in pats:
+		if not _alternable(p):
+			res.extend(_compilechunk([p]))
+			continue
+		ng = _parsere(p).pattern.groups - 1
+		if chunk and groups + ng > MAXGROUPS:
+			res.extend(_compilechunk(chunk))
+			chunk = []; groups = 0
+		chunk.append(p); groups += ng
+	if chunk:
+		res.extend(_compilechunk(chunk))
+	return tuple([x[0] for x in res]), tuple([x[1] for x in res])
+def _compilechunk(pats):
+	if len(pats) == 1:
+		return [(rememo.compile(pats[0]), _prefilter(pats))]
+	try:
+		r = rememo.compile("|".join(["(?:%s)" % x for x in pats]))
+		return [(r, _prefilter(pats))]
+	except BadArg:
+		return [(rememo.compile(x), _prefilter([x])) for x in pats]
+
 class REMatch(object):
-	__slots__ = "cname", "rexp"
+	__slots__ = "cname", "rexp", "pats", "rexps", "lits"
 	def __init__(self, name, val):
 		self.rexp = rememo.compile(val)
 		self.cname = intern(name)
+		# See merge().
+		self.pats = None
+		self.rexps = (self.rexp,)
+		self.lits = (_prefilter([val]),)
 	def __str__(self):
+		if self.pats:
+			return " ".join(["%s '%s'" % (self.cname, x) for x in self.pats])
 		return "%s '%s'" % (self.cname, self.rexp.pattern)
+	def sharekey(self):
+		return self.pats or (self.rexp.pattern,)
+	def merge(self, other):
+		if not (isinstance(other, REMatch) and \
+			other.cname == self.cname):
+			return False
+		# We may have been finalized already, if we came out of
+		# a bracketed orlist.
+		if self.pats is None:
+			self.pats = [self.rexp.pattern]
+		elif isinstance(self.pats, tuple):
+			self.pats = list(self.pats)
+		if other.pats:
+			self.pats.extend(other.pats)
+		else:
+			self.pats.append(other.rexp.pattern)
+		return True
+	def finalize(self):
+		if not self.pats:
+			return
+		self.pats = tuple(self.pats)
+		self.rexps, self.lits = _alternate(self.pats)
+	def facets(self):
+		return (('hostname', None),)
 	def _gethostname(self, hi):
 		return hi.gethostname()
+	hngetter = "gethostname"
+	def _search(self, hn):
+		lhn = hn.lower()
+		for r, lits in zip(self.rexps, self.lits):
+			if lits:
+				for l in lits:
+					if l in lhn:
+						break
+				else:
+					continue
+			if r.search(hn):
+				return True
+		return False
+	# The same patterns are often checked against the same hostname
+	# by several rules, so the answer is remembered for the life of
+	# the connection.
 	def eval(self, hi):
 		hn = self._gethostname(hi)
 		if not hn:
 			return 0
-		# We cannot just return the search result directly because
-		# it isn't a boolean. So we make it one. (Go team.)
-		return bool(self.rexp.search(hn))
+		return hi.memoized((self.rexps, hn), self._search, hn)
 class ClaimedREMatch(REMatch):
 	def _gethostname(self, hi):
 		return hi.getclaimedhn()
+	hngetter = "getclaimedhn"
 
 # This matches based on the *forward* hostname to IP address mapping
 # information, as opposed to the reverse. 'forwhn: foobar' will match
 # if the connection is coming from one of the IP addresses 'foobar'
 # resolves to, irregardless of their reverse mappings.
+# The name is resolved when the rule is loaded (and then periodically
+# refreshed by hinfo), so evaluation never waits on DNS.
 class ForwhnMatch:
 	def __init__(self, name, val):
 		__pychecker__ = 'no-argsused'
@@ -360,15 +648,17 @@ class ForwhnMatch:
 		if not validhostname(val):
 			raise BadArg, "bad forwhn hostname: "+val
 		self.forwhn = val
+		hinfo.forwcache.register(val)
 	def __str__(self):
 		return "forwhn: "+self.forwhn
+	def sharekey(self):
+		return self.forwhn
+	def facets(self):
+		return (('forwhn', self.forwhn),)
+	def genexpr(self, c):
+		return "d.getip() in d.getforwips(%s)" % (c.lit(self.forwhn),)
 	def eval(self, hi):
-		ips = hi.gethostips(self.forwhn)
-		ip = hi.getip()
-		for i in ips:
-			if ip == i:
-				return 1
-		return 0
+		return hi.getip() in hi.getforwips(self.forwhn)
 
 # Check a IP-based DNS blocklist. The optional /<IP> makes things only
 # match if the DNSBl specifically returns that IP address on lookups.
@@ -394,6 +684,16 @@ class DNSBlMatch:
 			return "dnsbl: %s/%s" % (self.dnsbl[1:], self.ipval)
 		else:
 			return "dnsbl: "+self.dnsbl[1:]
+	def sharekey(self):
+		return (self.dnsbl, self.ipval)
+	def facets(self):
+		return (('dnsbl', self.dnsbl),)
+	def genexpr(self, c):
+		ips = "d.gethostips(d.getrevip() + %s)" % (c.lit(self.dnsbl),)
+		if self.ipval:
+			return "%s in %s" % (c.lit(self.ipval), ips)
+		else:
+			return ips
 	def eval(self, hi):
 		# We have to reverse the IP address in order to perform
 		# DNS blacklist lookups. Fortunately the HostInfo data
@@ -408,16 +708,40 @@ class DNSBlMatch:
 				return 1
 		return 0
 
+# Several answerson: terms in a row are merged into one matcher, the
+# same way IPAddrMatch does it, so that all of the ports can be probed
+# at the same time instead of one after another.
 class AnswersOnMatch:
 	def __init__(self, name, val):
 		__pychecker__ = "no-argsused"
-		self.port = util.int_or_raise(val, BadArg)
-		if not (0 <= self.port <= 65536):
+		port = util.int_or_raise(val, BadArg)
+		if not (0 <= port <= 65536):
 			raise BadArg, "port number outside of OK range"
+		self.ports = [port]
 	def __str__(self):
-		return "answerson: %d" % self.port
+		return " ".join(["answerson: %d" % x for x in self.ports])
+	def sharekey(self):
+		return tuple(self.ports)
+	def facets(self):
+		return tuple([('answerson', x) for x in self.ports])
+	def merge(self, other):
+		if not isinstance(other, AnswersOnMatch):
+			return False
+		# We may have been finalized already, if we came out of
+		# a bracketed orlist.
+		self.ports = list(self.ports)
+		self.ports.extend(other.ports)
+		return True
+	def finalize(self):
+		self.ports = tuple(self.ports)
+	def genexpr(self, c):
+		if len(self.ports) == 1:
+			return "d.answerson(%s)" % (c.lit(self.ports[0]),)
+		return "d.answersonany(%s)" % (c.const(self.ports),)
 	def eval(self, hi):
-		return hi.answerson(self.port)
+		if len(self.ports) == 1:
+			return hi.answerson(self.ports[0])
+		return hi.answersonany(self.ports)
 
 # These matchers operate based on the time of the first or the most recent
 # connection.
@@ -427,15 +751,26 @@ class TimedMatch:
 		self.secsold = util.getsecs_or_raise(val, BadArg)
 	def __str__(self):
 		return "%s %ds" % (self.name, self.secsold)
+	def sharekey(self):
+		return self.secsold
+	def facets(self):
+		return (('iptimes', None),)
 class WaitedMatch(TimedMatch):
+	def genexpr(self, c):
+		return "d.getfirsttime() > %s" % (c.lit(self.secsold),)
 	def eval(self, hi):
 		return hi.getfirsttime() > self.secsold
 class StallMatch(TimedMatch):
+	def genexpr(self, c):
+		return "d.getfirsttime() <= %s" % (c.lit(self.secsold),)
 	def eval(self, hi):
 		return hi.getfirsttime() <= self.secsold
 # If this is the first connection, we have by definition not seen them
 # for an infinite time.
 class LastSeenMatch(TimedMatch):
+	def genexpr(self, c):
+		return "d.getlasttime() is not None and d.getlasttime() <= %s" % \
+		       (c.lit(self.secsold),)
 	def eval(self, hi):
 		r = hi.getlasttime()
 		if r == None:
@@ -444,6 +779,9 @@ class LastSeenMatch(TimedMatch):
 # Similarly, if this is the first connection we have not seen them for
 # an infinite amount of time.
 class NotSeenForMatch(TimedMatch):
+	def genexpr(self, c):
+		return "d.getlasttime() is None or d.getlasttime() > %s" % \
+		       (c.lit(self.secsold),)
 	def eval(self, hi):
 		r = hi.getlasttime()
 		if r == None:
@@ -454,9 +792,33 @@ class FirstTimeMatch:
 		__pychecker__ = 'no-argsused'
 	def __str__(self):
 		return "firsttime"
+	def sharekey(self):
+		return ()
+	def facets(self):
+		return (('iptimes', None),)
+	def genexpr(self, c):
+		__pychecker__ = "no-argsused"
+		return "d.getlasttime() is None"
 	def eval(self, hi):
 		return hi.getlasttime() == None
 
+# True if DNS lookups are being skipped because the DNS is in trouble
+# (see hinfo's breaker), so that rules can put connections that we
+# can't properly check into a safe class.
+class DNSDegradedMatch:
+	def __init__(self, name, val):
+		__pychecker__ = 'no-argsused'
+	def __str__(self):
+		return "dnsdegraded"
+	def sharekey(self):
+		return ()
+	def facets(self):
+		return (('degraded', None),)
+	def genexpr(self, c):
+		__pychecker__ = "no-argsused"
+		return "d.dnsdegraded()"
+	def eval(self, hi):
+		return hi.dnsdegraded()
 
 # This structure is what the rdparse module uses to match up matchers
 # with arguments.
@@ -480,6 +842,7 @@ class MatchInfo:
 		'stallfor:': StallMatch, 'waited:': WaitedMatch,
 		'seenwithin:': LastSeenMatch,'notseenfor:': NotSeenForMatch,
 		'firsttime': FirstTimeMatch,
+		'dnsdegraded': DNSDegradedMatch,
 		# This sort of doesn't belong here, but.
 		'class:': ClassMatch,
 		# DANGER WILL ROBINSON. Use of these is dangerous and can
@@ -2,11 +2,29 @@
 # Message services: formatting a message based on information from a
 # hinfo object and the class, and some standard messages.
 
-# Format messages by stirring them with a dictionary of information for use
-# in Python-style format strings. The dictionary is drawn from hostinfo and
-# class data.
+# Format messages by stirring them with a mapping of information for use
+# in Python-style format strings. The information is drawn from hostinfo
+# and class data, and then from sdict (which cannot override anything
+# else). Host information is only worked out for the keys that the
+# message actually uses.
+class FormatMap(object):
+	__slots__ = "d", "info", "sdict"
+	def __init__(self, d, info, sdict):
+		self.d = d
+		self.info = info
+		self.sdict = sdict
+	def __getitem__(self, key):
+		if key in self.d:
+			return self.d[key]
+		try:
+			return self.info[key]
+		except KeyError:
+			if self.sdict:
+				return self.sdict[key]
+			raise
+
 def format(msg, hi, cls, sdict = None, **kwargs):
-	d = hi.getinfo()
+	d = {}
 	if cls != None:
 		d['class'] = cls.clsname
 		d['lineno'] = cls.lineno
@@ -16,22 +34,28 @@ def format(msg, hi, cls, sdict = None, **kwargs):
 		d.update(kwargs)
 	# Give the user some way to insert \r, \n, and \r\n.
 	d['cr'] = "\r"; d['nl'] = "\n"; d['eol'] = "\r\n"
-	# We cannot mutate sdict, so we use a new dictionary (rd, the
-	# root dictionary) to get the semantics we want, which is that
-	# sdict cannot override values from elsewhere if they exist.
-	# (This means we put sdict in first, then d in later.)
-	rd = {}
-	if sdict:
-		rd.update(sdict)
-	rd.update(d)
-	return msg % rd
+	return msg % FormatMap(d, hi.getinfo(), sdict)
 
 
 # Standard messages.
 logconnect = "accepted: %(connsum)s by %(class)s"
 loglimits = "refused: %(connsum)s rejected by %(class)s %(limit)s limit"
 logreject = "rejected: %(connsum)s by %(class)s"
+# Logged later, with 'lognames on'.
+loghostname = "hostname: connection %(connid)d from %(ip)s is %(hostname)s (%(hnstatus)s)"
 rejmsgs = { 'reject': logreject,
 	   'ipmax': loglimits,
 	   'connmax': loglimits,
 	   }
+# With 'lognames on', the hostname is logged later in a message of its
+# own, so the standard messages must say which connection they are
+# about.
+def addconnids():
+	global logconnect, loglimits, logreject, rejmsgs
+	logconnect += " (connection %(connid)d)"
+	loglimits += " (connection %(connid)d)"
+	logreject += " (connection %(connid)d)"
+	rejmsgs = { 'reject': logreject,
+		   'ipmax': loglimits,
+		   'connmax': loglimits,
+		   }
@@ -246,3 +246,9 @@ class IPRanges(ranges.Ranges):
 		for irng in self._l:
 			lhcidrs(irng[0], irng[1], r)
 		return [cidrtostr(x[0], x[1]) for x in r]
+
+	# The ranges themselves, as numbers.
+	def numranges(self):
+		"""Return a list of (low, high) tuples of the IP address
+		ranges in this set, as numbers, in ascending order."""
+		return [(x[0], x[1]) for x in self._l]
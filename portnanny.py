@@ -7,13 +7,13 @@
 # a new connection, and dispatches it.
 #
 
-import sys, time
+import sys, time, errno
 import getopt
-import thread
+import thread, Queue
 
 import log
-import conntrack, hinfo
-import rules, actions
+import conntrack, hinfo, hostmap
+import rules, actions, msgs
 import cfloader
 import proc
 
@@ -55,6 +55,8 @@ totrules = 0
 # which failed getpeername().
 totloops = 0
 totconns = 0
+# The current rules, for status reports.
+currules = None
 
 # Called to reap a PID from the child handler.
 def reaper(pid):
@@ -63,8 +65,9 @@ def reaper(pid):
 
 # Emergency flush, called from a signal handler.
 def kickme():
-	log.debug(2, "force-clearing IP times")
+	log.debug(2, "force-clearing IP times and lookup caches")
 	hinfo.cleariptimes()
+	hinfo.flushcaches()
 # Report information on current state.
 def repstate():
 	log.report("status: total lifetime connections: %d" % (totconnects,))
@@ -85,6 +88,32 @@ def repstate():
 	# This is put at the bottom to bookend the active connection info.
 	log.report("status: per IP first/last connection times entries: %d" % \
 		   (hinfo.iptimessize()))
+	for name, size in hinfo.cachesizes():
+		if size:
+			log.report("status: %s cache entries: %d" % (name, size))
+	hits, misses = hinfo.identstats()
+	if hits or misses:
+		log.report("status: identd negative cache: %d hits, %d misses" % \
+			   (hits, misses))
+	if hinfo.flightstats():
+		log.report("status: lookups shared with concurrent connections: %d" % \
+			   (hinfo.flightstats(),))
+	tripped, trips, skips = hinfo.breakerstats()
+	if tripped:
+		log.report("status: DNS breaker tripped %d seconds ago" % \
+			   (int(time.time()) - tripped,))
+	if trips:
+		log.report("status: DNS breaker: %d trips, %d lookups skipped" % \
+			   (trips, skips))
+	pending, refused = hinfo.lookupstats()
+	if pending or refused:
+		log.report("status: background lookups: %d pending, %d refused" % \
+			   (pending, refused))
+	for kind, cnt in hinfo.timeoutstats():
+		log.report("status: %s lookups out of budget: %d" % (kind, cnt))
+	if hinfo.forwcachesize():
+		log.report("status: forwhn: names cached: %d" % \
+			   (hinfo.forwcachesize(),))
 	if threadcount or threadhigh > 1:
 		log.report("status: %d active rules evaluation threads (%d highwater)." % \
 			   (threadcount, threadhigh))
@@ -93,6 +122,14 @@ def repstate():
 	if totrules and totruleTime:
 		log.report("status: average rule evaluation time over %d evals: %0.4f seconds" % (totrules, totruleTime / totrules))
 
+	if currules and currules.results:
+		log.report("status: rules results cached: %d" % \
+			   (len(currules.results),))
+	if currules:
+		for r, o in currules.ors:
+			log.report("status: rule at line %d or-list order: %s" % \
+				   (r.lineno, o))
+
 	if totloops:
 		log.report("status: %d loops, %d conns, %0.1f conns average" %
 			   (totloops, totconns, (totconns*1.0)/totloops))
@@ -139,10 +176,16 @@ def rule(newsock, rroot, aroot):
 		return None
 
 	# Run it past the rules, and see if anything comes out. If not
-	# we're done.
+	# we're done. If we are prefetching, we start all of the lookups
+	# the rules may want now, so that they overlap. Only the lookups
+	# made for the rules are limited by the lookup budget; later
+	# lookups for actions and logging are not.
 	ruleslock.acquire(); totrules += 1; ruleslock.release()
 	st = time.time()
+	hi.setbudget(hinfo.lookupbudget)
+	hi.prefetch(rroot.plan)
 	rmatch = rroot.eval(hi)
+	hi.setbudget(None)
 	et = time.time()
 	ruleslock.acquire(); totruleTime += (et-st); ruleslock.release()
 	if not rmatch:
@@ -177,6 +220,8 @@ def action(newsock, hi, rmatch, aroot):
 	# do. Either can be blank (hopefully both are not blank, but).
 	for le in action.logmsgs:
 		log.report(le)
+	if action.logmsgs:
+		lognamelater(hi)
 
 	# Activate the action's work function (if any) in a separate
 	# process and track it if necessary. We do not track the message
@@ -195,13 +240,45 @@ def action(newsock, hi, rmatch, aroot):
 			  (pid, conninfo(hi, rmnames),
 			   action.what, action.argstring))
 		if action.what.endswith("run"):
-			conntrack.up(pid, hi.getip(), rmnames)
+			conntrack.up(pid, hi.getipn(), rmnames)
 	else:
 		log.debug(2, "dropping %s" % (conninfo(hi, rmnames),))
 	# In all cases, our side of the socket is now dead and we close
 	# it. (The child may still have a live connection.)
 	proc.closesock(newsock)
 
+# With 'lognames on', connections whose hostnames the rules didn't need
+# are logged right away and their hostnames are looked up afterwards by
+# a few background threads, which log another message about each of
+# them. The two can be matched up through %(connid)s. If the threads
+# fall too far behind, we skip looking up hostnames.
+NAMETHREADS = 2
+NAMEQUEUE = 1000
+namequeue = None
+def startnamers():
+	global namequeue
+	msgs.addconnids()
+	namequeue = Queue.Queue(NAMEQUEUE)
+	for i in range(NAMETHREADS):
+		thread.start_new_thread(namer, ())
+def namer():
+	while 1:
+		hi = namequeue.get()
+		try:
+			hi.gethostname()
+			log.report(msgs.format(msgs.loghostname, hi, None))
+		except Exception, e:
+			log.error("error logging the hostname of connection %d: %s" % \
+				  (hi.getconnid(), str(e)))
+def lognamelater(hi):
+	if namequeue is None or hi.hnknown():
+		return
+	try:
+		namequeue.put_nowait(hi)
+	except Queue.Full:
+		log.debug(2, "hostname lookup queue full, not looking up %s" % \
+			  (conninfo(hi),))
+
 # Finish up a completed rule processing by dispatching to actions.
 # This always happens in the main thread, which is why this whole
 # mess is so complicated (and irritating).
@@ -326,13 +403,92 @@ class ThreadConf:
 		else:
 			self.maxclass = None
 
+# How many IP times entries to look at per loop when expiring them.
+EXPIRESTEP = 5000
+# How often we save a snapshot of the IP times by default, if we
+# are saving them at all.
+SAVEEVERY = 300
+
+def saveiptimes(fname):
+	try:
+		n = hinfo.saveiptimes(fname)
+	except (EnvironmentError, OverflowError), e:
+		log.error("could not save IP times to %s: %s" % (fname, e))
+		return
+	log.debug(3, "saved %d IP times entries to %s" % (n, fname))
+def loadiptimes(fname):
+	try:
+		n = hinfo.loadiptimes(fname)
+	except EnvironmentError, e:
+		# Having no snapshot yet is normal.
+		if e.errno != errno.ENOENT:
+			log.error("could not load IP times from %s: %s" % (fname, e))
+		return
+	except ValueError, e:
+		log.error("bad IP times snapshot %s: %s" % (fname, e))
+		return
+	log.debug(1, "loaded %d IP times entries from %s" % (n, fname))
+
+def savecaches(fname):
+	try:
+		n = hinfo.savecaches(fname)
+	except (EnvironmentError, ValueError), e:
+		log.error("could not save lookup caches to %s: %s" % (fname, e))
+		return
+	log.debug(3, "saved %d lookup cache entries to %s" % (n, fname))
+def loadcaches(fname):
+	try:
+		n = hinfo.loadcaches(fname)
+	except EnvironmentError, e:
+		if e.errno != errno.ENOENT:
+			log.error("could not load lookup caches from %s: %s" % (fname, e))
+		return
+	except ValueError, e:
+		log.error("bad lookup cache snapshot %s: %s" % (fname, e))
+		return
+	log.debug(1, "loaded %d lookup cache entries from %s" % (n, fname))
+
+# Snapshots can be big enough that writing them would hold up accepting
+# connections, so they are written by a background thread. Only one
+# set is ever being written at once; if the last set is still being
+# written when it's time for another, we skip this one.
+savelock = thread.allocate_lock()
+def savesnapshots(ipfile, cachefile):
+	if not savelock.acquire(0):
+		log.debug(1, "still writing the last snapshots, skipping this round")
+		return
+	try:
+		thread.start_new_thread(writesnapshots, (ipfile, cachefile))
+	except thread.error, e:
+		savelock.release()
+		log.error("could not start a thread to save snapshots: %s" % (e,))
+def writesnapshots(ipfile, cachefile):
+	try:
+		if ipfile:
+			saveiptimes(ipfile)
+		if cachefile:
+			savecaches(cachefile)
+	finally:
+		savelock.release()
+
 def serve(cfg, sockl, threadmax):
-	global totloops, totconns
-	# Our expiry timers.
+	global totloops, totconns, currules
+	# Our expiry timers. We always have shared lookup caches to
+	# expire, even if there are no IP times to drop. IP times are
+	# expired a bit at a time on each trip around the loop until
+	# there is nothing more to do, and also whenever there are too
+	# many of them.
 	ttick = 0
-	if 'dropipafter' not in cfg:
-		expireevery = -1
-	elif 'expireevery' in cfg:
+	expiring = 0
+	# Our timer for reordering or-lists, if we are doing that.
+	otick = time.time()
+	reorderevery = cfg.get('reorderevery', 0)
+	# Our IP times and lookup cache snapshot timer.
+	stick = time.time()
+	ipfile = cfg.get('iptimesfile')
+	cachefile = cfg.get('cachefile')
+	saveevery = cfg.get('iptimessave', SAVEEVERY)
+	if 'expireevery' in cfg:
 		expireevery = cfg['expireevery']
 	else:
 		# Pick a default.
@@ -352,12 +508,20 @@ def serve(cfg, sockl, threadmax):
 			     "rules", droponerr)
 	loadActs = Reloader(cfg['actionfile'], actions.parsefile,
 			    actions.BadAction, "actions", droponerr)
+	# The host map is optional.
+	if 'hostmap' in cfg:
+		loadHosts = Reloader(cfg['hostmap'], hostmap.parsefile,
+				     hostmap.BadInput, "host map", droponerr)
+	else:
+		loadHosts = None
 
 	# We attempt our first load now, rather than waiting for our
 	# first connection, so that we produce feedback on program
 	# startup about broken configuration files.
 	rroot = loadRules.curroot()
 	aroot = loadActs.curroot()
+	if loadHosts:
+		hinfo.sethostmap(loadHosts.curroot())
 
 	# Having acquired our initial setup, start running forever.
 	while 1:
@@ -365,9 +529,19 @@ def serve(cfg, sockl, threadmax):
 		# Note that 'expireevery' of 0 means 'on every connection';
 		# use a negative number to turn it off.
 		if expireevery >= 0 and time.time() - ttick >= expireevery:
-			log.debug(3, "Expiring the IP times info")
+			log.debug(3, "Expiring the IP times info and caches")
 			ttick = time.time()
-			hinfo.expireiptimes()
+			expiring = 1
+			hinfo.expirecaches()
+		if expiring or hinfo.iptimesfull():
+			expiring = hinfo.expireiptimes(EXPIRESTEP)
+		if rroot and reorderevery > 0 and \
+		   time.time() - otick >= reorderevery:
+			otick = time.time()
+			rroot.reorder()
+		if (ipfile or cachefile) and time.time() - stick >= saveevery:
+			stick = time.time()
+			savesnapshots(ipfile, cachefile)
 		# (we do these at the bottom, because they may take some
 		# time, and we want to service our active connection first.)
 		# Yes, yes, this is the top. Relative to getting a new
@@ -377,8 +551,10 @@ def serve(cfg, sockl, threadmax):
 
 		# Immediately attempt reload; god knows how long we've
 		# been asleep.
-		rroot = loadRules.curroot()
+		rroot = currules = loadRules.curroot()
 		aroot = loadActs.curroot()
+		if loadHosts:
+			hinfo.sethostmap(loadHosts.curroot())
 
 		# We may have rules that have completed evaluations
 		# waiting for us to turn them into actual actions.
@@ -417,7 +593,15 @@ def checkcfg(cfg):
 		log.error("error loading actions file %s: %s" %\
 			  (cfg['actionfile'], str(e)))
 		aroot = None
-	if rroot == None or aroot == None:
+	hmerr = 0
+	if 'hostmap' in cfg:
+		try:
+			hostmap.parsefile(cfg['hostmap'])
+		except hostmap.BadInput, e:
+			log.error("error loading host map %s: %s" % \
+				  (cfg['hostmap'], str(e)))
+			hmerr = 1
+	if rroot == None or aroot == None or hmerr:
 		sys.exit(1)
 	if len(rroot) == 0:
 		log.error("No rules in the rules file.")
@@ -485,13 +669,41 @@ def startup(cfname, checkonly, threadmax):
 	# Initialize global parameters.
 	if cfg.has_key('dropipafter'):
 		hinfo.setiptimesdur(cfg['dropipafter'])
+	if cfg.get('maxiptimes'):
+		hinfo.setiptimesmax(cfg['maxiptimes'])
+	hinfo.setanswersonttls(cfg.get('answersonttl', hinfo.ANSWERSONTTL),
+			       cfg.get('answersonnegttl', hinfo.ANSWERSONNEGTTL))
+	if cfg.has_key('identdnegttl'):
+		hinfo.setidentdnegttl(cfg['identdnegttl'])
+	hinfo.setdnsttls(cfg.get('dnsttl', 0), cfg.get('dnsnegttl', 0))
+	if cfg.has_key('forwhnrefresh'):
+		hinfo.setforwrefresh(cfg['forwhnrefresh'])
 	if cfg.has_key('substitutions'):
 		if cfg['substitutions'] == 'off':
 			actions.dosubstitutions(0)
 		else:
 			actions.dosubstitutions(1)
 
+	if cfg.has_key('iptimesfile'):
+		loadiptimes(cfg['iptimesfile'])
+	if cfg.has_key('cachefile'):
+		loadcaches(cfg['cachefile'])
+	if cfg.get('lookupbudget'):
+		hinfo.setlookupbudget(cfg['lookupbudget'] / 1000.0)
+	if cfg.get('prefetch') == 'on':
+		hinfo.setidentlog(log.error)
+		hinfo.setprefetch(1)
+	if cfg.get('cheapfirst') == 'on':
+		rules.setcheapfirst(1)
+	if cfg.get('reorderevery', 0) > 0:
+		rules.setadaptive(1)
+	if cfg.get('rulecachettl'):
+		rules.setresultttl(cfg['rulecachettl'])
+	if cfg.get('lognames') == 'on':
+		startnamers()
+
 	proc.initsignals(kickme, repstate)
+	hinfo.startforwrefresh()
 	serve(cfg, sockl, threadmax)
 
 def usage():
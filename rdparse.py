@@ -30,6 +30,7 @@
 #	defterminals	The list of default matcher names to try for
 #			solo arguments.
 #
+import time
 import lexr
 
 # These values are constants.
@@ -80,6 +81,263 @@ class ExceptNode:
 	def eval(self, data):
 		return self.left.eval(data) and not self.right.eval(data)
 
+# Return a list of all of the operands (the terminal matcher objects)
+# in a parse tree, in evaluation order.
+def operands(node):
+	if isinstance(node, NotNode):
+		return operands(node.op)
+	elif isinstance(node, OrNode):
+		res = []
+		for e in node.ops:
+			res.extend(operands(e))
+		return res
+	elif isinstance(node, (AndNode, ExceptNode)):
+		return operands(node.left) + operands(node.right)
+	else:
+		return [node]
+
+# Return a list of all of the nodes in a parse tree, the tree itself
+# first.
+def subtrees(node):
+	res = [node]
+	if isinstance(node, NotNode):
+		res.extend(subtrees(node.op))
+	elif isinstance(node, OrNode):
+		for e in node.ops:
+			res.extend(subtrees(e))
+	elif isinstance(node, (AndNode, ExceptNode)):
+		res.extend(subtrees(node.left))
+		res.extend(subtrees(node.right))
+	return res
+
+# Hash-consing. hashcons() returns a tree that evaluates the same as
+# root, but that uses the node in table for any subtree that is
+# already there and adds the rest of its subtrees to table, so that
+# identical subtrees of many trees become one node. Terminals are
+# identical if they have the same class and .sharekey(), which must
+# say everything that the terminal's result depends on (string forms
+# are not good enough; a quoted argument can make two different
+# terminals print the same). Operator nodes are identical if they
+# have the same class and the very same operands, which have already
+# been shared by then. Terminals without a .sharekey() and subtrees
+# with an operand that shareable() rejects are never put in table.
+# If seen is given, every node of the result that is in table is
+# appended to it.
+def hashcons(root, table, shareable, seen = None):
+	if seen is None:
+		seen = []
+	return _hashcons(root, table, shareable, seen)[0]
+def _hashcons(node, table, shareable, seen):
+	if isinstance(node, NotNode):
+		node.op, ok = _hashcons(node.op, table, shareable, seen)
+		key = (node.__class__, node.op)
+	elif isinstance(node, OrNode):
+		res = [_hashcons(x, table, shareable, seen) for x in node.ops]
+		node.ops = type(node.ops)([x[0] for x in res])
+		ok = False not in [x[1] for x in res]
+		key = (node.__class__, tuple(node.ops))
+	elif isinstance(node, (AndNode, ExceptNode)):
+		node.left, lok = _hashcons(node.left, table, shareable, seen)
+		node.right, rok = _hashcons(node.right, table, shareable, seen)
+		ok = lok and rok
+		key = (node.__class__, node.left, node.right)
+	else:
+		ok = hasattr(node, 'sharekey') and shareable(node)
+		if ok:
+			key = (node.__class__, node.sharekey())
+	if not ok:
+		return node, False
+	node = table.setdefault(key, node)
+	seen.append(node)
+	return node, True
+
+# Put items into order by key(item), keeping the original order for
+# items with equal keys. An item whose key is None stays where it is,
+# and nothing moves past it; it splits the list into runs that are
+# sorted separately.
+def sortruns(items, key):
+	res = []
+	run = []
+	for e in list(items) + [None]:
+		if e is not None:
+			k = key(e)
+			if k is not None:
+				run.append((k, len(run), e))
+				continue
+		run.sort()
+		res.extend([x[2] for x in run])
+		run = []
+		if e is not None:
+			res.append(e)
+	return res
+
+# Compile a parse tree into a single Python function of the data that
+# gives the same answer as root.eval(data) (or at least one with the
+# same truth value), without the overhead of walking the tree and
+# calling each node's .eval(). The whole tree becomes one expression.
+# Terminals can supply a Python expression for themselves with a
+# .genexpr() method, which is passed the Compiler and should refer to
+# the data as 'd'; terminals without one are called through their
+# .eval(). If the tree is too big or too deep for Python to compile,
+# we just give back root.eval.
+#
+# If we are given a cost function, it is called on terminals to get
+# how expensive they are to evaluate. A cost of None means that the
+# terminal must be evaluated exactly when it would be in source order
+# (because evaluating it has side effects), so nothing is ever moved
+# past it. With 'reorder', the operands of OR lists and ANDs are
+# evaluated cheapest first. With 'adaptive' (a list), OR lists are
+# compiled into AdaptiveOr objects (see below), which are appended to
+# it. With 'memo' (a set of nodes), those subtrees remember their
+# result for each piece of data, which must have a .memoized() method.
+# The tree itself is left alone.
+class Compiler:
+	def __init__(self, costf = None, reorder = 0, adaptive = None,
+		     memo = None):
+		self.env = {}
+		self.costf = costf
+		self.reorder = reorder
+		self.adaptive = adaptive
+		self.memo = memo
+	# Return a name that refers to val in the generated code.
+	def const(self, val):
+		name = "_c%d" % len(self.env)
+		self.env[name] = val
+		return name
+	# Return a literal for val if it has a simple one, and a name
+	# for it if it doesn't.
+	def lit(self, val):
+		if type(val) in (int, long, str, bool, type(None)):
+			return repr(val)
+		return self.const(val)
+	# Make a function of d that returns expr.
+	def mkfunc(self, expr):
+		name = "_f%d" % len(self.env)
+		src = "def %s(d):\n\treturn %s\n" % (name, expr)
+		exec compile(src, "<rule>", "exec") in self.env
+		return self.env[name]
+	# The cost of a subtree is the total of its terminals' costs.
+	def cost(self, node):
+		if self.costf is None:
+			return 0
+		t = 0
+		for m in operands(node):
+			c = self.costf(m)
+			if c is None:
+				return None
+			t += c
+		return t
+	# Put a list of operands into evaluation order.
+	def order(self, ops):
+		if not self.reorder:
+			return ops
+		return sortruns(ops, self.cost)
+	# Subtrees in memo are compiled into functions of their own.
+	def gen(self, node):
+		if self.memo and node in self.memo:
+			f = self.mkfunc(self._gen(node))
+			return "d.memoized(%s, %s, d)" % (self.const(node),
+							  self.const(f))
+		return self._gen(node)
+	def _gen(self, node):
+		if isinstance(node, NotNode):
+			return "(not %s)" % (self.gen(node.op),)
+		elif isinstance(node, OrNode):
+			ops = self.order(node.ops)
+			if self.adaptive is None:
+				return "(%s)" % (" or ".join(map(self.gen, ops)),)
+			funcs = [self.mkfunc(self.gen(x)) for x in ops]
+			fixed = [self.cost(x) is None for x in ops]
+			a = AdaptiveOr(ops, funcs, fixed)
+			self.adaptive.append(a)
+			return "%s(d)" % (self.const(a),)
+		elif isinstance(node, AndNode):
+			return "(%s)" % (" and ".join(map(self.gen, self.order([node.left, node.right]))),)
+		elif isinstance(node, ExceptNode):
+			return "(%s and not %s)" % (self.gen(node.left),
+						    self.gen(node.right))
+		elif hasattr(node, 'genexpr'):
+			return "(%s)" % (node.genexpr(self),)
+		else:
+			return "%s(d)" % (self.const(node.eval),)
+
+def compiletree(root, costf = None, reorder = 0, adaptive = None,
+		memo = None):
+	if adaptive is not None:
+		ors = []
+	else:
+		ors = None
+	c = Compiler(costf, reorder, ors, memo)
+	try:
+		f = c.mkfunc(c.gen(root))
+	except (SyntaxError, MemoryError, RuntimeError):
+		return root.eval
+	if ors:
+		adaptive.extend(ors)
+	return f
+
+# An OR list that learns what order to try its operands in. One
+# evaluation in every ADAPTSAMPLE is timed, recording how long each
+# operand took and whether it was true; .reorder() then puts the
+# operands in order of their expected time per success, cheap and
+# likely to be true first. Operands that have never been tried (because
+# earlier ones were always true) go last, and fixed operands (ones
+# with side effects) never move and nothing moves past them. The
+# counts decay every time we reorder, so that we follow changes in
+# what connections we're getting.
+#
+# Several threads can evaluate us at once. The counts are not locked,
+# so they can be a bit off, and .reorder() replaces the order as a
+# unit.
+ADAPTSAMPLE = 16
+class AdaptiveOr:
+	def __init__(self, ops, funcs, fixed):
+		self.ops = ops
+		self.funcs = funcs
+		self.fixed = fixed
+		n = len(ops)
+		self.tries = [0.0] * n
+		self.hits = [0.0] * n
+		self.time = [0.0] * n
+		self.evals = 0
+		self.setorder(range(n))
+	def setorder(self, order):
+		self.order = order
+		self.ofuncs = [self.funcs[i] for i in order]
+	def __call__(self, d):
+		self.evals += 1
+		if self.evals % ADAPTSAMPLE:
+			for f in self.ofuncs:
+				if f(d):
+					return 1
+			return 0
+		for i in self.order:
+			t = time.time()
+			r = self.funcs[i](d)
+			self.time[i] += time.time() - t
+			self.tries[i] += 1
+			if r:
+				self.hits[i] += 1
+				return 1
+		return 0
+	def score(self, i):
+		if self.fixed[i]:
+			return None
+		if not self.tries[i]:
+			return UNTRIED
+		return (self.time[i] / self.tries[i]) / \
+		       ((self.hits[i] + 1) / (self.tries[i] + 2))
+	def reorder(self):
+		self.setorder(sortruns(self.order, self.score))
+		for l in (self.tries, self.hits, self.time):
+			for i in range(len(l)):
+				l[i] = l[i] / 2
+	def __str__(self):
+		return " ".join(["%s [%d/%d]" % (self.ops[i], self.hits[i],
+						 self.tries[i])
+				 for i in self.order])
+UNTRIED = float('inf')
+
 # Pretty representation of a token tuple.
 def pretty(token):
 	if token[0] == '':
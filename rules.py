@@ -16,6 +16,7 @@
 # If at least one rule has matched, a synthetic matching rule called
 # 'GLOBAL' is added at the end of the match list.
 
+import bisect, time
 import rdparse
 import readcf
 import matchers
@@ -24,8 +25,18 @@ class BadInput(Exception):
 	pass
 
 # Non-underscored variables are public interfaces.
+# 'facets' is the set of host information facets that evaluating the
+# rule may look up; see matchers. 'evalf' is the matcher compiled into
+# a function (see rdparse.compiletree), which is what we actually call
+# to evaluate the rule. 'guard' is None or a check on the listener that
+# must be true for the rule to match (see listenguard()), and 'ipguard'
+# is None or the ranges of remote IP addresses that the rule can match
+# (see ipguard()). 'cacheable' is false if the rule looks at facets
+# that keep its result from being cached (see RulesList.eval()).
 class Rule(object):
-	__slots__ = "lineno", "clsname", "nonterminal", "always", "label", "matcher"
+	__slots__ = "lineno", "clsname", "nonterminal", "always", "label", \
+		    "matcher", "facets", "evalf", "guard", "ipguard", \
+		    "cacheable"
 	def __init__(self, lineno):
 		self.lineno = lineno
 		self.clsname = None
@@ -33,6 +44,11 @@ class Rule(object):
 		self.always = 0
 		self.label = None
 		self.matcher = None
+		self.facets = frozenset()
+		self.evalf = None
+		self.guard = None
+		self.ipguard = None
+		self.cacheable = 1
 	def __str__(self):
 		# If we have no matcher, we are an internal rule.
 		if not self.matcher:
@@ -99,8 +115,184 @@ def parseline(line, lineno):
 		r.matcher = rdparse.parse(rulestr, matchers.matchinfo)
 	except rdparse.ParseError, e:
 		raise BadInput, e
+	r.facets = getfacets(r.matcher)
 	return r
 
+# Find all of the host information facets that a matcher tree can
+# ask for.
+def getfacets(root):
+	res = []
+	for m in rdparse.operands(root):
+		if hasattr(m, 'facets'):
+			res.extend(m.facets())
+	return frozenset(res)
+
+# The order in which lookups for facets are started when prefetching,
+# cheapest first. Identd queries and answerson: probes don't block
+# anything to start; hostname and DNSBl lookups each take a thread.
+# forwhn: names are already resolved when the rules are loaded, and IP
+# times and the DNS breaker state are never prefetched (see hinfo), but
+# they are facets all the same.
+facetcosts = {
+	'iptimes': 0, 'forwhn': 0, 'degraded': 0,
+	'identd': 1, 'answerson': 2,
+	'hostname': 3, 'dnsbl': 4,
+	}
+def makeplan(facets):
+	plan = list(facets)
+	plan.sort(lambda a, b: cmp((facetcosts[a[0]], a), (facetcosts[b[0]], b)))
+	return plan
+
+# How expensive it is to evaluate matchers that need each facet, so
+# that rules can be compiled to try cheap operands first (see
+# rdparse.compiletree) if cheapfirst is set. Matchers that need no
+# facets at all (ip:, local:, ALL, class:) are free. Matchers that look
+# at IP times are never moved, because looking at them is what records
+# the time of the connection.
+#
+# If adaptive is set, OR lists learn their order from how their
+# operands actually do (see rdparse.AdaptiveOr); RulesList.reorder()
+# is called every so often to apply what they've learned.
+evalcosts = {
+	'forwhn': 0, 'degraded': 0,
+	'hostname': 1,
+	'identd': 2, 'answerson': 2, 'dnsbl': 2,
+	}
+cheapfirst = 0
+adaptive = 0
+def setcheapfirst(val):
+	global cheapfirst
+	cheapfirst = val
+def setadaptive(val):
+	global adaptive
+	adaptive = val
+def opcost(m):
+	c = 0
+	if hasattr(m, 'facets'):
+		for kind, arg in m.facets():
+			if kind == 'iptimes':
+				return None
+			c += evalcosts[kind]
+	return c
+
+# Identical subtrees in different rules are shared (see
+# rdparse.hashcons), and shared subtrees that need host information
+# remember their result for the connection, so that they are only
+# evaluated once per connection however many rules use them. class:
+# matchers are never shared, because their result changes as rules
+# match. Subtrees that are free to evaluate are cheaper to evaluate
+# again than to look up, and subtrees with IP times matchers are left
+# alone like they are for cheapfirst.
+def shareable(m):
+	return not isinstance(m, matchers.ClassMatch)
+def worthmemo(node):
+	c = 0
+	for m in rdparse.operands(node):
+		mc = opcost(m)
+		if mc is None:
+			return False
+		c += mc
+	return c > 0
+
+# Many rules start with local: or localip:, so that they can only match
+# connections to some of our listeners. listenguard() finds the check
+# on the listener that the rule is guarded by, if it has one; it's a
+# function of a Listener. We only take checks that are evaluated
+# before anything else in the rule, so that skipping the rule when the
+# check fails skips nothing else that evaluating it would have done.
+# (cheapfirst and reorderevery can move things in front of them, but
+# only things without side effects that matter; see opcost().)
+class Listener:
+	def __init__(self, lipn, lportn):
+		self.lipn = lipn
+		self.lportn = lportn
+	def getlipn(self):
+		return self.lipn
+	def getlportn(self):
+		return self.lportn
+def listenguard(node):
+	if isinstance(node, (matchers.LocalMatch, matchers.LIPAddrMatch)):
+		return node.eval
+	elif isinstance(node, (rdparse.AndNode, rdparse.ExceptNode)):
+		return listenguard(node.left)
+	elif isinstance(node, rdparse.OrNode):
+		gl = [listenguard(x) for x in node.ops]
+		if None in gl:
+			return None
+		def anyguard(l):
+			for g in gl:
+				if g(l):
+					return True
+			return False
+		return anyguard
+	return None
+
+# Similarly, ipguard() finds the ip: checks that a rule is guarded by,
+# and returns the (low, high) ranges of IP addresses that they can
+# match. Here we also look past the left side of an AND if it is free
+# to evaluate (which local: checks usually are).
+def isfree(node):
+	for m in rdparse.operands(node):
+		if opcost(m) != 0:
+			return False
+	return True
+def ipguard(node):
+	if isinstance(node, matchers.IPAddrMatch) and \
+	   not isinstance(node, matchers.LIPAddrMatch):
+		return node.ipranges()
+	elif isinstance(node, (rdparse.AndNode, rdparse.ExceptNode)):
+		g = ipguard(node.left)
+		if g is None and isinstance(node, rdparse.AndNode) and \
+		   isfree(node.left):
+			g = ipguard(node.right)
+		return g
+	elif isinstance(node, rdparse.OrNode):
+		res = []
+		for x in node.ops:
+			g = ipguard(x)
+			if g is None:
+				return None
+			res.extend(g)
+		return res
+	return None
+
+# An IPIndex maps a remote IP address to a bitmap of the rules (by
+# their position in the rules list) that can match it, going by their
+# ipguards. The IP address space is split into intervals at the ends
+# of every guard range; .find() gives the interval that an IP address
+# is in, and .bits[] is the bitmap for each interval.
+class IPIndex:
+	def __init__(self, rules):
+		# Each guard range turns its rule on at its start and
+		# off again after its end. A rule's ranges can overlap,
+		# so we keep count.
+		events = {0: []}
+		always = 0L
+		for n, r in enumerate(rules):
+			if r.ipguard is None:
+				always |= 1L << n
+				continue
+			for low, high in r.ipguard:
+				events.setdefault(low, []).append((n, 1))
+				if high < 0xffffffffL:
+					events.setdefault(high+1, []).append((n, -1))
+		self.starts = events.keys()
+		self.starts.sort()
+		self.bits = []
+		cur = always
+		cnt = {}
+		for s in self.starts:
+			for n, d in events[s]:
+				c = cnt.get(n, 0) + d
+				cnt[n] = c
+				if c == 0:
+					cur &= ~(1L << n)
+				else:
+					cur |= 1L << n
+			self.bits.append(cur)
+	def find(self, ipn):
+		return bisect.bisect_right(self.starts, ipn) - 1
+
 # All matches that match anything also append on to the match list a
 # match against a virtual global rule called GLOBAL. This simplifies
 # life downstream in the actions department.
@@ -110,10 +302,45 @@ def genfakerule(clsname):
 	return r
 globalrule = genfakerule("GLOBAL")
 
+# The results of evaluating the rules for a connection can be reused
+# for resultttl seconds for later connections from the same remote IP
+# address to the same listener, if nothing that was evaluated for the
+# first one could be different for them. Identd data and IP times
+# differ from connection to connection and the DNS breaker comes and
+# goes, so rules that look at them stop the result from being cached;
+# so do lookups that were cut short or that gave answers that are not
+# in hinfo's shared caches (see HostInfo.transient()), and a result
+# never outlives the cache entries that it came from. We keep at most
+# RESULTMAX results; they go away with the rules list when the rules
+# are reloaded.
+uncacheable = frozenset(('identd', 'iptimes', 'degraded'))
+resultttl = 0
+def setresultttl(ttl):
+	global resultttl
+	resultttl = ttl
+RESULTMAX = 10000
+
+CANDMAX = 10000
 class RulesList:
 	def __init__(self):
 		self.rules = []
 		self.havealways = 0
+		# All of the facets that any rule can ask for, and the
+		# order to start looking them up in when prefetching.
+		self.facets = frozenset()
+		self.plan = []
+		# (rule, AdaptiveOr) pairs, if we are adaptive.
+		self.ors = []
+		# See candidates().
+		self.ipindex = None
+		self.clear()
+		# Shared subtrees, the rules that use each of them, and
+		# the ones we memoize; see shareable().
+		self.shared = {}
+		self.users = {}
+		self.memo = set()
+		# See resultttl.
+		self.results = {}
 	def __len__(self):
 		return len(self.rules)
 	def __getitem__(self, key):
@@ -129,9 +356,105 @@ class RulesList:
 		# name, rather than duplicating it.
 		if len(self.rules) and self.rules[-1].clsname == rule.clsname:
 			rule.clsname = self.rules[-1].clsname
+		seen = []
+		rule.matcher = rdparse.hashcons(rule.matcher, self.shared,
+						shareable, seen)
+		# Rules that already use a subtree that is now shared
+		# must be recompiled to memoize it.
+		redo = []
+		for n in seen:
+			ul = self.users.setdefault(n, [])
+			if ul and n not in self.memo and worthmemo(n):
+				self.memo.add(n)
+				redo.extend([r for r in ul if r is not rule and \
+					     r not in redo])
+			ul.append(rule)
+		for r in redo:
+			self.compile(r)
+		self.compile(rule)
+		for kind, arg in rule.facets:
+			if kind in uncacheable:
+				rule.cacheable = 0
+		rule.guard = listenguard(rule.matcher)
+		rule.ipguard = ipguard(rule.matcher)
+		self.ipindex = None
+		self.clear()
 		self.rules.append(rule)
 		if rule.always:
 			self.havealways = 1
+		if not rule.facets.issubset(self.facets):
+			self.facets = self.facets.union(rule.facets)
+			self.plan = makeplan(self.facets)
+
+	def compile(self, rule):
+		if adaptive:
+			ors = []
+			rule.evalf = rdparse.compiletree(rule.matcher, opcost,
+							 cheapfirst, ors,
+							 self.memo)
+			self.ors = [x for x in self.ors if x[0] is not rule]
+			self.ors.extend([(rule, x) for x in ors])
+		else:
+			rule.evalf = rdparse.compiletree(rule.matcher, opcost,
+							 cheapfirst, None,
+							 self.memo)
+
+	# The list of rules that could match the connection, going by
+	# what listener it came in on and what IP address it came from.
+	# Each listener has a bitmap of the rules whose listener guards
+	# it passes, and that is ANDed with the IPIndex bitmap for the
+	# remote IP address to get the candidates. We remember the lists
+	# by listener and IP index interval, and share identical lists,
+	# up to CANDMAX of them.
+	def clear(self):
+		self.bylistener = {}
+		self.cands = {}
+		self.bybits = {}
+	def listenbits(self, lipn, lportn):
+		try:
+			return self.bylistener[(lipn, lportn)]
+		except KeyError:
+			pass
+		l = Listener(lipn, lportn)
+		bits = 0L
+		for n, r in enumerate(self.rules):
+			if r.guard is None or r.guard(l):
+				bits |= 1L << n
+		self.bylistener[(lipn, lportn)] = bits
+		return bits
+	def candidates(self, hi):
+		if self.ipindex is None:
+			self.ipindex = IPIndex(self.rules)
+		i = self.ipindex.find(hi.getipn())
+		key = (hi.getlipn(), hi.getlportn(), i)
+		try:
+			return self.cands[key]
+		except KeyError:
+			pass
+		bits = self.listenbits(key[0], key[1]) & self.ipindex.bits[i]
+		try:
+			rl = self.bybits[bits]
+		except KeyError:
+			rl = []
+			b, i = bits, 0
+			while b:
+				if not b & 0xff:
+					b >>= 8
+					i += 8
+					continue
+				if b & 1:
+					rl.append(self.rules[i])
+				b >>= 1
+				i += 1
+		if len(self.cands) >= CANDMAX:
+			self.clear()
+		self.bybits[bits] = rl
+		self.cands[key] = rl
+		return rl
+
+	def reorder(self):
+		for r, o in self.ors:
+			o.reorder()
 
 	def getclassnames(self):
 		cnd = {}
@@ -147,13 +470,25 @@ class RulesList:
 	# successful match of the class, all further rules for it
 	# are skipped.
 	def eval(self, hi):
+		key = None
+		if resultttl > 0 and not hi.classes:
+			key = (hi.getipn(), hi.getlipn(), hi.getlportn())
+			ent = self.results.get(key)
+			if ent and ent[1] >= time.time():
+				for r in ent[0]:
+					if r is not globalrule:
+						hi.addclass(r.clsname)
+				return list(ent[0])
+		cacheable = key is not None
 		matching = []
 		matched = 0
-		for r in self.rules:
+		for r in self.candidates(hi):
 			if (matched and not r.always) or \
 			       (r.clsname in hi.classes):
 				continue
-			res = r.matcher.eval(hi)
+			if not r.cacheable:
+				cacheable = 0
+			res = r.evalf(hi)
 			if res:
 				matching.append(r)
 				hi.addclass(r.clsname)
@@ -167,6 +502,13 @@ class RulesList:
 		# If we matched anything, we add 'GLOBAL' to the list.
 		if len(matching) > 0:
 			matching.append(globalrule)
+		if cacheable and not hi.transient():
+			if len(self.results) >= RESULTMAX:
+				self.results = {}
+			et = time.time() + resultttl
+			if hi.validuntil() is not None:
+				et = min(et, hi.validuntil())
+			self.results[key] = (list(matching), et)
 		return matching
 
 # Parse an entire file into a rules list, exploding on errors.
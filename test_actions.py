@@ -605,7 +605,7 @@ class testSeeOptions(unittest.TestCase):
 		for ipl, connl, lmsg in self.knownLimVals:
 			conntrack._clearmaps()
 			for i in range(0, ipl):
-				conntrack.up(i, rip, [])
+				conntrack.up(i, hi.getipn(), [])
 			for i in range(0, connl):
 				conntrack.up(i+100, 'NOIP', ['class50'])
 			r = aroot.genaction(hi, clsl)
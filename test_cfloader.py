@@ -14,13 +14,28 @@ class basicTests(unittest.TestCase):
 		("dropipafter 3600s", "dropipafter 3600s\n"),
 		("onfileerror drop", "onfileerror drop\n"),
 		("substitutions off", "substitutions off\n"),
+		("prefetch on", "prefetch on\n"),
 		("maxthreads 10", "maxthreads 10\n"),
+		("lookupbudget 750", "lookupbudget 750\n"),
+		("maxiptimes 100000", "maxiptimes 100000\n"),
+		("iptimesfile /var/run/pn.times", "iptimesfile /var/run/pn.times\n"),
+		("iptimessave 10m", "iptimessave 600s\n"),
+		("hostmap /etc/pn.hosts", "hostmap /etc/pn.hosts\n"),
+		("cachefile /var/run/pn.cache", "cachefile /var/run/pn.cache\n"),
+		("dnsttl 5m", "dnsttl 300s\n"),
+		("lognames on", "lognames on\n"),
+		("cheapfirst on", "cheapfirst on\n"),
+		("reorderevery 1m", "reorderevery 60s\n"),
+		("rulecachettl 10s", "rulecachettl 10s\n"),
 		("expireevery 10s", "expireevery 10s\n"),
 		('dropipafter 1m', 'dropipafter 60s\n'),
 		('dropipafter 1h', 'dropipafter 3600s\n'),
 		('dropipafter 1d', 'dropipafter 86400s\n'),
 		('expireevery -1s', 'expireevery -1s\n'),
 		("aftermaxthreads foobar", "aftermaxthreads foobar\n"),
+		("forwhnrefresh 10m", "forwhnrefresh 600s\n"),
+		("answersonttl 1h", "answersonttl 3600s\n"),
+		("answersonnegttl 0s", "answersonnegttl 0s\n"),
 		)
 	def testKnownLines(self):
 		"Test cfloader's direct parsing of known lines and the invertability of its output."
@@ -73,6 +88,8 @@ class failureTests(unittest.TestCase):
 		'onfileerror foobar',
 		'maxthreads abc',
 		'maxthreads',
+		'lookupbudget 1s',
+		'lookupbudget -1',
 		'expireevery abc',
 		'expireevery',
 		'expireevery 10',
@@ -154,6 +154,9 @@ class ConnBasics(unittest.TestCase):
 		conntrack.up(2, "127.0.0.4", ("test",))
 		self.assertEqual(str(conntrack.getpid(1)), "<CI: PID 1, IP 127.0.0.3, classes: abc def GLOBAL>")
 		self.assertEqual(str(conntrack.getpid(2)), "<CI: PID 2, IP 127.0.0.4, classes: test>")
+		# Numeric IP addresses are shown as strings.
+		conntrack.up(3, 0x7f000005, ("test",))
+		self.assertEqual(str(conntrack.getpid(3)), "<CI: PID 3, IP 127.0.0.5, classes: test>")
 
 if __name__ == "__main__":
 	unittest.main()
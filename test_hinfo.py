@@ -2,10 +2,13 @@
 # This requires a bunch of shimming to actually test, and some of it is
 # impossible. Life is like that.
 import hinfo
-import socket
+import socket, threading, time, os, tempfile
 from errno import *
 import unittest
 import netblock
+import hostmap
+import msgs
+import StringIO
 
 from testutils import *
 
@@ -22,6 +25,8 @@ class basicTests(unittest.TestCase):
 		self.assertEqual(hi.getipn(), ln)
 		ln2 = netblock.strtoip('127.0.0.1')
 		self.assertEqual(hi.getlipn(), ln2)
+		self.assertEqual(hi.getlportn(), 1000)
+		self.assertEqual(hinfo.iptoint('255.255.255.254'), 0xfffffffeL)
 
 	# Each tuple is what-to-add and what-the-result-should-be.
 	# The thing is cumulative.
@@ -87,14 +92,14 @@ class shimTests(unittest.TestCase):
 	def setUp(self):
 		self.ghba = hinfo.socket.gethostbyaddr
 		self.ghbne = hinfo.socket.gethostbyname_ex
-		self.idc = hinfo.idclient.ident
+		self.idc = hinfo.idclient.queryident
 		hinfo.socket.gethostbyaddr = mygethbaddr
 		hinfo.socket.gethostbyname_ex = mygethbname
-		hinfo.idclient.ident = myidentd
+		hinfo.idclient.queryident = myqueryident
 	def tearDown(self):
 		hinfo.socket.gethostbyaddr = self.ghba
 		hinfo.socket.gethostbyname_ex = self.ghbne
-		hinfo.idclient.ident = self.idc
+		hinfo.idclient.queryident = self.idc
 	knownValues = (
 		('127.0.0.100', 'noforward', '127.0.0.100', None),
 		('127.0.0.101', 'noforward', 'not-a-forward', None),
@@ -122,6 +127,301 @@ class shimTests(unittest.TestCase):
 			self.assertEqual(p.getidentd(),
 					 myidentd(0, port, 0, 0, None))
 
+	def testNegativeIdentd(self):
+		"Test that hosts without a reachable identd are not queried again."
+		hinfo.flushcaches()
+		h0, m0 = hinfo.identstats()
+		p = makehi(rip = '127.0.0.50', rport = 202)
+		self.assertEqual(p.getidentd(), None)
+		self.assertEqual(hinfo.identstats(), (h0, m0+1))
+		p = makehi(rip = '127.0.0.50', rport = 202)
+		self.assertEqual(p.getidentd(), None)
+		self.assertEqual(hinfo.identstats(), (h0+1, m0+1))
+		# Hosts that answer are not remembered.
+		for i in range(2):
+			p = makehi(rip = '127.0.0.52', rport = 202)
+			self.assertEqual(p.getidentd(), 'cks')
+		self.assertEqual(hinfo.identstats(), (h0+1, m0+3))
+		self.assertEqual(len(hinfo.idnegcache), 1)
+		hinfo.flushcaches()
+
+	def testStartIdent(self):
+		"Test that identd queries started early are used and remembered."
+		class FakeQuery:
+			def __init__(self, res):
+				self.res = res
+			def wait(self):
+				if self.res is None:
+					raise hinfo.idclient.NoIdentd
+				return self.res
+		class FakeEngine:
+			def __init__(self):
+				self.subs = []
+			def submit(self, rh, rp, lh, lp, wait):
+				self.subs.append(rh)
+				return FakeQuery(myidentd(rh, rp, lh, lp, wait) or None)
+		hinfo.flushcaches()
+		eng = FakeEngine()
+		hinfo.identengine = eng
+		try:
+			p = makehi(rip = '127.0.0.60', rport = 202)
+			p.startident()
+			p.startident()
+			self.assertEqual(p.getidentd(), 'cks')
+			p = makehi(rip = '127.0.0.61', rport = 204)
+			p.startident()
+			self.assertEqual(p.getidentd(), None)
+			# The second host is now known to have no identd.
+			p = makehi(rip = '127.0.0.61', rport = 204)
+			p.startident()
+			self.assertEqual(p.getidentd(), None)
+			self.assertEqual(eng.subs, ['127.0.0.60', '127.0.0.61'])
+		finally:
+			hinfo.identengine = None
+			hinfo.flushcaches()
+
+	def testPrefetch(self):
+		"Test that prefetched lookups are used and give the right answers."
+		plan = [('hostname', None), ('dnsbl', '.dnsbl1')]
+		hinfo.setprefetch(0)
+		p = makehi(rip = '127.0.0.103')
+		p.prefetch(plan)
+		self.assertEqual(p._pend, {})
+		hinfo.prefetching = 1
+		try:
+			p = makehi(rip = '127.0.0.103')
+			p.prefetch(plan)
+			self.assertEqual(p._pend.has_key('hostname'), 1)
+			self.assertEqual(p.gethostname(), 'is-a-good-name')
+			self.assertEqual(p.gethnstate(), 'good')
+			self.assertEqual(p._pend.has_key('hostname'), 0)
+			p = makehi(rip = '8.7.6.5')
+			p.prefetch(plan)
+			self.assertEqual(p.gethostips('5.6.7.8.dnsbl1'), ['127.0.0.3'])
+			self.assertEqual(p._pend.keys(), ['hostname'])
+			self.assertEqual(p.gethostname(), None)
+		finally:
+			hinfo.prefetching = 0
+
+	def testBudget(self):
+		"Test that lookups stop waiting once the lookup budget is used up."
+		ev = threading.Event()
+		def slowgethbaddr(ip):
+			ev.wait()
+			return mygethbaddr(ip)
+		hinfo.socket.gethostbyaddr = slowgethbaddr
+		hinfo.lookuptimeouts.clear()
+		try:
+			p = makehi(rip = '127.0.0.103', rport = 202)
+			p.setbudget(0.05)
+			self.assertEqual(p.gethnstate(), 'unknown')
+			self.assertEqual(p.gethostname(), None)
+			# Out of budget lookups don't even start.
+			self.assertEqual(p.gethostips('is-a-good-name'), [])
+			self.assertEqual(p.getidentd(), None)
+			self.assertEqual(hinfo.timeoutstats(),
+					 [('dnsbl', 1), ('hostname', 1), ('identd', 1)])
+			# Asking again doesn't count again.
+			self.assertEqual(p.gethnstate(), 'unknown')
+			self.assertEqual(hinfo.timeoutstats(),
+					 [('dnsbl', 1), ('hostname', 1), ('identd', 1)])
+			# The defaults were only for the budget; once it is
+			# lifted, we get real answers.
+			ev.set()
+			p.setbudget(None)
+			self.assertEqual(p.gethostname(), 'is-a-good-name')
+			self.assertEqual(p.gethostips('is-a-good-name'), ['127.0.0.103'])
+			self.assertEqual(p.getidentd(), 'cks')
+			# Lookups within the budget work normally.
+			p = makehi(rip = '127.0.0.103', rport = 202)
+			p.setbudget(5)
+			self.assertEqual(p.gethostname(), 'is-a-good-name')
+			self.assertEqual(p.getidentd(), 'cks')
+			self.assertEqual(hinfo.timeoutstats(),
+					 [('dnsbl', 1), ('hostname', 1), ('identd', 1)])
+			# Identds that answer without a user ID, or that
+			# can't be reached, haven't run out of budget.
+			for ip, port in (('127.0.0.103', 201), ('127.0.0.50', 202)):
+				p = makehi(rip = ip, rport = port)
+				p.setbudget(hinfo.IDENTDTIMEOUT / 2)
+				self.assertEqual(p.getidentd(), None)
+				self.assertEqual(p.transient(), False)
+			self.assertEqual(hinfo.timeoutstats(),
+					 [('dnsbl', 1), ('hostname', 1), ('identd', 1)])
+		finally:
+			ev.set()
+			hinfo.lookuptimeouts.clear()
+
+	def testSingleFlight(self):
+		"Test that concurrent identical lookups share one query."
+		ev = threading.Event()
+		calls = []
+		def slowgethbaddr(ip):
+			calls.append(ip)
+			ev.wait()
+			return mygethbaddr(ip)
+		hinfo.socket.gethostbyaddr = slowgethbaddr
+		base = hinfo.flightstats()
+		try:
+			ls = [hinfo.Lookup(None, hinfo.singleflight,
+					   hinfo.getipname, '127.0.0.103')
+			      for i in range(5)]
+			while hinfo.flightstats() < base + 4:
+				time.sleep(0.01)
+			ev.set()
+			for l in ls:
+				self.assertEqual(l.get(), ('good', 'is-a-good-name'))
+			self.assertEqual(calls, ['127.0.0.103'])
+			self.assertEqual(hinfo.inflight, {})
+			# Once the lookup is done, it is done again.
+			p = makehi(rip = '127.0.0.103')
+			self.assertEqual(p.gethostname(), 'is-a-good-name')
+			self.assertEqual(len(calls), 2)
+		finally:
+			ev.set()
+
+	def testLookupPool(self):
+		"Test that too many outstanding lookups are refused."
+		ev = threading.Event()
+		def slow(x):
+			ev.wait()
+			return x
+		omax = hinfo.LOOKUPMAX
+		hinfo.LOOKUPMAX = hinfo.lookuppool.pending + 2
+		base = hinfo.lookupstats()[1]
+		try:
+			ls = [hinfo.Lookup(None, slow, i) for i in range(3)]
+			self.assertEqual(ls[2].finished(), False)
+			self.assertEqual(ls[2].get(), None)
+			self.assertEqual(hinfo.lookupstats()[1], base + 1)
+			ev.set()
+			self.assertEqual([l.get() for l in ls[:2]], [0, 1])
+			self.assertEqual(ls[0].finished(), True)
+		finally:
+			ev.set()
+			hinfo.LOOKUPMAX = omax
+
+	def testTimedFlight(self):
+		"Test that callers with different timeouts share a flight but wait only as long as they can."
+		ev = threading.Event()
+		calls = []
+		def slow(x, timeout):
+			calls.append((x, timeout))
+			ev.wait()
+			return x
+		base = hinfo.flightstats()
+		try:
+			l = hinfo.Lookup(None, hinfo.timedflight, 5, slow, 1)
+			while not calls:
+				time.sleep(0.01)
+			self.assertEqual(hinfo.timedflight(0.05, slow, 1), None)
+			w = hinfo.Lookup(None, hinfo.timedflight, 2, slow, 1)
+			while hinfo.flightstats() < base + 2:
+				time.sleep(0.01)
+			ev.set()
+			self.assertEqual(l.get(), (1, 5))
+			self.assertEqual(w.get(), (1, 5))
+			self.assertEqual(calls, [(1, 5)])
+		finally:
+			ev.set()
+
+	def testHostMap(self):
+		"Test that the host map is used instead of the DNS."
+		hm = hostmap.fromfile(StringIO.StringIO("127.0.0.0/24 mapped.example.com\n"), "<t>")
+		hinfo.sethostmap(hm)
+		try:
+			p = makehi(rip = '127.0.0.103')
+			self.assertEqual(p.gethostname(), 'mapped.example.com')
+			self.assertEqual(p.gethnstate(), 'good')
+			self.assertEqual(p.getinfo()['hostname'], 'mapped.example.com')
+			p = makehi(rip = '127.0.1.1')
+			self.assertEqual(p.gethostname(), 'franklin.com')
+		finally:
+			hinfo.sethostmap(None)
+
+	def testBreaker(self):
+		"Test that DNS trouble trips the breaker and that it resets."
+		def badgethbaddr(ip):
+			raise socket.herror, (2, "Host name lookup failure")
+		hinfo.socket.gethostbyaddr = badgethbaddr
+		oprobe = hinfo.BREAKPROBE
+		hinfo.BREAKPROBE = 0.01
+		try:
+			for i in range(hinfo.BREAKMIN):
+				self.assertEqual(hinfo.dnsdegraded(), False)
+				p = makehi(rip = '127.0.0.103')
+				self.assertEqual(p.gethnstate(), 'unknown')
+			self.assertEqual(hinfo.dnsdegraded(), True)
+			# Lookups are now skipped entirely.
+			hinfo.socket.gethostbyaddr = mygethbaddr
+			p = makehi(rip = '127.0.0.103')
+			self.assertEqual(p.dnsdegraded(), True)
+			self.assertEqual(p.gethostips('is-a-good-name'), [])
+			self.assertEqual(hinfo.breakerstats()[2] >= 1, True)
+			# The prober notices that the DNS is back.
+			for i in range(500):
+				if not hinfo.dnsdegraded():
+					break
+				time.sleep(0.01)
+			self.assertEqual(hinfo.dnsdegraded(), False)
+			p = makehi(rip = '127.0.0.103')
+			self.assertEqual(p.gethostname(), 'is-a-good-name')
+		finally:
+			hinfo.BREAKPROBE = oprobe
+			hinfo.breaker.reset()
+
+	def testDNSCaches(self):
+		"Test that definite DNS answers are shared and survive a save and load."
+		calls = []
+		def countgethbaddr(ip):
+			calls.append(ip)
+			return mygethbaddr(ip)
+		def badgethbaddr(ip):
+			raise socket.herror, (2, "Host name lookup failure")
+		hinfo.socket.gethostbyaddr = countgethbaddr
+		hinfo.setdnsttls(300, 60)
+		fname = tempfile.mktemp()
+		try:
+			for i in range(2):
+				p = makehi(rip = '127.0.0.103')
+				self.assertEqual(p.gethostname(), 'is-a-good-name')
+				self.assertEqual(p.transient(), False)
+				p = makehi(rip = '127.0.0.104')
+				self.assertEqual(p.gethnstate(), 'unknown')
+				self.assertEqual(p.gethostips('is-a-good-name'), ['127.0.0.103'])
+			self.assertEqual(calls, ['127.0.0.103', '127.0.0.104'])
+			# Trouble is not remembered.
+			hinfo.socket.gethostbyaddr = badgethbaddr
+			p = makehi(rip = '127.0.0.105')
+			self.assertEqual(p.gethnstate(), 'unknown')
+			self.assertEqual(p.transient(), True)
+			self.assertEqual(dict(hinfo.cachesizes())['hostname'], 2)
+			self.assertEqual(hinfo.savecaches(fname), 3)
+			hinfo.flushcaches()
+			self.assertEqual(hinfo.loadcaches(fname), 3)
+			# These now come from the cache, not the DNS.
+			p = makehi(rip = '127.0.0.103')
+			self.assertEqual(p.gethostname(), 'is-a-good-name')
+			open(fname, "w").write("garbage")
+			self.assertRaises(ValueError, hinfo.loadcaches, fname)
+		finally:
+			hinfo.setdnsttls(0, 0)
+			hinfo.flushcaches()
+			hinfo.breaker.reset()
+			os.unlink(fname)
+
+	def testConnIds(self):
+		"Test that connections get distinct IDs for log messages."
+		p1 = makehi(rip = '127.0.0.103')
+		p2 = makehi(rip = '127.0.0.103')
+		self.assertEqual(p2.getconnid() > p1.getconnid(), True)
+		self.assertEqual(p1.getinfo()['connid'], p1.getconnid())
+		self.assertEqual(p1.hnknown(), False)
+		p1.gethostname()
+		self.assertEqual(p1.hnknown(), True)
+		self.assertEqual(msgs.format(msgs.loghostname, p1, None),
+				 "hostname: connection %d from 127.0.0.103 is is-a-good-name (good)" % (p1.getconnid(),))
+
 	def testPrettyPrint(self):
 		"Test the pretty-print output of remote connection information."
 		hi = hinfo.frompairs(('127.0.0.1', 100),
@@ -155,11 +455,16 @@ class shimTests(unittest.TestCase):
 		d = hi.getinfo()
 		self.assertEqual(d['hostname'], '127.0.0.103')
 		self.assertEqual(d['connsum'], '127.0.0.103')
+		self.assertRaises(KeyError, lambda: d['identd'])
+		self.assertEqual('identd' in d, False)
+		self.assertEqual(hi.getinfo() is d, True)
 		# Fill all the info sources, then refetch the dict.
 		hi.getfirsttime(); hi.gethostname(); hi.getidentd()
 		d = hi.getinfo()
 		for k, v in self.knownInfoVals:
 			self.assertEqual(d[k], v)
+		# Plus connid, which varies.
+		self.assertEqual(len(d.keys()), len(self.knownInfoVals) + 1)
 
 	def testGetLower(self):
 		"Test that the gethostname_l() and getclaimedhn_l() routines work."
@@ -169,6 +474,59 @@ class shimTests(unittest.TestCase):
 		self.assertEqual(hi.getclaimedhn(), "BIGBUCKS.SMACK.COM")
 		self.assertEqual(hi.getclaimedhn_l(), "bigbucks.smack.com")
 		
+class forwCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.ghbne = hinfo.socket.gethostbyname_ex
+		hinfo.socket.gethostbyname_ex = mygethbname
+		self.fc = hinfo.ForwardCache()
+	def tearDown(self):
+		hinfo.socket.gethostbyname_ex = self.ghbne
+
+	def testRegisterLookup(self):
+		"Test that registered forwhn: names are resolved immediately."
+		self.fc.register('franklin.com')
+		self.fc.register('not-there-at-all')
+		self.assertEqual(self.fc.lookup('franklin.com'),
+				 frozenset(['127.0.1.1']))
+		self.assertEqual(self.fc.lookup('not-there-at-all'),
+				 frozenset())
+		self.assertEqual(self.fc.lookup('never-registered'), None)
+
+	def testAging(self):
+		"Test that aging keeps only the names of the latest generation."
+		self.fc.register('franklin.com')
+		self.fc.age()
+		self.assertEqual(len(self.fc), 1)
+		self.fc.register('localhost')
+		self.fc.age()
+		self.assertEqual(self.fc.lookup('franklin.com'), None)
+		self.assertEqual(self.fc.lookup('localhost'),
+				 frozenset(['127.0.0.1']))
+		# A discarded generation leaves the live one alone.
+		self.fc.register('franklin.com')
+		self.fc.discard()
+		self.assertEqual(self.fc.lookup('franklin.com'), None)
+		self.assertEqual(len(self.fc), 1)
+
+	def testRefresh(self):
+		"Test that stale entries are refreshed and that failures keep old answers."
+		self.fc.setrefresh(0)
+		self.fc.register('franklin.com')
+		self.fc.register('localhost')
+		self.fc.age()
+		nametoip['franklin.com'] = ['127.0.1.10']
+		iplist = nametoip['localhost']
+		del nametoip['localhost']
+		try:
+			self.fc.refreshall()
+		finally:
+			nametoip['franklin.com'] = ['127.0.1.1']
+			nametoip['localhost'] = iplist
+		self.assertEqual(self.fc.lookup('franklin.com'),
+				 frozenset(['127.0.1.10']))
+		self.assertEqual(self.fc.lookup('localhost'),
+				 frozenset(['127.0.0.1']))
+
 # Shim calls to get the current time.
 curtime = 0
 def settime(t):
@@ -255,6 +613,82 @@ class testConnAge(unittest.TestCase):
 		hinfo.expireiptimes()
 		self.assertEqual(hinfo.iptimessize(), 3)
 
+	def testIncrementalExpiry(self):
+		"Test that expiry can be done a bit at a time and without scanning recent entries."
+		hinfo.setiptimesdur(600)
+		try:
+			settime(1000)
+			for ip in netblock.IPRanges('127.0.0.0/28'):
+				makehi(rip = ip).getfirsttime()
+			settime(1500)
+			makehi(rip = '127.0.0.1').getfirsttime()
+			settime(1700)
+			self.assertEqual(hinfo.expireiptimes(5), True)
+			self.assertEqual(hinfo.iptimessize(), 12)
+			self.assertEqual(hinfo.expireiptimes(5), True)
+			self.assertEqual(hinfo.expireiptimes(10), False)
+			self.assertEqual(hinfo.iptimessize(), 1)
+			self.assertEqual(makehi(rip = '127.0.0.1').getfirsttime(), 700)
+			self.assertEqual(makehi(rip = '127.0.0.2').getfirsttime(), 0)
+			self.assertEqual(hinfo.expireiptimes(), False)
+			self.assertEqual(hinfo.iptimessize(), 2)
+		finally:
+			hinfo.setiptimesdur(None)
+
+	def testMaxEntries(self):
+		"Test that the least recently seen entries are shed when over the cap."
+		hinfo.setiptimesmax(3)
+		try:
+			for i, ip in enumerate(('127.0.0.1', '127.0.0.2', '127.0.0.3',
+						'127.0.0.4', '127.0.0.5')):
+				settime(1000 + i*100)
+				makehi(rip = ip).getfirsttime()
+			settime(1500)
+			makehi(rip = '127.0.0.1').getfirsttime()
+			settime(2000)
+			self.assertEqual(hinfo.iptimesfull(), True)
+			hinfo.expireiptimes()
+			self.assertEqual(hinfo.iptimesfull(), False)
+			self.assertEqual(hinfo.iptimessize(), 3)
+			self.assertEqual(makehi(rip = '127.0.0.1').getfirsttime(), 1000)
+			self.assertEqual(makehi(rip = '127.0.0.3').getfirsttime(), 0)
+			self.assertEqual(makehi(rip = '127.0.0.4').getfirsttime(), 700)
+		finally:
+			hinfo.setiptimesmax(None)
+
+	def testSnapshot(self):
+		"Test that IP times survive being saved and loaded."
+		fname = tempfile.mktemp()
+		try:
+			settime(1000)
+			for ip in netblock.IPRanges('128.100.0.0/28'):
+				makehi(rip = ip).getfirsttime()
+			settime(1200)
+			makehi(rip = '128.100.0.1').getfirsttime()
+			self.assertEqual(hinfo.saveiptimes(fname), 16)
+			hinfo.cleariptimes()
+			self.assertEqual(hinfo.loadiptimes(fname), 16)
+			self.assertEqual(hinfo.iptimessize(), 16)
+			settime(1300)
+			hi = makehi(rip = '128.100.0.1')
+			self.assertEqual(hi.getfirsttime(), 300)
+			self.assertEqual(hi.getlasttime(), 100)
+			# The expiry queue comes back too.
+			hinfo.setiptimesdur(200)
+			hinfo.expireiptimes()
+			self.assertEqual(hinfo.iptimessize(), 1)
+			# Damaged snapshots are refused.
+			data = open(fname).read()
+			open(fname, "w").write(data[:-3])
+			self.assertRaises(ValueError, hinfo.loadiptimes, fname)
+			open(fname, "w").write("PNIT")
+			self.assertRaises(ValueError, hinfo.loadiptimes, fname)
+			open(fname, "w").write("")
+			self.assertRaises(ValueError, hinfo.loadiptimes, fname)
+		finally:
+			hinfo.setiptimesdur(None)
+			os.unlink(fname)
+
 	knownIPRanges = (
 		'0.0.0.0/24',
 		'127.255.255.0/24',
@@ -320,7 +754,104 @@ class sockShimTests(unittest.TestCase):
 			hi = makehi()
 			hinfo.select.select = selectfactory(tmo)
 			hinfo.socket.socket = socketfactory(cR, rR)
+			hinfo.flushcaches()
 			self.assertEqual(hi.answerson(10), res)
 
+	def testSharedAnswers(self):
+		"Test that answerson results are shared between connections and expire."
+		hinfo.flushcaches()
+		hinfo.setanswersonttls(60, 0)
+		try:
+			hinfo.select.select = selectfactory(0)
+			hinfo.socket.socket = socketfactory(EAGAIN, "a")
+			st = time.time()
+			hi = makehi()
+			self.assertEqual(hi.answerson(25), True)
+			self.assertEqual(hi.transient(), False)
+			self.assert_(st + 60 <= hi.validuntil() <= time.time() + 60)
+			# Now every probe would fail, but we don't probe.
+			hinfo.socket.socket = socketfactory(ECONNREFUSED, EAGAIN)
+			self.assertEqual(makehi().answerson(25), True)
+			# Failures are not remembered with a zero negative
+			# TTL, so they only hold for this connection.
+			hi = makehi()
+			self.assertEqual(hi.answerson(26), False)
+			self.assertEqual(hi.transient(), True)
+			self.assertEqual(len(hinfo.anscache), 1)
+		finally:
+			hinfo.setanswersonttls(hinfo.ANSWERSONTTL,
+					       hinfo.ANSWERSONNEGTTL)
+			hinfo.flushcaches()
+
+	def testManyPorts(self):
+		"Test that several ports are probed together and all results kept."
+		hinfo.flushcaches()
+		hinfo.select.select = selectfactory(0)
+		hinfo.socket.socket = socketfactory(ECONNREFUSED, EAGAIN)
+		hi = makehi()
+		self.assertEqual(hi.answersonany((10, 20, 30)), False)
+		self.assertEqual(hi._anscache, {10: False, 20: False, 30: False})
+		self.assertEqual(hinfo.canconnectmany('1.1.1.1', (1, 2)),
+				 {1: False, 2: False})
+		hinfo.flushcaches()
+
+class ttlCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.otime = hinfo.time.time
+		hinfo.time.time = gettime
+	def tearDown(self):
+		hinfo.time.time = self.otime
+	def testTTLs(self):
+		"Test that TTLCache keeps positive and negative answers for their own lifetimes."
+		settime(1000)
+		tc = hinfo.TTLCache(100, 10)
+		tc.put('a', True)
+		tc.put('b', False)
+		self.assertEqual(tc.get('a'), True)
+		self.assertEqual(tc.get('b'), False)
+		self.assertRaises(KeyError, tc.get, 'c')
+		advtime(50)
+		self.assertEqual(tc.get('a'), True)
+		self.assertRaises(KeyError, tc.get, 'b')
+		self.assertEqual(len(tc), 2)
+		tc.expire()
+		self.assertEqual(len(tc), 1)
+		# Zero lifetimes are not cached at all.
+		tc.setttls(0, 0)
+		tc.put('d', True)
+		self.assertRaises(KeyError, tc.get, 'd')
+
+	def testSnapshot(self):
+		"Test that TTLCache snapshots keep only entries that are still current."
+		settime(1000)
+		tc = hinfo.TTLCache(100, 10)
+		tc.put('a', True)
+		tc.put('b', False)
+		tc.put('c', ('unknown', None), False)
+		snap = tc.snapshot()
+		advtime(50)
+		tc = hinfo.TTLCache(100, 10)
+		self.assertEqual(tc.restore(snap), 1)
+		self.assertEqual(tc.get('a'), True)
+		self.assertRaises(KeyError, tc.get, 'c')
+		# Entries can't outlive our current lifetimes.
+		tc = hinfo.TTLCache(20, 10)
+		tc.restore(snap)
+		advtime(30)
+		self.assertRaises(KeyError, tc.get, 'a')
+		# Including negative entries, whose lifetime is their own.
+		settime(1000)
+		tc = hinfo.TTLCache(100, 60)
+		tc.put('n', False)
+		snap = tc.snapshot()
+		tc = hinfo.TTLCache(100, 5)
+		self.assertEqual(tc.restore(snap), 1)
+		self.assertEqual(tc.get('n'), False)
+		advtime(10)
+		self.assertRaises(KeyError, tc.get, 'n')
+		# Nothing is restored into a cache that doesn't keep it.
+		tc = hinfo.TTLCache(100, 0)
+		self.assertEqual(tc.restore(snap), 0)
+
 if __name__ == "__main__":
 	unittest.main()
@@ -0,0 +1,57 @@
+#
+# Test the host map loader and lookups.
+import hostmap
+import netblock
+import unittest
+from StringIO import StringIO
+
+testfile = """# A test host map.
+10.0.0.0/8	internal.example.com
+10.1.2.3	build.example.com
+10.1.0.0/16	lab.example.com	noforward
+192.168.0.0/16	-	unknown
+0.0.0.0/0	the-internet
+"""
+
+class basicTests(unittest.TestCase):
+	knownLookups = (
+		('10.200.0.1', ('good', 'internal.example.com')),
+		('10.1.2.3', ('good', 'build.example.com')),
+		('10.1.2.4', ('noforward', 'lab.example.com')),
+		('192.168.10.10', ('unknown', None)),
+		('127.0.0.1', ('good', 'the-internet')),
+		)
+	def testLookups(self):
+		"Test that lookups find the most specific entry."
+		hm = hostmap.fromfile(StringIO(testfile), "<t>")
+		self.assertEqual(len(hm), 5)
+		for ip, res in self.knownLookups:
+			self.assertEqual(hm.lookup(netblock.strtoip(ip)), res)
+		hm = hostmap.fromfile(StringIO("10.0.0.0/8 a.b\n"), "<t>")
+		self.assertEqual(hm.lookup(netblock.strtoip('11.0.0.1')), None)
+
+	def testLastWins(self):
+		"Test that a repeated netblock uses the last entry."
+		hm = hostmap.fromfile(StringIO("10.0.0.0/8 a\n10.0.0.0/8 b\n"), "<t>")
+		self.assertEqual(hm.lookup(netblock.strtoip('10.0.0.1')),
+				 ('good', 'b'))
+
+	knownBadLines = (
+		"10.0.0.1",
+		"10.0.0.1 a good extra",
+		"10.0.0.1 a bogus",
+		"10.0.0.1 - good",
+		"10.0.0.1 a unknown",
+		"10.0.0.1/8 a",
+		"10.0.0 a",
+		"10.0.0.256 a",
+		"foobar a",
+		)
+	def testBadLines(self):
+		"Test that bad host map lines are rejected."
+		for l in self.knownBadLines:
+			self.assertRaises(hostmap.BadInput, hostmap.fromfile,
+					  StringIO(l+"\n"), "<t>")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,109 @@
+#
+# Test the identd client against a tiny fake identd of our own, which
+# listens on a random local port instead of the real identd port.
+import idclient
+import socket, thread, time
+import unittest
+
+# Our fake identd answers each connection with 'reply', or with
+# nothing at all if 'reply' is None.
+class FakeIdentd:
+	def __init__(self, reply):
+		self.reply = reply
+		self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.s.bind(('127.0.0.1', 0))
+		self.s.listen(10)
+		self.port = self.s.getsockname()[1]
+		self.held = []
+		thread.start_new_thread(self.serve, ())
+	def serve(self):
+		while 1:
+			try:
+				c = self.s.accept()[0]
+			except socket.error:
+				return
+			q = c.recv(100)
+			if self.reply is None:
+				self.held.append(c)
+				continue
+			ports = q.strip()
+			c.send("%s : %s\r\n" % (ports, self.reply))
+			c.close()
+	def close(self):
+		self.s.close()
+
+# Find a local port that nothing is listening on.
+def deadport():
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+class replyTests(unittest.TestCase):
+	knownReplies = (
+		("1, 2 : USERID : UNIX : cks\r\n", "cks"),
+		("1, 2 : ERROR : NO-USER\r\n", None),
+		("1, 2 : USERID : UNIX : cks", None),
+		("1, 2 : USERID : UNIX : a\r\nb\r\n", "a"),
+		)
+	def testParseReply(self):
+		"Test the parsing of identd replies."
+		for l, res in self.knownReplies:
+			self.assertEqual(idclient.parsereply(l), res)
+
+class engineTests(unittest.TestCase):
+	def setUp(self):
+		self.eng = idclient.IdentEngine()
+		self.eng.start()
+	def testAnswers(self):
+		"Test that the engine gets answers from an identd."
+		fi = FakeIdentd("USERID : UNIX : cks")
+		ql = [self.eng.submit('127.0.0.1', 1000+i, '127.0.0.1', 22,
+				      2, fi.port) for i in range(5)]
+		for q in ql:
+			self.assertEqual(q.wait(), 'cks')
+		fi.close()
+	def testRefused(self):
+		"Test that an unreachable identd raises NoIdentd."
+		q = self.eng.submit('127.0.0.1', 1000, '127.0.0.1', 22, 2,
+				    deadport())
+		self.assertRaises(idclient.NoIdentd, q.wait)
+	def testTimeout(self):
+		"Test that a silent identd times out with no answer, all at once."
+		fi = FakeIdentd(None)
+		st = time.time()
+		ql = [self.eng.submit('127.0.0.1', 1000+i, '127.0.0.1', 22,
+				      0.3, fi.port) for i in range(5)]
+		for q in ql:
+			self.assertEqual(q.wait(), None)
+		self.assert_(time.time() - st < 1.0)
+		fi.close()
+
+	def testStuck(self):
+		"Test that waiting gives up on a query that the engine never finishes."
+		q = idclient.Query('127.0.0.1', 1000, '127.0.0.1', 22, 0.1)
+		st = time.time()
+		self.assertEqual(q.wait(), None)
+		self.assert_(time.time() - st < idclient.WAITSLACK + 1)
+	def testEngineError(self):
+		"Test that the engine survives errors and gives up on its queries."
+		errs = []
+		eng = idclient.IdentEngine(errs.append)
+		def badstep(active):
+			eng.step = lambda a: idclient.IdentEngine.step(eng, a)
+			raise ValueError, "filedescriptor out of range in select()"
+		eng.step = badstep
+		q = eng.submit('127.0.0.1', 1000, '127.0.0.1', 22, 2, deadport())
+		eng.start()
+		self.assertEqual(q.wait(), None)
+		self.assertEqual(eng.errors, 1)
+		self.assertEqual(errs, ["identd engine error: ValueError: filedescriptor out of range in select()"])
+		# The engine still works afterward.
+		fi = FakeIdentd("USERID : UNIX : cks")
+		q = eng.submit('127.0.0.1', 1000, '127.0.0.1', 22, 2, fi.port)
+		self.assertEqual(q.wait(), 'cks')
+		fi.close()
+
+if __name__ == "__main__":
+	unittest.main()
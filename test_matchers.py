@@ -21,6 +21,11 @@ class tUtils(unittest.TestCase):
 			hi = makehi(rip = iaddr)
 			self.assertEqual(mo.eval(hi), res,
 					 "failed for %s/%s" % (iaddr, val))
+			# The compiled form must agree.
+			hi = makehi(rip = iaddr)
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)),
+					 bool(res),
+					 "compiled failed for %s/%s" % (iaddr, val))
 	def genfinal(self, name, val):
 		mfactory = matchers.MatchInfo.terminals[name]
 		mo = mfactory(name, val)
@@ -42,6 +47,9 @@ class testSimpleMatchers(tUtils):
 		('127.0.0.1', '127.0.0.2', 0),
 		('127.0.0.1', '127.0.0.', 1),
 		('127.1.0.0', '127.0.', 0),
+		('127.1.200.9', '127.1.', 1),
+		('127.10.0.1', '127.1.', 0),
+		('255.255.1.1', '255.255.', 1),
 		('142.151.255.255', '142.150.0.0/15', 1),
 		('142.152.0.0', '142.150.0.0/15', 0),
 		# Make sure the low-hi syntax is recognized.
@@ -79,6 +87,10 @@ class testSimpleMatchers(tUtils):
 		('127.0.0.1', 100, '100@127.0.0.1', 1),
 		('128.100.102.51', 100, '127.0.0.1', 0),
 		('128.100.102.51', 100, '*@128.100.102.51', 1),
+		# Leading zeros are decimal, the same as everywhere else.
+		('10.0.0.1', 100, '100@010.0.0.1', 1),
+		('8.0.0.1', 100, '100@010.0.0.1', 0),
+		('9.1.1.1', 100, '09.1.1.1', 1),
 		)
 	def testLocalMatcher(self):
 		"Test the local: matcher against a series of known values."
@@ -87,6 +99,7 @@ class testSimpleMatchers(tUtils):
 			hi = hinfo.frompairs((ip, port),
 					     ('0.0.0.0', '100'))
 			self.assertEqual(mo.eval(hi), res)
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)), bool(res))
 
 
 	# In the presence of finalization, this is now kind of ugly. It would
@@ -151,14 +164,14 @@ class Shimit(tUtils):
 	def setUp(self):
 		self.ghba = hinfo.socket.gethostbyaddr
 		self.ghbne = hinfo.socket.gethostbyname_ex
-		self.idc = hinfo.idclient.ident
+		self.idc = hinfo.idclient.queryident
 		hinfo.socket.gethostbyaddr = mygethbaddr
 		hinfo.socket.gethostbyname_ex = mygethbname
-		hinfo.idclient.ident = myidentd
+		hinfo.idclient.queryident = myqueryident
 	def tearDown(self):
 		hinfo.socket.gethostbyaddr = self.ghba
 		hinfo.socket.gethostbyname_ex = self.ghbne
-		hinfo.idclient.ident = self.idc
+		hinfo.idclient.queryident = self.idc
 	
 class testShimMatchers(Shimit):
 	knownHNSet = (
@@ -214,6 +227,26 @@ class testShimMatchers(Shimit):
 		"Test the HostnameMatch matcher against known values."
 		self.lcheck('hostname:', self.knownHostnames)
 
+	def testHostnameMerging(self):
+		"Test that hostname: matches merge into one and get the right results."
+		names = ('franklin.com', '.smack.com', '.a.franklin.com', 'x.y')
+		mo = matchers.HostnameMatch('hostname:', 'is-a-good-name')
+		for n in names:
+			self.assertEqual(mo.merge(matchers.HostnameMatch('hostname:', n)), True)
+		self.assertEqual(mo.merge(matchers.ClaimedHNMatch('claimedhn:', 'x')), False)
+		mo.finalize()
+		self.assertEqual(str(mo), "hostname: is-a-good-name hostname: franklin.com hostname: .smack.com hostname: .a.franklin.com hostname: x.y")
+		for ip, res in (('127.0.0.103', 1), ('127.0.1.1', 1),
+				('127.0.1.2', 1), ('127.0.2.1', 1),
+				('127.0.0.105', 0), ('127.0.0.104', 0)):
+			hi = makehi(rip = ip)
+			self.assertEqual(mo.eval(hi), res, "failed on "+ip)
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)), bool(res))
+		# '.smack.com' also matches 'smack.com' itself, but not
+		# names that merely end in it.
+		self.assertEqual(mo._matchmany('smack.com'), True)
+		self.assertEqual(mo._matchmany('bigsmack.com'), False)
+
 	knownCHostnames = (
 		('127.0.0.103', 'is-a-good-name', 1),
 		('127.0.0.101', 'not-a-forward', 1),
@@ -244,6 +277,51 @@ class testShimMatchers(Shimit):
 		"Test the claimedre: matcher to insure it matches against claimed hostnames."
 		self.lcheck("claimedre:", self.knownCREMatches)
 
+	def testREMerging(self):
+		"Test that re: matches merge into one and get the right results."
+		pats = ('^nomatch', 'franklin', r'(a)\1', '(?x) smack \. com $')
+		mo = matchers.REMatch('re:', '^is-a-')
+		for p in pats:
+			self.assertEqual(mo.merge(matchers.REMatch('re:', p)), True)
+		self.assertEqual(mo.merge(matchers.ClaimedREMatch('claimedre:', 'x')), False)
+		mo.finalize()
+		self.assertEqual(str(mo), "re: '^is-a-' re: '^nomatch' re: 'franklin' re: '(a)\\1' re: '(?x) smack \\. com $'")
+		# The backreference and the inline flag get searches of
+		# their own; everything else is one alternation.
+		self.assertEqual(len(mo.rexps), 3)
+		for ip, res in (('127.0.0.103', 1), ('127.0.1.1', 1),
+				('127.0.2.1', 1), ('127.0.0.105', 0),
+				('127.0.0.104', 0)):
+			hi = makehi(rip = ip)
+			self.assertEqual(mo.eval(hi), res, "failed on "+ip)
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)), bool(res))
+		mo = matchers.REMatch('re:', '(?P<a>x)')
+		self.assertEqual(mo.merge(matchers.REMatch('re:', '(?P<a>y)')), True)
+		mo.finalize()
+		self.assertEqual(len(mo.rexps), 2)
+
+	knownReqLiterals = (
+		(r'^dsl-[0-9]+\.', 'dsl-'),
+		('dyn(amic)?ip', 'dyn'),
+		(r'^(cable)\.[a-z]+\.Example\.com$', '.example.com'),
+		('[0-9]+', None),
+		('(?x) s m', 'sm'),
+		)
+	def testRELiterals(self):
+		"Test that re: matches find the literals their patterns require."
+		for p, res in self.knownReqLiterals:
+			self.assertEqual(matchers._reqliteral(p), res, "failed on "+p)
+		# An alternation can only be skipped if all of its patterns
+		# have a literal.
+		self.assertEqual(matchers._prefilter(['dsl', 'pool']), ('dsl', 'pool'))
+		self.assertEqual(matchers._prefilter(['dsl', '[0-9]']), None)
+		mo = matchers.REMatch('re:', 'SMACK')
+		self.assertEqual(mo.merge(matchers.REMatch('re:', 'nomatch')), True)
+		mo.finalize()
+		self.assertEqual(mo.lits, (('smack', 'nomatch'),))
+		self.assertEqual(mo.eval(makehi(rip = '127.0.2.1')), 1)
+		self.assertEqual(mo.eval(makehi(rip = '127.0.1.1')), 0)
+
 	knownForwhnMatches = (
 		('127.0.0.1', 'no-reverse-name', 0),
 		('127.0.10.1', 'no-reverse-name', 1),
@@ -279,6 +357,7 @@ class testShimMatchers(Shimit):
 			mo = matchers.IdentdMatch("identd:", iddes)
 			hi = makehi(rport = port)
 			self.assertEqual(mo.eval(hi), res)
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)), bool(res))
 	def testHasIdentd(self):
 		"Test for matching when we just want to know if we have identd data."
 		mo = matchers.IdentdMatch("IDENTD", None)
@@ -286,6 +365,7 @@ class testShimMatchers(Shimit):
 		for port in idports + (204,):
 			hi = makehi(rport = port)
 			self.assertEqual(mo.eval(hi), port in idports)
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)), port in idports)
 
 	# Test the time-based matchers.
 	knownTBInfo = (
@@ -318,6 +398,8 @@ class testShimMatchers(Shimit):
 			hi.settimes(times[0], times[1])
 			self.assertEqual(mo.eval(hi), res,
 					 "failed on %s %s / %s" % (n, v, times))
+			self.assertEqual(bool(rdparse.compiletree(mo)(hi)), bool(res),
+					 "compiled failed on %s %s / %s" % (n, v, times))
 
 	def testAnswersTo(self):
 		"Do a very basic test for answerson:."
@@ -328,6 +410,17 @@ class testShimMatchers(Shimit):
 		hi._anscache[25] = False
 		self.assertEqual(mo("answerson:", "10").eval(hi), True)
 		self.assertEqual(mo("answerson:", "25").eval(hi), False)
+		# Merged ports are true if any of them answers.
+		m2 = mo("answerson:", "25")
+		self.assertEqual(m2.merge(mo("answerson:", "10")), True)
+		m2.finalize()
+		self.assertEqual(m2.eval(hi), True)
+		self.assertEqual(rdparse.compiletree(m2)(hi), True)
+		self.assertEqual(str(m2), "answerson: 25 answerson: 10")
+		# A finalized matcher (from a bracketed orlist) still merges.
+		self.assertEqual(m2.merge(mo("answerson:", "80")), True)
+		m2.finalize()
+		self.assertEqual(m2.ports, (25, 10, 80))
 
 # Test things that should fail to be recognized.
 class testMatcherRejects(tUtils):
@@ -429,10 +522,14 @@ class testParsingEvaling(Shimit):
 		("re: ^abcdef", "re: '^abcdef'"),
 		("claimedre: ppp", "claimedre: 'ppp'"),
 		("re: '(abc|def)'", "re: '(abc|def)'"),
+		("re: a re: b", "re: 'a' re: 'b'"),
+		("(re: a re: b) re: c", "re: 'a' re: 'b' re: 'c'"),
 		("forwhn: foobar.com", "forwhn: foobar.com"),
 		("dnsbl: sbl.spamhaus.org", "dnsbl: sbl.spamhaus.org"),
 		("dnsbl: t.org/127.0.0.1", "dnsbl: t.org/127.0.0.1"),
 		("answerson: 25", "answerson: 25"),
+		("answerson: 25 answerson: 80", "answerson: 25 answerson: 80"),
+		("(answerson: 1) answerson: 2", "answerson: 1 answerson: 2"),
 		("stallfor: 10s", "stallfor: 10s"),
 		# The canonical duration for time-based duration is seconds.
 		("stallfor: 1m", "stallfor: 60s"),
@@ -441,6 +538,7 @@ class testParsingEvaling(Shimit):
 		('seenwithin: 10s', 'seenwithin: 10s'),
 		('seenwithin: 1d', 'seenwithin: 86400s'),
 		("firsttime", "firsttime"),
+		("dnsdegraded", "dnsdegraded"),
 		# test the default cascades.
 		("127.0.0.1", "ip: 127.0.0.1"),
 		("127.0.", "ip: 127.0."),
@@ -449,6 +547,8 @@ class testParsingEvaling(Shimit):
 		(".foobar.com", "hostname: .foobar.com"),
 		# test no-argument things that expand.
 		("UNKNOWN PARANOID", "hnstatus: UNKNOWN hnstatus: PARANOID"),
+		("(a.com .b.com) c.com", "hostname: a.com hostname: .b.com hostname: c.com"),
+		("(10. 11.) 12.", "ip: 10. ip: 11. ip: 12."),
 		# This tests IP address merging (sort of)
 		("128.120. 128.100.", "ip: 128.120. ip: 128.100."),
 		)
@@ -480,6 +580,9 @@ class testParsingEvaling(Shimit):
 		('UNKNOWN PARANOID', 'hnstatus: UNKNOWN hnstatus: PARANOID',
 		 ('127.0.0.1', 0), ('127.0.0.2', 1), ('127.0.0.100', 1),
 		 ('127.0.1.1', 0)),
+		('localhost .franklin.com', 'hostname: localhost hostname: .franklin.com',
+		 ('127.0.0.1', 1), ('127.0.1.1', 1), ('127.0.1.2', 1),
+		 ('127.0.0.103', 0)),
 		('ALL EXCEPT KNOWN', '(ALL) EXCEPT (hnstatus: KNOWN)',
 		 ('127.0.0.1', 0), ('127.0.0.2', 1), ('127.0.0.100', 1)),
 		('class: frotz AND KNOWN',
@@ -509,12 +612,15 @@ class testParsingEvaling(Shimit):
 			# But I'm paranoid.
 			r2 = rdparse.parse(pres, matchers.matchinfo)
 			self.assertEqual(str(r2), pres, "%s did not reparse identical" % (pres,))
+			evalf = rdparse.compiletree(root)
 			for ip, res in testline[2:]:
 				hi = makehi(rip = ip)
 				# We manually add a class so we can use it.
 				hi.addclass("frotz")
 				self.assertEqual(root.eval(hi), res,
 						 "%s failed on host %s" % (pstr, ip))
+				self.assertEqual(bool(evalf(hi)), bool(res),
+						 "compiled %s failed on host %s" % (pstr, ip))
 
 if __name__ == "__main__":
 	unittest.main()
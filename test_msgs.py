@@ -37,6 +37,25 @@ class basicTests(unittest.TestCase):
 		sdict = {'ip': 'def'}
 		self.assertEqual(msgs.format("%(ip)s", hi, fc, sdict), "127.100.0.10")
 		self.assertEqual(str(sdict), "{'ip': 'def'}")
+		# But it can supply things that hi doesn't know.
+		sdict = {'identd': 'nobody'}
+		self.assertEqual(msgs.format("%(identd)s@%(ip)s", hi, fc, sdict),
+				 "nobody@127.100.0.10")
+		self.assertRaises(KeyError, msgs.format, "%(identd)s", hi, fc)
+	def testConnIds(self):
+		"Test that the standard messages can be made to give the connection ID."
+		saved = (msgs.logconnect, msgs.loglimits, msgs.logreject,
+			 msgs.rejmsgs)
+		try:
+			msgs.addconnids()
+			hi = makehi(rip = '127.100.0.10')
+			fc = FakeCls('test', 10, None)
+			self.assertEqual(msgs.format(msgs.rejmsgs['reject'], hi, fc),
+					 "rejected: 127.100.0.10 by test (connection %d)" % (hi.getconnid(),))
+			self.assertEqual(msgs.rejmsgs['ipmax'], msgs.loglimits)
+		finally:
+			msgs.logconnect, msgs.loglimits, msgs.logreject, \
+					 msgs.rejmsgs = saved
 		
 
 if __name__ == "__main__":
@@ -109,6 +109,12 @@ class basicTests(unittest.TestCase):
 		n = netblock.IPRanges('127.0.0.0/23')
 		n.removeoddcidr('127.0.0.1/24')
 		self.assertEqual(str(n), '<IPRanges: 127.0.1.0-127.0.1.255>')
+	def testNumranges(self):
+		"""test that .numranges() gives the ranges as numbers."""
+		n = netblock.IPRanges('127.0.1.0/24')
+		n.add('10.0.0.1')
+		self.assertEqual(n.numranges(), [(0x0a000001, 0x0a000001),
+						 (0x7f000100, 0x7f0001ff)])
 
 class failureTests(unittest.TestCase):
 	knownBadInitArgs = (
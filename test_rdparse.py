@@ -111,6 +111,8 @@ class BooleanTerm:
 		self.name = name
 	def __str__(self):
 		return "bool: "+self.val
+	def sharekey(self):
+		return self.val
 	def eval(self, data):
 		__pychecker__ = "no-argsused"
 		return self.val in ("True", "T", "t")
@@ -166,6 +168,109 @@ class testEvalResults(unittest.TestCase):
 			p = rdparse.parse(s, BoolTInfo())
 			self.assertEqual(p.eval(None), res, "failed on "+s)
 
+	def testCompiled(self):
+		"Test that compiled parse trees give the same results."
+		for s, res in self.knownResults:
+			p = rdparse.parse(s, BoolTInfo())
+			self.assertEqual(bool(rdparse.compiletree(p)(None)),
+					 bool(res), "failed on "+s)
+		# Terminals can generate their own code.
+		class GenTerm(BooleanTerm):
+			def genexpr(self, c):
+				return c.lit(self.val in ("True", "T", "t"))
+		class GenTInfo(BoolTInfo):
+			terminals = {"bool:": GenTerm}
+		for s, res in self.knownResults:
+			p = rdparse.parse(s, GenTInfo())
+			self.assertEqual(bool(rdparse.compiletree(p)(None)),
+					 bool(res), "failed on "+s)
+
+	def testCostOrder(self):
+		"Test that compiled trees evaluate cheap operands first, but not past fixed ones."
+		seen = []
+		class CostTerm(BooleanTerm):
+			def eval(self, data):
+				seen.append(self.val)
+				return BooleanTerm.eval(self, data)
+		class CostTInfo(BoolTInfo):
+			terminals = {"bool:": CostTerm}
+		costs = {"f": 2, "F": 1, "False": 0, "t": None}
+		def cost(m):
+			return costs.get(m.val, 0)
+		knownOrders = (
+			("f F False", ["False", "F", "f"]),
+			("f AND False", ["False"]),
+			("f F t F False", ["F", "f", "t"]),
+			("(f AND F) T", ["T"]),
+			("True EXCEPT f False", ["True", "False", "f"]),
+			)
+		for s, order in knownOrders:
+			del seen[:]
+			p = rdparse.parse(s, CostTInfo())
+			rdparse.compiletree(p, cost, 1)(None)
+			self.assertEqual(seen, order, "failed on "+s)
+
+	def testAdaptive(self):
+		"Test that adaptive OR lists learn to try likely operands first."
+		costs = {"t": None}
+		def cost(m):
+			return costs.get(m.val, 0)
+		# Every operand takes one tick of our fake clock.
+		clock = [0]
+		def ticktime():
+			clock[0] += 0.5
+			return clock[0]
+		osample = rdparse.ADAPTSAMPLE
+		otime = rdparse.time.time
+		rdparse.ADAPTSAMPLE = 1
+		rdparse.time.time = ticktime
+		try:
+			ors = []
+			p = rdparse.parse("F f True t False T", BoolTInfo())
+			evalf = rdparse.compiletree(p, cost, 0, ors)
+			self.assertEqual(len(ors), 1)
+			for i in range(4):
+				self.assertEqual(evalf(None), 1)
+			ors[0].reorder()
+			# True has been hit; False and T have never been
+			# tried; nothing moves past t.
+			self.assertEqual(str(ors[0]),
+					 "bool: True [2/2] bool: F [0/2] bool: f [0/2] bool: t [0/0] bool: False [0/0] bool: T [0/0]")
+			self.assertEqual(evalf(None), 1)
+		finally:
+			rdparse.ADAPTSAMPLE = osample
+			rdparse.time.time = otime
+
+class testSharing(unittest.TestCase):
+	def testHashcons(self):
+		"Test that hash-consing shares identical subtrees, and that compiled trees memoize them."
+		table = {}
+		def shareable(m):
+			return m.val != "F"
+		p1 = rdparse.hashcons(rdparse.parse("t AND (f T)", BoolTInfo()),
+				      table, shareable)
+		seen = []
+		p2 = rdparse.hashcons(rdparse.parse("F (f T) (f T)", BoolTInfo()),
+				      table, shareable, seen)
+		self.assertEqual(p1.right is p2.ops[1], True)
+		self.assertEqual(p2.ops[1] is p2.ops[2], True)
+		self.assertEqual(p1.right.ops[0] is p2.ops[1].ops[0], True)
+		# Nothing with F in it is shared.
+		self.assertEqual(len(seen), 6)
+		self.assertEqual(p2 in seen, False)
+		self.assertEqual(str(p2), "bool: F bool: f bool: T bool: f bool: T")
+		class Data:
+			def __init__(self):
+				self.memo = {}
+			def memoized(self, key, func, *args):
+				if key not in self.memo:
+					self.memo[key] = func(*args)
+				return self.memo[key]
+		d = Data()
+		evalf = rdparse.compiletree(p1, memo = set([p1.right]))
+		self.assertEqual(evalf(d), 1)
+		self.assertEqual(d.memo, {p1.right: 1})
+
 class MergeTerm:
 	def __init__(self, name, val):
 		self.name = name
@@ -252,5 +357,18 @@ class testFinalizeErrors(unittest.TestCase):
 			self.assertRaises(rdparse.ParseError,
 					  rdparse.parse, s, InfoObj)
 
+class testOperands(unittest.TestCase):
+	knownValues = (
+		("c", ["c"]),
+		("c d a: b", ["c", "d", "a: b"]),
+		("!(c EXCEPT d) AND a: A", ["c", "d", "a: A"]),
+		("c && d EXCEPT a: b", ["c", "d", "a: b"]),
+		)
+	def testOperands(self):
+		"Test that operands() finds all operands in evaluation order."
+		for pstr, res in self.knownValues:
+			ops = rdparse.operands(rdparse.parse(pstr, NodeInfo()))
+			self.assertEqual(map(str, ops), res)
+
 if __name__ == "__main__":
 	unittest.main()
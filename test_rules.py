@@ -2,6 +2,7 @@
 # Test the rules module against various things.
 #
 import rules
+import hinfo
 import unittest
 import StringIO
 
@@ -144,6 +145,175 @@ class testRulesEval(unittest.TestCase):
 		hi = makehi()
 		self.assertEqual(rls.eval(hi), [])
 
+	knownPlans = (
+		("a: ALL\nb: 127. AND local: 25\n", []),
+		("a: ALL\nb: 127. AND NOT identd: cks\n", [('identd', None)]),
+		("a: dnsbl: a.org KNOWN\nb: IDENTD answerson: 25\nc: firsttime re: foo\n",
+		 [('iptimes', None), ('identd', None), ('answerson', 25),
+		  ('hostname', None), ('dnsbl', '.a.org')]),
+		)
+	def testPlans(self):
+		"Test that rules lists know what lookups they can need, in cost order."
+		for rf, plan in self.knownPlans:
+			rls = rules.fromfile(StringIO.StringIO(rf), "<t>")
+			self.assertEqual(rls.plan, plan)
+		rls = rules.fromfile(StringIO.StringIO(self.knownPlans[2][0]), "<t>")
+		self.assertEqual(rls[1].facets,
+				 frozenset([('identd', None), ('answerson', 25)]))
+
+	def testCheapFirst(self):
+		"Test that cheap operands are evaluated before expensive ones."
+		rules.setcheapfirst(1)
+		try:
+			self.checkCheapFirst()
+		finally:
+			rules.setcheapfirst(0)
+		# Without cheapfirst, source order rules.
+		rls = rules.fromfile(StringIO.StringIO("a: KNOWN 1.\n"), "<t>")
+		hi = makehi()
+		rls.eval(hi)
+		self.assertEqual(hi.hnknown(), True)
+	def checkCheapFirst(self):
+		rls = rules.fromfile(StringIO.StringIO("a: dnsbl: a.org 1.\nb: IDENTD AND 10.\n"), "<t>")
+		hi = makehi()
+		self.assertEqual(formatrmatch(rls.eval(hi)), "a@1 GLOBAL@-1")
+		self.assertEqual(hi._lupcache, {})
+		hi = makehi()
+		hi.addclass('a')
+		self.assertEqual(rls.eval(hi), [])
+		self.assertEqual(hi._idinit, None)
+		# Nothing moves past IP times matchers.
+		rls = rules.fromfile(StringIO.StringIO("a: KNOWN firsttime 1.\n"), "<t>")
+		hi = makehi()
+		rls.eval(hi)
+		self.assertEqual(hi.hnknown(), True)
+
+	def testAdaptive(self):
+		"Test that adaptive rules lists know their or-lists."
+		rules.setadaptive(1)
+		try:
+			rls = rules.fromfile(StringIO.StringIO("a: 10. KNOWN\nb: ALL\n"), "<t>")
+		finally:
+			rules.setadaptive(0)
+		self.assertEqual(len(rls.ors), 1)
+		self.assertEqual(rls.ors[0][0].lineno, 1)
+		hi = makehi()
+		self.assertEqual(formatrmatch(rls.eval(hi)), "b@2 GLOBAL@-1")
+		rls.reorder()
+
+	listenRules = """a: local: 25 AND KNOWN
+b/nt: local: 25@127.0.0.1 local: 80
+c: localip: 127.0.0. EXCEPT 10.
+d: KNOWN AND local: 25
+e: NOT local: 25
+f: ALL
+"""
+	knownCandidates = (
+		('127.0.0.1', 25, "a b c d e f"),
+		('127.0.0.1', 80, "b c d e f"),
+		('127.0.0.2', 25, "a c d e f"),
+		('10.0.0.1', 22, "d e f"),
+		)
+	def testListenerIndex(self):
+		"Test that rules guarded by local: checks are only tried on their listeners."
+		rls = rules.fromfile(StringIO.StringIO(self.listenRules), "<t>")
+		for lip, lport, res in self.knownCandidates:
+			hi = makehi(lip = lip, lport = lport)
+			self.assertEqual(" ".join([r.clsname for r in rls.candidates(hi)]), res)
+		hi = makehi(lip = '127.0.0.1', lport = 80)
+		self.assertEqual(formatrmatch(rls.eval(hi)), "b@2 c@3 GLOBAL@-1")
+		hi = makehi(lip = '10.0.0.1', lport = 22)
+		self.assertEqual(formatrmatch(rls.eval(hi)), "e@5 GLOBAL@-1")
+
+	ipRules = """a: 10. AND KNOWN
+b: 10.1.0.0/16 192.168.1.1 EXCEPT 10.1.2.3
+c: local: 25 AND 172.16.
+d: KNOWN AND 10.
+e/nt: 10.0.0.0-10.0.255.255 10.0.0.0/24
+f: ALL
+"""
+	knownIPCandidates = (
+		('10.0.0.1', 25, "a d e f"),
+		('10.1.2.3', 25, "a b d f"),
+		('10.2.0.0', 80, "a d f"),
+		('192.168.1.1', 25, "b d f"),
+		('192.168.1.2', 25, "d f"),
+		('172.16.0.1', 25, "c d f"),
+		('172.16.0.1', 80, "d f"),
+		('0.0.0.0', 25, "d f"),
+		('255.255.255.255', 25, "d f"),
+		)
+	def testIPIndex(self):
+		"Test that rules guarded by ip: checks are only tried on IP addresses that they can match."
+		rls = rules.fromfile(StringIO.StringIO(self.ipRules), "<t>")
+		for rip, lport, res in self.knownIPCandidates:
+			hi = makehi(rip = rip, lport = lport)
+			self.assertEqual(" ".join([r.clsname for r in rls.candidates(hi)]), res, "failed on %s@%d" % (rip, lport))
+		hi = makehi(rip = '10.0.0.1')
+		hi.addclass('a')
+		hi.addclass('d')
+		self.assertEqual(formatrmatch(rls.eval(hi)), "e@5 f@6 GLOBAL@-1")
+		# Identical candidate lists are shared.
+		self.assertEqual(rls.candidates(makehi(rip = '0.0.0.0')) is
+				 rls.candidates(makehi(rip = '172.16.0.1')), True)
+
+	def testSharing(self):
+		"Test that identical subtrees of rules are shared and only evaluated once."
+		rls = rules.fromfile(StringIO.StringIO("a/nt: 1. EXCEPT KNOWN\nb/nt: 1.1. EXCEPT KNOWN\nc/nt: class: a\nd: class: a\n"), "<t>")
+		known = rls[0].matcher.right
+		self.assertEqual(rls[1].matcher.right is known, True)
+		self.assertEqual(rls[0].matcher.left is rls[1].matcher.left, False)
+		self.assertEqual(rls[2].matcher is rls[3].matcher, False)
+		# Only the shared subtree that needs a lookup is memoized.
+		self.assertEqual(rls.memo, set([known]))
+		hi = makehi()
+		self.assertEqual(formatrmatch(rls.eval(hi)), "a@1 b@2 c@3 d@4 GLOBAL@-1")
+		self.assertEqual(hi._memo, {known: False})
+		# Matchers that print the same are not necessarily the same.
+		rls = rules.fromfile(StringIO.StringIO("a/nt: re: 'l'' re: ''q'\nb/nt: re: l re: q\n"), "<t>")
+		self.assertEqual(str(rls[0].matcher), str(rls[1].matcher))
+		self.assertEqual(rls[0].matcher is rls[1].matcher, False)
+		self.assertEqual(formatrmatch(rls.eval(makehi(rip = "127.0.0.1"))), "b@2 GLOBAL@-1")
+
+	def testResultCache(self):
+		"Test that rule results are reused for repeat connections when they can be."
+		rules.setresultttl(60)
+		try:
+			rls = rules.fromfile(StringIO.StringIO("a/nt: 1. EXCEPT class: x\nb: 2. AND firsttime\nc: 1.1. 2.\n"), "<t>")
+			hi = makehi()
+			self.assertEqual(formatrmatch(rls.eval(hi)), "a@1 c@3 GLOBAL@-1")
+			self.assertEqual(rls.results.keys(), [(hi.getipn(), hi.getlipn(), hi.getlportn())])
+			# Later connections get the cached result without
+			# evaluating anything.
+			key = rls.results.keys()[0]
+			rls.results[key] = ([rls[2], rules.globalrule],
+					    rls.results[key][1])
+			hi = makehi(rport = 300)
+			self.assertEqual(formatrmatch(rls.eval(hi)), "c@3 GLOBAL@-1")
+			self.assertEqual(hi.getclasses(), ['c'])
+			# But not ones that already have classes.
+			hi = makehi()
+			hi.addclass('x')
+			self.assertEqual(formatrmatch(rls.eval(hi)), "c@3 GLOBAL@-1")
+			# Results that depended on IP times are not cached.
+			hi = makehi(rip = '2.0.0.1')
+			rls.eval(hi)
+			self.assertEqual(len(rls.results), 1)
+			# Results don't outlive the shared cache entries
+			# they came from.
+			hinfo.setanswersonttls(10, 10)
+			hinfo.anscache.put(('3.0.0.1', 25), True)
+			rls = rules.fromfile(StringIO.StringIO("d: answerson: 25\n"), "<t>")
+			hi = makehi(rip = '3.0.0.1')
+			self.assertEqual(formatrmatch(rls.eval(hi)), "d@1 GLOBAL@-1")
+			self.assertEqual(rls.results.values()[0][1],
+					 hinfo.anscache.getent(('3.0.0.1', 25))[1])
+		finally:
+			rules.setresultttl(0)
+			hinfo.setanswersonttls(hinfo.ANSWERSONTTL,
+					       hinfo.ANSWERSONNEGTTL)
+			hinfo.flushcaches()
+
 	def testGetCnames(self):
 		"Test that rules.getclassnames() works."
 		rls = rules.fromfile(StringIO.StringIO(testfile), "<t>")
@@ -1,6 +1,7 @@
 #
 import util
 import unittest
+import os, tempfile
 
 class testSplitLocal(unittest.TestCase):
 	knownValues = (
@@ -46,5 +47,20 @@ class testIsIpAddr(unittest.TestCase):
 		for i, j in self.knownValues:
 			self.assertEqual(util.isipaddr(i), j, "bad result at "+i)
 
+class testAtomicWrite(unittest.TestCase):
+	def testAtomicWrite(self):
+		"Test that atomicwrite replaces files and leaves nothing behind."
+		fname = tempfile.mktemp()
+		try:
+			open(fname, "w").write("old")
+			util.atomicwrite(fname, ["a", "b", "c"])
+			self.assertEqual(open(fname).read(), "abc")
+			self.assertEqual(os.path.exists(fname + ".new"), False)
+			self.assertRaises(TypeError, util.atomicwrite, fname, [1])
+			self.assertEqual(open(fname).read(), "abc")
+			self.assertEqual(os.path.exists(fname + ".new"), False)
+		finally:
+			os.unlink(fname)
+
 if __name__ == "__main__":
 	unittest.main()
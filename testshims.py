@@ -3,6 +3,7 @@
 # Look ma, shims.
 import socket, errno
 # for the error.
+import idclient
 
 iptoname = {
 	'127.0.0.1': 'localhost',
@@ -52,6 +53,12 @@ def myidentd(rip, rport, lip, lport, timeo):
 	if porttores.has_key(rport):
 		return porttores[rport]
 	return None
+# These hosts have no reachable identd at all.
+noidentdips = ('127.0.0.50', '127.0.0.51')
+def myqueryident(rip, rport, lip, lport, timeo):
+	if rip in noidentdips:
+		raise idclient.NoIdentd
+	return myidentd(rip, rport, lip, lport, timeo)
 
 # Fake sockets.
 # These deliberately have no fileno argument, so they detonate on contact
@@ -1,6 +1,8 @@
 #
 # Various utility routines used in multiple modules.
 
+import os
+
 # This is necessary to work around a small flaw in the Python socket API.
 # We cannot use socket.inet_aton() for annoying reasons.
 def isipaddr(s):
@@ -72,3 +74,23 @@ def getsecs_or_raise(val, err):
 		return num * 60 * 60
 	else:
 		return num * 60 * 60 * 24
+
+# Write the strings in chunks to fname so that anyone looking at fname
+# sees either all of the old contents or all of the new ones, never
+# part of each: we write a new file beside it, then rename it into
+# place.
+def atomicwrite(fname, chunks):
+	tmp = fname + ".new"
+	fp = open(tmp, "wb")
+	try:
+		try:
+			fp.writelines(chunks)
+			fp.flush()
+			os.fsync(fp.fileno())
+		finally:
+			fp.close()
+		os.rename(tmp, fname)
+	except:
+		try:	os.unlink(tmp)
+		except EnvironmentError:	pass
+		raise